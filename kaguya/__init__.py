@@ -84,6 +84,7 @@ if ENV:
     URL = os.environ.get("URL", "")  # Does not contain token
     PORT = int(os.environ.get("PORT", 5000))
     CERT_PATH = os.environ.get("CERT_PATH")
+    METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
 
     DB_URI = os.environ.get("DATABASE_URL")
     DONATION_LINK = os.environ.get("DONATION_LINK")
@@ -92,6 +93,12 @@ if ENV:
     DEL_CMDS = bool(os.environ.get("DEL_CMDS", False))
     STRICT_GBAN = bool(os.environ.get("STRICT_GBAN", False))
     WORKERS = int(os.environ.get("WORKERS", 8))
+    SHARDS = int(os.environ.get("SHARDS", 4))
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 16))
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 16))
+    DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 30 * 60))
+    DB_QUERY_CACHE = int(os.environ.get("DB_QUERY_CACHE", 500))
+    SLOW_QUERY_MS = int(os.environ.get("SLOW_QUERY_MS", 250))
     BAN_STICKER = os.environ.get(
         "BAN_STICKER", "CAADAgADOwADPPEcAXkko5EB3YGYAg"
     )
@@ -101,6 +108,11 @@ if ENV:
     TELETHON_ID = int(os.environ.get("TL_APP_ID", None))
     TELETHON_HASH = os.environ.get("TL_HASH", None)
     SPAMWATCH = os.environ.get("SPAMWATCH_API", None)
+    SPAMWATCH_SNAPSHOT = os.environ.get("SPAMWATCH_SNAPSHOT", None)
+    HUMAN_CHECK_TIMEOUT = int(
+        os.environ.get("HUMAN_CHECK_TIMEOUT", 24 * 60 * 60)
+    )
+    KICK_UNVERIFIED = bool(os.environ.get("KICK_UNVERIFIED", False))
 
 else:
     from kaguya.config import Development as Config
@@ -151,6 +163,7 @@ else:
     URL = Config.URL
     PORT = Config.PORT
     CERT_PATH = Config.CERT_PATH
+    METRICS_PORT = Config.METRICS_PORT
 
     DB_URI = Config.SQLALCHEMY_DATABASE_URI
     DONATION_LINK = Config.DONATION_LINK
@@ -159,6 +172,12 @@ else:
     DEL_CMDS = Config.DEL_CMDS
     STRICT_GBAN = Config.STRICT_GBAN
     WORKERS = Config.WORKERS
+    SHARDS = Config.SHARDS
+    DB_POOL_SIZE = Config.DB_POOL_SIZE
+    DB_MAX_OVERFLOW = Config.DB_MAX_OVERFLOW
+    DB_POOL_RECYCLE = Config.DB_POOL_RECYCLE
+    DB_QUERY_CACHE = Config.DB_QUERY_CACHE
+    SLOW_QUERY_MS = Config.SLOW_QUERY_MS
     BAN_STICKER = Config.BAN_STICKER
     # ALLOW_EXCL = Config.ALLOW_EXCL
     CUSTOM_CMD = Config.CUSTOM_CMD
@@ -167,6 +186,9 @@ else:
     TELETHON_HASH = Config.TELETHON_HASH
     TELETHON_ID = Config.TELETHON_ID
     SPAMWATCH = Config.SPAMWATCH_API
+    SPAMWATCH_SNAPSHOT = Config.SPAMWATCH_SNAPSHOT
+    HUMAN_CHECK_TIMEOUT = Config.HUMAN_CHECK_TIMEOUT
+    KICK_UNVERIFIED = Config.KICK_UNVERIFIED
 
 SUDO_USERS.add(OWNER_ID)
 
@@ -192,6 +214,11 @@ SUPPORT_USERS = list(SUPPORT_USERS)
 
 # Load at end to ensure all prev variables have been set
 from kaguya.modules.helper_funcs.handlers import CustomCommandHandler
+from kaguya.sharding import ChatShardedExecutor
+
+# handle each chat's updates in order, and different chats in parallel
+EXECUTOR = ChatShardedExecutor(dispatcher, SHARDS)
+EXECUTOR.install()
 
 if CUSTOM_CMD and len(CUSTOM_CMD) >= 1:
     tg.CommandHandler = CustomCommandHandler
@@ -2,13 +2,14 @@ import importlib, traceback, html, json
 import re
 from typing import Optional, List
 
-from telegram import Message, Chat, User
+from telegram import Message, Chat, Update, User
 from telegram import ParseMode, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
     CommandHandler,
     Filters,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
 )
 from telegram.ext.dispatcher import DispatcherHandlerStop
 from telegram.utils.helpers import escape_markdown
@@ -21,8 +22,10 @@ from kaguya import (
     WEBHOOK,
     CERT_PATH,
     PORT,
+    METRICS_PORT,
     URL,
     LOGGER,
+    EXECUTOR,
     BLACKLIST_CHATS,
     WHITELIST_CHATS,
 )
@@ -34,6 +37,16 @@ from kaguya.modules.purge import client
 from kaguya.modules.helper_funcs.chat_status import is_user_admin
 from kaguya.modules.helper_funcs.misc import paginate_modules
 from kaguya.modules.helper_funcs.alternate import typing_action
+from kaguya.modules.helper_funcs.command_index import index_commands
+from kaguya.modules.helper_funcs.query_stats import (
+    instrument_handlers,
+    instrument_updates,
+)
+from kaguya import metrics
+from kaguya.modules.helper_funcs.text_analysis import (
+    ANALYSIS_GROUP,
+    analyze_update,
+)
 
 
 PM_START_TEXT = f"""
@@ -590,6 +603,7 @@ def main():
         Filters.status_update.migrate, migrate_chats
     )
     is_chat_allowed_handler = MessageHandler(Filters.group, is_chat_allowed)
+    analysis_handler = TypeHandler(Update, analyze_update)
 
     # dispatcher.add_handler(test_handler)
     dispatcher.add_handler(start_handler)
@@ -599,6 +613,12 @@ def main():
     dispatcher.add_handler(settings_callback_handler)
     dispatcher.add_handler(migrate_handler)
     dispatcher.add_handler(is_chat_allowed_handler)
+    dispatcher.add_handler(analysis_handler, ANALYSIS_GROUP)
+    LOGGER.info("Indexed %d command handlers.", index_commands(dispatcher))
+    instrument_handlers(dispatcher)
+    instrument_updates(dispatcher, EXECUTOR)
+    # after the others so the group markers aren't indexed or instrumented
+    metrics.install(dispatcher, METRICS_PORT)
 
     dispatcher.add_error_handler(error_handler)
 
@@ -0,0 +1,341 @@
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List
+
+from telegram import Update
+from telegram.ext import Dispatcher, Handler
+
+from kaguya import LOGGER, EXECUTOR
+from kaguya.modules.helper_funcs.query_stats import get_handler_stats
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def _labels(names, values, extra="") -> str:
+    pairs = [
+        '{}="{}"'.format(name, _escape(value))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(object):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            "{}{} {}".format(self.name, _labels(self.labels, key), value)
+            for key, value in values
+        ]
+
+
+class Histogram(object):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [count per bucket and one for +Inf, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [
+                    [0] * (len(self.buckets) + 1),
+                    0.0,
+                ]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = [(k, list(v[0]), v[1]) for k, v in self._values.items()]
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        self.name,
+                        _labels(self.labels, key, 'le="{}"'.format(bound)),
+                        cumulative,
+                    )
+                )
+            lines.append(
+                "{}_sum{} {}".format(
+                    self.name, _labels(self.labels, key), total
+                )
+            )
+            lines.append(
+                "{}_count{} {}".format(
+                    self.name, _labels(self.labels, key), cumulative
+                )
+            )
+        return lines
+
+
+class Collected(object):
+    """
+    Values kept elsewhere, read when scraped. read returns a dict of label
+    value tuples to values.
+    """
+
+    def __init__(
+        self, name, help_text, labels, read: Callable[[], dict], kind="gauge"
+    ):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.read = read
+        self.kind = kind
+
+    def render(self) -> List[str]:
+        return [
+            "{}{} {}".format(self.name, _labels(self.labels, key), value)
+            for key, value in self.read().items()
+        ]
+
+
+METRICS = []
+
+
+def register(metric):
+    METRICS.append(metric)
+    return metric
+
+
+def render() -> str:
+    """All metrics in the prometheus text format."""
+    lines = []
+    for metric in METRICS:
+        try:
+            samples = metric.render()
+        except Exception:
+            LOGGER.exception("Failed to read metric %s", metric.name)
+            continue
+        lines.append("# HELP {} {}".format(metric.name, metric.help))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+UPDATES = register(
+    Counter("kaguya_updates_total", "Updates received", ("type",))
+)
+GROUP_LATENCY = register(
+    Histogram(
+        "kaguya_group_latency_seconds",
+        "Time an update spent in a handler group, run_async callbacks "
+        "only count as far as being queued",
+        ("group",),
+    )
+)
+API_LATENCY = register(
+    Histogram("kaguya_api_request_seconds", "Bot API requests", ("method",))
+)
+API_ERRORS = register(
+    Counter(
+        "kaguya_api_errors_total",
+        "Failed Bot API requests by error class, eg. RetryAfter",
+        ("method", "error"),
+    )
+)
+
+
+def update_type(update: Update) -> str:
+    for kind in (
+        "message",
+        "edited_message",
+        "channel_post",
+        "edited_channel_post",
+        "callback_query",
+        "inline_query",
+        "chosen_inline_result",
+        "shipping_query",
+        "pre_checkout_query",
+        "poll",
+        "poll_answer",
+    ):
+        if getattr(update, kind, None) is not None:
+            return kind
+    return "other"
+
+
+# (update, group, start) of the group the update on this thread is in
+GROUP_TIMER = threading.local()
+
+
+class GroupMarker(Handler):
+    """
+    Put first in each handler group, and alone in one last group. Never
+    handles anything; when an update reaches a marker the update left the
+    previous group, so the time since that group's marker is its latency.
+    """
+
+    def __init__(self, group, first=False):
+        super().__init__(lambda update, context: None)
+        # None for the closing marker
+        self.group = group
+        self.first = first
+
+    def check_update(self, update):
+        now = time.perf_counter()
+        pending = getattr(GROUP_TIMER, "value", None)
+        # one left pending by an update that stopped early is dropped
+        if pending is not None and pending[0] is update:
+            GROUP_LATENCY.observe(now - pending[2], str(pending[1]))
+        if self.first and isinstance(update, Update):
+            UPDATES.inc(update_type(update))
+        if self.group is None:
+            GROUP_TIMER.value = None
+        else:
+            GROUP_TIMER.value = (update, self.group, now)
+        return None
+
+
+def instrument_groups(dispatcher: Dispatcher):
+    """Time each handler group. Call it once all handlers were added."""
+    groups = sorted(dispatcher.handlers)
+    for group in groups:
+        dispatcher.handlers[group].insert(
+            0, GroupMarker(group, first=group == groups[0])
+        )
+    dispatcher.add_handler(GroupMarker(None), groups[-1] + 1)
+
+
+def instrument_bot(bot):
+    """Time every Bot API request and count the failed ones."""
+    request = bot.request
+    post = request.post
+
+    def timed_post(url, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            return post(url, *args, **kwargs)
+        except Exception as excp:
+            API_ERRORS.inc(method, type(excp).__name__)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - start, method)
+
+    request.post = timed_post
+
+
+def register_collected(dispatcher: Dispatcher):
+    """Queue depths and the per handler database stats."""
+
+    def async_queue_depth():
+        # private to the dispatcher, gone if a new version renames it
+        async_queue = getattr(dispatcher, "_Dispatcher__async_queue", None)
+        return {(): async_queue.qsize()} if async_queue else {}
+
+    register(
+        Collected(
+            "kaguya_async_queue_depth",
+            "run_async callbacks waiting for a worker",
+            (),
+            async_queue_depth,
+        )
+    )
+    register(
+        Collected(
+            "kaguya_shard_queue_depth",
+            "Updates waiting for their shard",
+            ("shard",),
+            lambda: {(x["shard"],): x["depth"] for x in EXECUTOR.stats()},
+        )
+    )
+    register(
+        Collected(
+            "kaguya_handler_db_statements_total",
+            "SQL statements run by handler callbacks",
+            ("handler",),
+            lambda: {
+                (k,): v.statements for k, v in get_handler_stats().items()
+            },
+            kind="counter",
+        )
+    )
+    register(
+        Collected(
+            "kaguya_handler_db_seconds_total",
+            "Time handler callbacks spent in SQL statements",
+            ("handler",),
+            lambda: {(k,): v.db_time for k, v in get_handler_stats().items()},
+            kind="counter",
+        )
+    )
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def install(dispatcher: Dispatcher, port: int):
+    """
+    Instrument the dispatcher and its bot, and serve /metrics on port.
+    Does nothing if port is 0, nothing would read them. Call it once all
+    handlers were added.
+    """
+    if not port:
+        return
+    instrument_groups(dispatcher)
+    instrument_bot(dispatcher.bot)
+    register_collected(dispatcher)
+    start_server(port)
+
+
+def start_server(port: int):
+    """Serve /metrics on port from a daemon thread."""
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="metrics", daemon=True
+    ).start()
+    LOGGER.info("Serving metrics on port %d.", port)
+    return server
@@ -14,6 +14,8 @@ from kaguya.modules.helper_funcs.chat_status import (
     can_promote,
     user_admin,
     can_pin,
+    get_admin_roster,
+    invalidate_admin_roster,
 )
 from kaguya.modules.helper_funcs.extraction import (
     extract_user,
@@ -76,6 +78,7 @@ def promote(update, context):
         can_restrict_members=bot_member.can_restrict_members,
         can_pin_messages=bot_member.can_pin_messages,
     )
+    invalidate_admin_roster(chat.id)
 
     message.reply_text("Promoted🧡")
     return (
@@ -137,6 +140,7 @@ def demote(update, context):
             can_restrict_members=False,
             can_pin_messages=False,
         )
+        invalidate_admin_roster(chat.id)
         message.reply_text("Successfully demoted!")
         return (
             "<b>{}:</b>"
@@ -275,7 +279,9 @@ def invite(update, context):
 
 @typing_action
 def adminlist(update, context):
-    administrators = update.effective_chat.get_administrators()
+    administrators = get_admin_roster(
+        context.bot, update.effective_chat.id
+    ).values()
     text = "Admins in <b>{}</b>:".format(
         update.effective_chat.title or "this chat"
     )
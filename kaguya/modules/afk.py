@@ -2,7 +2,7 @@ from typing import Optional
 import random
 
 from telegram import Message, User
-from telegram import MessageEntity, ParseMode
+from telegram import ParseMode
 from telegram.error import BadRequest
 from telegram.ext import Filters, MessageHandler
 
@@ -12,9 +12,9 @@ from kaguya.modules.disable import (
     DisableAbleMessageHandler,
 )
 from kaguya.modules.sql import afk_sql as sql
-from kaguya.modules.users import get_user_id
 
 from kaguya.modules.helper_funcs.alternate import send_message
+from kaguya.modules.helper_funcs.text_analysis import get_analysis
 import kaguya.modules.helper_funcs.fun_strings as fun
 
 AFK_GROUP = 7
@@ -48,47 +48,36 @@ def no_longer_afk(update, context):
 
 
 def reply_afk(update, context):
-    message = update.effective_message  # type: Optional[Message]
-
-    entities = message.parse_entities(
-        [MessageEntity.TEXT_MENTION, MessageEntity.MENTION]
-    )
-    if message.entities and entities:
-        for ent in entities:
-            if ent.type == MessageEntity.TEXT_MENTION:
-                user_id = ent.user.id
-                fst_name = ent.user.first_name
-
-            elif ent.type == MessageEntity.MENTION:
-                user_id = get_user_id(
-                    message.text[ent.offset : ent.offset + ent.length]
+    analysis = get_analysis(update)
+
+    for user_id, fst_name in analysis.mentions:
+        if not user_id:
+            # Should never happen, since for a user to become AFK they must have spoken. Maybe changed username?
+            return
+
+        if sql.is_afk(user_id):
+            valid, reason = sql.check_afk_status(user_id)
+            if valid:
+                if not fst_name:
+                    try:
+                        chat = context.bot.get_chat(user_id)
+                    except BadRequest:
+                        print(
+                            "Error in afk can't get user id {}".format(user_id)
+                        )
+                        return
+                    fst_name = chat.first_name
+
+                if not reason:
+                    rplafkstr = random.choice(fun.AFKRPL)
+                    res = rplafkstr.format(fst_name)
+                else:
+                    res = f"<b>{fst_name}</b> is away from keyboard! says it's because of \n{reason}"
+                send_message(
+                    update.effective_message,
+                    res,
+                    parse_mode=ParseMode.HTML,
                 )
-                if not user_id:
-                    # Should never happen, since for a user to become AFK they must have spoken. Maybe changed username?
-                    return
-                try:
-                    chat = context.bot.get_chat(user_id)
-                except BadRequest:
-                    print("Error in afk can't get user id {}".format(user_id))
-                    return
-                fst_name = chat.first_name
-
-            else:
-                return
-
-            if sql.is_afk(user_id):
-                valid, reason = sql.check_afk_status(user_id)
-                if valid:
-                    if not reason:
-                        rplafkstr = random.choice(fun.AFKRPL)
-                        res = rplafkstr.format(fst_name)
-                    else:
-                        res = f"<b>{fst_name}</b> is away from keyboard! says it's because of \n{reason}"
-                    send_message(
-                        update.effective_message,
-                        res,
-                        parse_mode=ParseMode.HTML,
-                    )
 
 
 def __user_info__(user_id):
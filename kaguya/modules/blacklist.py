@@ -1,5 +1,4 @@
 import html
-import re
 
 from telegram import ParseMode, ChatPermissions
 from telegram.error import BadRequest
@@ -10,7 +9,7 @@ import kaguya.modules.sql.blacklist_sql as sql
 from kaguya import dispatcher, LOGGER
 from kaguya.modules.disable import DisableAbleCommandHandler
 from kaguya.modules.helper_funcs.chat_status import user_admin, user_not_admin
-from kaguya.modules.helper_funcs.extraction import extract_text
+from kaguya.modules.helper_funcs.text_analysis import get_analysis
 from kaguya.modules.helper_funcs.misc import split_message
 from kaguya.modules.log_channel import loggable
 from kaguya.modules.warns import warn
@@ -96,10 +95,25 @@ def add_blacklist(update, context):
                 if trigger.strip()
             )
         )
-        for trigger in to_blacklist:
-            sql.add_to_blacklist(chat_id, trigger.lower())
+        rejected = [
+            trigger
+            for trigger in to_blacklist
+            if not sql.add_to_blacklist(chat_id, trigger.lower())
+        ]
+        if rejected:
+            send_message(
+                update.effective_message,
+                "Wildcard triggers need a word to match, these would match "
+                "every message: <code>{}</code>".format(
+                    html.escape(", ".join(rejected))
+                ),
+                parse_mode=ParseMode.HTML,
+            )
+            to_blacklist = [x for x in to_blacklist if x not in rejected]
 
-        if len(to_blacklist) == 1:
+        if not to_blacklist:
+            return
+        elif len(to_blacklist) == 1:
             send_message(
                 update.effective_message,
                 "Added blacklist <code>{}</code> in chat: <b>{}</b>!".format(
@@ -358,89 +372,87 @@ def del_blacklist(update, context):
     message = update.effective_message
     user = update.effective_user
     bot = context.bot
-    to_match = extract_text(message)
-    if not to_match:
+    analysis = get_analysis(update)
+    if not analysis:
         return
 
-    getmode, value = sql.get_blacklist_setting(chat.id)
+    trigger = sql.match_blacklist(chat.id, analysis.normalized)
+    if not trigger:
+        return
 
-    chat_filters = sql.get_chat_blacklist(chat.id)
-    for trigger in chat_filters:
-        pattern = r"( |^|[^\w])" + re.escape(trigger) + r"( |$|[^\w])"
-        if re.search(pattern, to_match, flags=re.IGNORECASE):
-            try:
-                if getmode == 0:
-                    return
-                elif getmode == 1:
-                    message.delete()
-                elif getmode == 2:
-                    message.delete()
-                    warn(
-                        update.effective_user,
-                        chat,
-                        ("Using blacklisted trigger: {}".format(trigger)),
-                        message,
-                        update.effective_user,
-                    )
-                    return
-                elif getmode == 3:
-                    message.delete()
-                    bot.restrict_chat_member(
-                        chat.id,
-                        update.effective_user.id,
-                        permissions=ChatPermissions(can_send_messages=False),
-                    )
-                    bot.sendMessage(
-                        chat.id,
-                        f"Muted {user.first_name} for using Blacklisted word: {trigger}!",
-                    )
-                    return
-                elif getmode == 4:
-                    message.delete()
-                    res = chat.unban_member(update.effective_user.id)
-                    if res:
-                        bot.sendMessage(
-                            chat.id,
-                            f"Kicked {user.first_name} for using Blacklisted word: {trigger}!",
-                        )
-                    return
-                elif getmode == 5:
-                    message.delete()
-                    chat.kick_member(user.id)
-                    bot.sendMessage(
-                        chat.id,
-                        f"Banned {user.first_name} for using Blacklisted word: {trigger}",
-                    )
-                    return
-                elif getmode == 6:
-                    message.delete()
-                    bantime = extract_time(message, value)
-                    chat.kick_member(user.id, until_date=bantime)
-                    bot.sendMessage(
-                        chat.id,
-                        f"Banned {user.first_name} until '{value}' for using Blacklisted word: {trigger}!",
-                    )
-                    return
-                elif getmode == 7:
-                    message.delete()
-                    mutetime = extract_time(message, value)
-                    bot.restrict_chat_member(
-                        chat.id,
-                        user.id,
-                        until_date=mutetime,
-                        permissions=ChatPermissions(can_send_messages=False),
-                    )
-                    bot.sendMessage(
-                        chat.id,
-                        f"Muted {user.first_name} until '{value}' for using Blacklisted word: {trigger}!",
-                    )
-                    return
-            except BadRequest as excp:
-                if excp.message == "Message to delete not found":
-                    pass
-                else:
-                    LOGGER.exception("Error while deleting blacklist message.")
-            break
+    getmode, value = sql.get_blacklist_setting(chat.id)
+    try:
+        if getmode == 0:
+            return
+        elif getmode == 1:
+            message.delete()
+        elif getmode == 2:
+            message.delete()
+            warn(
+                update.effective_user,
+                chat,
+                ("Using blacklisted trigger: {}".format(trigger)),
+                message,
+                update.effective_user,
+            )
+            return
+        elif getmode == 3:
+            message.delete()
+            bot.restrict_chat_member(
+                chat.id,
+                update.effective_user.id,
+                permissions=ChatPermissions(can_send_messages=False),
+            )
+            bot.sendMessage(
+                chat.id,
+                f"Muted {user.first_name} for using Blacklisted word: {trigger}!",
+            )
+            return
+        elif getmode == 4:
+            message.delete()
+            res = chat.unban_member(update.effective_user.id)
+            if res:
+                bot.sendMessage(
+                    chat.id,
+                    f"Kicked {user.first_name} for using Blacklisted word: {trigger}!",
+                )
+            return
+        elif getmode == 5:
+            message.delete()
+            chat.kick_member(user.id)
+            bot.sendMessage(
+                chat.id,
+                f"Banned {user.first_name} for using Blacklisted word: {trigger}",
+            )
+            return
+        elif getmode == 6:
+            message.delete()
+            bantime = extract_time(message, value)
+            chat.kick_member(user.id, until_date=bantime)
+            bot.sendMessage(
+                chat.id,
+                f"Banned {user.first_name} until '{value}' for using Blacklisted word: {trigger}!",
+            )
+            return
+        elif getmode == 7:
+            message.delete()
+            mutetime = extract_time(message, value)
+            bot.restrict_chat_member(
+                chat.id,
+                user.id,
+                until_date=mutetime,
+                permissions=ChatPermissions(can_send_messages=False),
+            )
+            bot.sendMessage(
+                chat.id,
+                f"Muted {user.first_name} until '{value}' for using Blacklisted word: {trigger}!",
+            )
+            return
+    except BadRequest as excp:
+        if excp.message == "Message to delete not found":
+            pass
+        else:
+            LOGGER.exception("Error while deleting blacklist message.")
 
 
 def __import_data__(chat_id, data):
@@ -479,6 +491,8 @@ Admin only:
  × /addblacklist <triggers>: Add a trigger to the blacklist. Each line is considered one trigger, so using different lines will allow you to add multiple triggers.
  × /unblacklist <triggers>: Remove triggers from the blacklist. Same newline logic applies here, so you can remove multiple triggers at once.
  × /rmblacklist <triggers>: Same as above.
+ × Triggers match regardless of case and of lookalike unicode forms.
+ × Start a trigger with `wildcard:` to use `*` for any run of characters other than spaces, or `?` for a single one, eg: `wildcard:f*ck`. Without it `*` and `?` are matched as they are.
  × /blacklistmode <off/del/warn/ban/kick/mute/tban/tmute>: Action to perform when someone sends blacklisted words.
 """
 BLACKLIST_HANDLER = DisableAbleCommandHandler(
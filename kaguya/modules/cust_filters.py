@@ -1,4 +1,3 @@
-import re
 from html import escape
 
 import telegram
@@ -15,10 +14,10 @@ from telegram.utils.helpers import mention_html, escape_markdown
 from kaguya import dispatcher, LOGGER
 from kaguya.modules.disable import DisableAbleCommandHandler
 from kaguya.modules.helper_funcs.chat_status import user_admin
-from kaguya.modules.helper_funcs.extraction import extract_text
 from kaguya.modules.helper_funcs.filters import CustomFilters
 from kaguya.modules.helper_funcs.misc import build_keyboard_parser
 from kaguya.modules.helper_funcs.msg_types import get_filter_type
+from kaguya.modules.helper_funcs.text_analysis import get_analysis
 from kaguya.modules.helper_funcs.string_handling import (
     split_quotes,
     button_markdown_parser,
@@ -275,210 +274,204 @@ def reply_filter(update, context):
     chat = update.effective_chat  # type: Optional[Chat]
     message = update.effective_message  # type: Optional[Message]
 
-    to_match = extract_text(message)
-    if not to_match:
+    analysis = get_analysis(update)
+    if not analysis:
         return
 
-    chat_filters = sql.get_chat_triggers(chat.id)
-    for keyword in chat_filters:
-        pattern = r"( |^|[^\w])" + re.escape(keyword) + r"( |$|[^\w])"
-        if re.search(pattern, to_match, flags=re.IGNORECASE):
-            filt = sql.get_filter(chat.id, keyword)
-            if filt.reply == "there is should be a new reply":
-                buttons = sql.get_buttons(chat.id, filt.keyword)
-                keyb = build_keyboard_parser(context.bot, chat.id, buttons)
-                keyboard = InlineKeyboardMarkup(keyb)
-
-                VALID_WELCOME_FORMATTERS = [
-                    "first",
-                    "last",
-                    "fullname",
-                    "username",
-                    "id",
-                    "chatname",
-                    "mention",
-                ]
-                if filt.reply_text:
-                    valid_format = escape_invalid_curly_brackets(
-                        filt.reply_text, VALID_WELCOME_FORMATTERS
-                    )
-                    if valid_format:
-                        filtext = valid_format.format(
-                            first=escape(message.from_user.first_name),
-                            last=escape(
-                                message.from_user.last_name
-                                or message.from_user.first_name
-                            ),
-                            fullname=" ".join(
-                                [
-                                    escape(message.from_user.first_name),
-                                    escape(message.from_user.last_name),
-                                ]
-                                if message.from_user.last_name
-                                else [escape(message.from_user.first_name)]
-                            ),
-                            username="@" + escape(message.from_user.username)
-                            if message.from_user.username
-                            else mention_html(
-                                message.from_user.id,
-                                message.from_user.first_name,
-                            ),
-                            mention=mention_html(
-                                message.from_user.id,
-                                message.from_user.first_name,
-                            ),
-                            chatname=escape(message.chat.title)
-                            if message.chat.type != "private"
-                            else escape(message.from_user.first_name),
-                            id=message.from_user.id,
-                        )
-                    else:
-                        filtext = ""
-                else:
-                    filtext = ""
+    keyword = sql.match_filter(chat.id, analysis.lowered)
+    if not keyword:
+        return
 
-                if filt.file_type in (sql.Types.BUTTON_TEXT, sql.Types.TEXT):
+    filt = sql.get_filter(chat.id, keyword)
+    if filt.reply == "there is should be a new reply":
+        buttons = sql.get_buttons(chat.id, filt.keyword)
+        keyb = build_keyboard_parser(context.bot, chat.id, buttons)
+        keyboard = InlineKeyboardMarkup(keyb)
+
+        VALID_WELCOME_FORMATTERS = [
+            "first",
+            "last",
+            "fullname",
+            "username",
+            "id",
+            "chatname",
+            "mention",
+        ]
+        if filt.reply_text:
+            valid_format = escape_invalid_curly_brackets(
+                filt.reply_text, VALID_WELCOME_FORMATTERS
+            )
+            if valid_format:
+                filtext = valid_format.format(
+                    first=escape(message.from_user.first_name),
+                    last=escape(
+                        message.from_user.last_name
+                        or message.from_user.first_name
+                    ),
+                    fullname=" ".join(
+                        [
+                            escape(message.from_user.first_name),
+                            escape(message.from_user.last_name),
+                        ]
+                        if message.from_user.last_name
+                        else [escape(message.from_user.first_name)]
+                    ),
+                    username=(
+                        "@" + escape(message.from_user.username)
+                        if message.from_user.username
+                        else mention_html(
+                            message.from_user.id,
+                            message.from_user.first_name,
+                        )
+                    ),
+                    mention=mention_html(
+                        message.from_user.id,
+                        message.from_user.first_name,
+                    ),
+                    chatname=(
+                        escape(message.chat.title)
+                        if message.chat.type != "private"
+                        else escape(message.from_user.first_name)
+                    ),
+                    id=message.from_user.id,
+                )
+            else:
+                filtext = ""
+        else:
+            filtext = ""
+
+        if filt.file_type in (sql.Types.BUTTON_TEXT, sql.Types.TEXT):
+            try:
+                context.bot.send_message(
+                    chat.id,
+                    markdown_to_html(filtext),
+                    reply_to_message_id=message.message_id,
+                    parse_mode=ParseMode.HTML,
+                    disable_web_page_preview=True,
+                    reply_markup=keyboard,
+                )
+            except BadRequest as excp:
+                error_catch = get_exception(excp, filt, chat)
+                if error_catch == "noreply":
                     try:
                         context.bot.send_message(
                             chat.id,
                             markdown_to_html(filtext),
-                            reply_to_message_id=message.message_id,
                             parse_mode=ParseMode.HTML,
                             disable_web_page_preview=True,
                             reply_markup=keyboard,
                         )
                     except BadRequest as excp:
-                        error_catch = get_exception(excp, filt, chat)
-                        if error_catch == "noreply":
-                            try:
-                                context.bot.send_message(
-                                    chat.id,
-                                    markdown_to_html(filtext),
-                                    parse_mode=ParseMode.HTML,
-                                    disable_web_page_preview=True,
-                                    reply_markup=keyboard,
-                                )
-                            except BadRequest as excp:
-                                LOGGER.exception(
-                                    "Error in filters: " + excp.message
-                                )
-                                send_message(
-                                    update.effective_message,
-                                    get_exception(excp, filt, chat),
-                                )
-                        else:
-                            try:
-                                send_message(
-                                    update.effective_message,
-                                    get_exception(excp, filt, chat),
-                                )
-                            except BadRequest as excp:
-                                LOGGER.exception(
-                                    "Failed to send message: " + excp.message
-                                )
-                                pass
+                        LOGGER.exception("Error in filters: " + excp.message)
+                        send_message(
+                            update.effective_message,
+                            get_exception(excp, filt, chat),
+                        )
                 else:
-                    if filt.file_type == sql.Types.STICKER:
-                        ENUM_FUNC_MAP[filt.file_type](
-                            chat.id,
-                            filt.file_id,
-                            reply_to_message_id=message.message_id,
+                    try:
+                        send_message(
+                            update.effective_message,
+                            get_exception(excp, filt, chat),
                         )
-
-                    else:
-                        ENUM_FUNC_MAP[filt.file_type](
-                            chat.id,
-                            filt.file_id,
-                            caption=markdown_to_html(filtext),
-                            reply_to_message_id=message.message_id,
-                            parse_mode=ParseMode.HTML,
-                            disable_web_page_preview=True,
-                            reply_markup=keyboard,
+                    except BadRequest as excp:
+                        LOGGER.exception(
+                            "Failed to send message: " + excp.message
                         )
-                break
-            else:
-                if filt.is_sticker:
-                    message.reply_sticker(filt.reply)
-                elif filt.is_document:
-                    message.reply_document(filt.reply)
-                elif filt.is_image:
-                    message.reply_photo(filt.reply)
-                elif filt.is_audio:
-                    message.reply_audio(filt.reply)
-                elif filt.is_voice:
-                    message.reply_voice(filt.reply)
-                elif filt.is_video:
-                    message.reply_video(filt.reply)
-                elif filt.has_markdown:
-                    buttons = sql.get_buttons(chat.id, filt.keyword)
-                    keyb = build_keyboard_parser(context.bot, chat.id, buttons)
-                    keyboard = InlineKeyboardMarkup(keyb)
+                        pass
+        else:
+            if filt.file_type == sql.Types.STICKER:
+                ENUM_FUNC_MAP[filt.file_type](
+                    chat.id,
+                    filt.file_id,
+                    reply_to_message_id=message.message_id,
+                )
 
+            else:
+                ENUM_FUNC_MAP[filt.file_type](
+                    chat.id,
+                    filt.file_id,
+                    caption=markdown_to_html(filtext),
+                    reply_to_message_id=message.message_id,
+                    parse_mode=ParseMode.HTML,
+                    disable_web_page_preview=True,
+                    reply_markup=keyboard,
+                )
+    else:
+        if filt.is_sticker:
+            message.reply_sticker(filt.reply)
+        elif filt.is_document:
+            message.reply_document(filt.reply)
+        elif filt.is_image:
+            message.reply_photo(filt.reply)
+        elif filt.is_audio:
+            message.reply_audio(filt.reply)
+        elif filt.is_voice:
+            message.reply_voice(filt.reply)
+        elif filt.is_video:
+            message.reply_video(filt.reply)
+        elif filt.has_markdown:
+            buttons = sql.get_buttons(chat.id, filt.keyword)
+            keyb = build_keyboard_parser(context.bot, chat.id, buttons)
+            keyboard = InlineKeyboardMarkup(keyb)
+
+            try:
+                send_message(
+                    update.effective_message,
+                    filt.reply,
+                    parse_mode=ParseMode.MARKDOWN,
+                    disable_web_page_preview=True,
+                    reply_markup=keyboard,
+                )
+            except BadRequest as excp:
+                if excp.message == "Unsupported url protocol":
                     try:
                         send_message(
                             update.effective_message,
+                            "You seem to be trying to use an unsupported url protocol. "
+                            "Telegram doesn't support buttons for some protocols, such as tg://. Please try "
+                            "again...",
+                        )
+                    except BadRequest as excp:
+                        LOGGER.exception("Error in filters: " + excp.message)
+                        pass
+                elif excp.message == "Reply message not found":
+                    try:
+                        context.bot.send_message(
+                            chat.id,
                             filt.reply,
                             parse_mode=ParseMode.MARKDOWN,
                             disable_web_page_preview=True,
                             reply_markup=keyboard,
                         )
                     except BadRequest as excp:
-                        if excp.message == "Unsupported url protocol":
-                            try:
-                                send_message(
-                                    update.effective_message,
-                                    "You seem to be trying to use an unsupported url protocol. "
-                                    "Telegram doesn't support buttons for some protocols, such as tg://. Please try "
-                                    "again...",
-                                )
-                            except BadRequest as excp:
-                                LOGGER.exception(
-                                    "Error in filters: " + excp.message
-                                )
-                                pass
-                        elif excp.message == "Reply message not found":
-                            try:
-                                context.bot.send_message(
-                                    chat.id,
-                                    filt.reply,
-                                    parse_mode=ParseMode.MARKDOWN,
-                                    disable_web_page_preview=True,
-                                    reply_markup=keyboard,
-                                )
-                            except BadRequest as excp:
-                                LOGGER.exception(
-                                    "Error in filters: " + excp.message
-                                )
-                                pass
-                        else:
-                            try:
-                                send_message(
-                                    update.effective_message,
-                                    "This message couldn't be sent as it's incorrectly formatted.",
-                                )
-                            except BadRequest as excp:
-                                LOGGER.exception(
-                                    "Error in filters: " + excp.message
-                                )
-                                pass
-                            LOGGER.warning(
-                                "Message %s could not be parsed",
-                                str(filt.reply),
-                            )
-                            LOGGER.exception(
-                                "Could not parse filter %s in chat %s",
-                                str(filt.keyword),
-                                str(chat.id),
-                            )
-
+                        LOGGER.exception("Error in filters: " + excp.message)
+                        pass
                 else:
-                    # LEGACY - all new filters will have has_markdown set to True.
                     try:
-                        send_message(update.effective_message, filt.reply)
+                        send_message(
+                            update.effective_message,
+                            "This message couldn't be sent as it's incorrectly formatted.",
+                        )
                     except BadRequest as excp:
                         LOGGER.exception("Error in filters: " + excp.message)
                         pass
-                break
+                    LOGGER.warning(
+                        "Message %s could not be parsed",
+                        str(filt.reply),
+                    )
+                    LOGGER.exception(
+                        "Could not parse filter %s in chat %s",
+                        str(filt.keyword),
+                        str(chat.id),
+                    )
+
+        else:
+            # LEGACY - all new filters will have has_markdown set to True.
+            try:
+                send_message(update.effective_message, filt.reply)
+            except BadRequest as excp:
+                LOGGER.exception("Error in filters: " + excp.message)
+                pass
 
 
 @user_admin
@@ -6,7 +6,7 @@ from telegram.ext import CommandHandler, MessageHandler
 from telegram.utils.helpers import escape_markdown
 
 from kaguya import dispatcher
-from kaguya.modules.helper_funcs.handlers import CMD_STARTERS
+from kaguya.modules.helper_funcs.handlers import CMD_STARTERS, parse_command
 from kaguya.modules.helper_funcs.misc import is_module_loaded
 from kaguya.modules.helper_funcs.alternate import send_message, typing_action
 from kaguya.modules.connection import connected
@@ -42,47 +42,33 @@ if is_module_loaded(FILENAME):
                     ADMIN_CMDS.extend(command)
 
         def check_update(self, update):
-            if isinstance(update, Update) and update.effective_message:
-                message = update.effective_message
-
-                if message.text and len(message.text) > 1:
-                    fst_word = message.text.split(None, 1)[0]
-                    if len(fst_word) > 1 and any(
-                        fst_word.startswith(start) for start in CMD_STARTERS
-                    ):
-                        args = message.text.split()[1:]
-                        command = fst_word[1:].split("@")
-                        command.append(message.bot.username)
-
-                        if not (
-                            command[0].lower() in self.command
-                            and command[1].lower()
-                            == message.bot.username.lower()
-                        ):
-                            return None
-
-                        filter_result = self.filters(update)
-                        if filter_result:
-                            chat = update.effective_chat
-                            user = update.effective_user
-                            # disabled, admincmd, user admin
-                            if sql.is_command_disabled(
-                                chat.id, command[0].lower()
-                            ):
-                                # check if command was disabled
-                                is_disabled = command[
-                                    0
-                                ] in ADMIN_CMDS and is_user_admin(
-                                    chat, user.id
-                                )
-                                if not is_disabled:
-                                    return None
-                                else:
-                                    return args, filter_result
-
-                            return args, filter_result
-                        else:
-                            return False
+            parsed = parse_command(update)
+            if parsed is None or not any(
+                parsed.word.startswith(start) for start in CMD_STARTERS
+            ):
+                return None
+            if parsed.command not in self.command:
+                return None
+
+            filter_result = self.filters(update)
+            if filter_result:
+                chat = update.effective_chat
+                user = update.effective_user
+                # disabled, admincmd, user admin
+                if sql.is_command_disabled(chat.id, parsed.command):
+                    # check if command was disabled
+                    is_disabled = (
+                        parsed.command in ADMIN_CMDS
+                        and is_user_admin(chat, user.id)
+                    )
+                    if not is_disabled:
+                        return None
+                    else:
+                        return parsed.args, filter_result
+
+                return parsed.args, filter_result
+            else:
+                return False
 
     class DisableAbleMessageHandler(MessageHandler):
         def __init__(
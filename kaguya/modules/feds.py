@@ -1,11 +1,12 @@
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
+from tempfile import SpooledTemporaryFile, TemporaryFile
 from typing import Optional
 import uuid
 import re
 import json
 import time
 import csv
-import os
+import gzip
 
 from telegram.error import BadRequest, TelegramError, Unauthorized
 from telegram import (
@@ -29,6 +30,8 @@ from kaguya import (
     LOGGER,
 )
 from kaguya.modules.helper_funcs.chat_status import is_user_admin
+from kaguya.modules.helper_funcs.fanout import AbortFanout, FanoutEngine
+from kaguya.modules.helper_funcs.join_guard import forget_user
 from kaguya.modules.helper_funcs.extraction import (
     extract_user,
     extract_unt_fedban,
@@ -38,6 +41,7 @@ from kaguya.modules.helper_funcs.string_handling import markdown_parser
 from kaguya.modules.disable import DisableAbleCommandHandler
 
 import kaguya.modules.sql.feds_sql as sql
+import kaguya.modules.sql.fed_jobs_sql as jobs_sql
 
 from kaguya.modules.helper_funcs.alternate import (
     send_message,
@@ -88,6 +92,104 @@ UNFBAN_ERRORS = {
 }
 
 
+def fanout_target(job, target):
+    fedschat, fedsid = target
+    user_id = job["user_id"]
+    try:
+        if job["action"] == "ban":
+            dispatcher.bot.kick_chat_member(fedschat, user_id)
+        else:
+            member = dispatcher.bot.get_chat_member(fedschat, user_id)
+            if member.status == "kicked":
+                dispatcher.bot.unban_chat_member(fedschat, user_id)
+        return True
+    except BadRequest as excp:
+        if job["action"] == "ban":
+            errors = FBAN_ERRORS
+        else:
+            errors = UNFBAN_ERRORS
+        if excp.message in errors:
+            try:
+                dispatcher.bot.getChat(fedschat)
+            except Unauthorized:
+                if fedsid == job["fed_id"]:
+                    sql.chat_leave_fed(fedschat)
+                    LOGGER.info(
+                        "Chat {} has leave fed {} because I was kicked".format(
+                            fedschat, fedsid
+                        )
+                    )
+                else:
+                    sql.unsubs_fed(job["fed_id"], fedsid)
+                    LOGGER.info(
+                        "Chat {} has unsub fed {} because I was kicked".format(
+                            fedschat, fedsid
+                        )
+                    )
+            except BadRequest:
+                pass
+        elif excp.message == "User_id_invalid":
+            raise AbortFanout
+        else:
+            LOGGER.warning(
+                "Could not f{} on {} because: {}".format(
+                    job["action"], fedschat, excp.message
+                )
+            )
+    except Unauthorized:
+        pass
+    return False
+
+
+def fanout_progress(job):
+    jobs_sql.set_progress(job["job_id"], job["progress"], job["affected"])
+
+
+def fanout_done(job):
+    jobs_sql.finish_job(job["job_id"])
+    info = sql.get_fed_info(job["fed_id"])
+    if not info:
+        return
+    text = (
+        "<b>{}</b>"
+        "\n<b>Federation:</b> {}"
+        "\n<b>User ID:</b> <code>{}</code>"
+        "\n<b>Affected chats:</b> {}/{}".format(
+            "FedBan done" if job["action"] == "ban" else "Un-FedBan done",
+            info["fname"],
+            job["user_id"],
+            job["affected"],
+            len(job["targets"]),
+        )
+    )
+    report_to = {job["origin_chat"]}
+    get_fedlog = sql.get_fed_log(job["fed_id"])
+    if get_fedlog:
+        report_to.add(str(get_fedlog))
+    for chat_id in report_to:
+        try:
+            dispatcher.bot.send_message(chat_id, text, parse_mode="HTML")
+        except TelegramError:
+            pass
+
+
+FANOUT = FanoutEngine(fanout_target, fanout_progress, fanout_done)
+
+
+def fanout_fban(fed_id, user_id, action, origin_chat):
+    """
+    Queue a fed ban ("ban") or unban ("unban") of user_id in every chat of
+    the fed and its subscribers; the result is reported when it is done.
+
+    :return: number of chats the job will go through
+    """
+    forget_user(user_id)
+    targets = sql.get_fed_targets(fed_id)
+    job = jobs_sql.add_job(fed_id, user_id, action, origin_chat, targets)
+    FANOUT.submit(job)
+    return len(targets)
+
+
 @typing_action
 def new_fed(update, context):
     chat = update.effective_chat  # type: Optional[Chat]
@@ -366,7 +468,7 @@ def user_join_fed(update, context):
         getuser = sql.search_user_in_fed(fed_id, user_id)
         fed_id = sql.get_fed_id(chat.id)
         info = sql.get_fed_info(fed_id)
-        get_owner = eval(info["fusers"])["owner"]
+        get_owner = info["owner"]
         get_owner = context.bot.get_chat(get_owner).id
         if user_id == get_owner:
             update.effective_message.reply_text(
@@ -498,8 +600,9 @@ def fed_info(update, context):
     text += "\nName: {}".format(info["fname"])
     text += "\nCreator: {}".format(mention_html(owner.id, owner_name))
     text += "\nAll Admins: <code>{}</code>".format(TotalAdminFed)
-    getfban = sql.get_all_fban_users(fed_id)
-    text += "\nTotal banned users: <code>{}</code>".format(len(getfban))
+    text += "\nTotal banned users: <code>{}</code>".format(
+        sql.get_fban_count(fed_id)
+    )
     getfchat = sql.all_fed_chats(fed_id)
     text += "\nNumber of groups in this federation: <code>{}</code>".format(
         len(getfchat)
@@ -679,7 +782,6 @@ def fed_ban(update, context):
             message.reply_text("Failed to ban from the federation!")
             return
 
-        fed_chats = sql.all_fed_chats(fed_id)
         # Will send to current chat
         context.bot.send_message(
             chat.id,
@@ -735,82 +837,7 @@ def fed_ban(update, context):
                     ),
                     parse_mode="HTML",
                 )
-        for fedschat in fed_chats:
-            try:
-                # Do not spam all fed chats
-                """
-				context.bot.send_message(chat, "<b>FedBan reason updated</b>" \
-							 "\n<b>Federation:</b> {}" \
-							 "\n<b>Federation Admin:</b> {}" \
-							 "\n<b>User:</b> {}" \
-							 "\n<b>User ID:</b> <code>{}</code>" \
-							 "\n<b>Reason:</b> {}".format(fed_name, mention_html(user.id, user.first_name), user_target, fban_user_id, reason), parse_mode="HTML")
-				"""
-                context.bot.kick_chat_member(fedschat, fban_user_id)
-            except BadRequest as excp:
-                if excp.message in FBAN_ERRORS:
-                    try:
-                        dispatcher.bot.getChat(fedschat)
-                    except Unauthorized:
-                        sql.chat_leave_fed(fedschat)
-                        LOGGER.info(
-                            "Chat {} has leave fed {} because I was kicked".format(
-                                fedschat, info["fname"]
-                            )
-                        )
-                        continue
-                elif excp.message == "User_id_invalid":
-                    break
-                else:
-                    LOGGER.warning(
-                        "Could not fban on {} because: {}".format(
-                            chat, excp.message
-                        )
-                    )
-            except TelegramError:
-                pass
-        # Also do not spam all fed admins
-
-        # send_to_list(bot, FEDADMIN,
-        # "<b>FedBan reason updated</b>" \
-        # "\n<b>Federation:</b> {}" \
-        # "\n<b>Federation Admin:</b> {}" \
-        # "\n<b>User:</b> {}" \
-        # "\n<b>User ID:</b> <code>{}</code>" \
-        # "\n<b>Reason:</b> {}".format(fed_name, mention_html(user.id, user.first_name), user_target, fban_user_id, reason),
-        # html=True)
-
-        # Fban for fed subscriber
-        subscriber = list(sql.get_subscriber(fed_id))
-        if len(subscriber) != 0:
-            for fedsid in subscriber:
-                all_fedschat = sql.all_fed_chats(fedsid)
-                for fedschat in all_fedschat:
-                    try:
-                        context.bot.kick_chat_member(fedschat, fban_user_id)
-                    except BadRequest as excp:
-                        if excp.message in FBAN_ERRORS:
-                            try:
-                                dispatcher.bot.getChat(fedschat)
-                            except Unauthorized:
-                                targetfed_id = sql.get_fed_id(fedschat)
-                                sql.unsubs_fed(fed_id, targetfed_id)
-                                LOGGER.info(
-                                    "Chat {} has unsub fed {} because I was kicked".format(
-                                        fedschat, info["fname"]
-                                    )
-                                )
-                                continue
-                        elif excp.message == "User_id_invalid":
-                            break
-                        else:
-                            LOGGER.warning(
-                                "Unable to fban on {} because: {}".format(
-                                    fedschat, excp.message
-                                )
-                            )
-                    except TelegramError:
-                        pass
+        fanout_fban(fed_id, fban_user_id, "ban", chat.id)
         # send_message(update.effective_message, "Fedban Reason has been updated.")
         return
 
@@ -839,7 +866,6 @@ def fed_ban(update, context):
         message.reply_text("Failed to ban from the federation!")
         return
 
-    fed_chats = sql.all_fed_chats(fed_id)
     # Will send to current chat
     context.bot.send_message(
         chat.id,
@@ -895,84 +921,12 @@ def fed_ban(update, context):
                 ),
                 parse_mode="HTML",
             )
-    chats_in_fed = 0
-    for fedschat in fed_chats:
-        chats_in_fed += 1
-        try:
-            # Do not spamming all fed chats
-            """
-			context.bot.send_message(chat, "<b>FedBan reason updated</b>" \
-							"\n<b>Federation:</b> {}" \
-							"\n<b>Federation Admin:</b> {}" \
-							"\n<b>User:</b> {}" \
-							"\n<b>User ID:</b> <code>{}</code>" \
-							"\n<b>Reason:</b> {}".format(fed_name, mention_html(user.id, user.first_name), user_target, fban_user_id, reason), parse_mode="HTML")
-			"""
-            context.bot.kick_chat_member(fedschat, fban_user_id)
-        except BadRequest as excp:
-            if excp.message in FBAN_ERRORS:
-                pass
-            elif excp.message == "User_id_invalid":
-                break
-            else:
-                LOGGER.warning(
-                    "Could not fban on {} because: {}".format(
-                        chat, excp.message
-                    )
-                )
-        except TelegramError:
-            pass
-
-        # Also do not spamming all fed admins
-        """
-		send_to_list(bot, FEDADMIN,
-				 "<b>FedBan reason updated</b>" \
-							 "\n<b>Federation:</b> {}" \
-							 "\n<b>Federation Admin:</b> {}" \
-							 "\n<b>User:</b> {}" \
-							 "\n<b>User ID:</b> <code>{}</code>" \
-							 "\n<b>Reason:</b> {}".format(fed_name, mention_html(user.id, user.first_name), user_target, fban_user_id, reason),
-							html=True)
-		"""
-
-        # Fban for fed subscriber
-        subscriber = list(sql.get_subscriber(fed_id))
-        if len(subscriber) != 0:
-            for fedsid in subscriber:
-                all_fedschat = sql.all_fed_chats(fedsid)
-                for fedschat in all_fedschat:
-                    try:
-                        context.bot.kick_chat_member(fedschat, fban_user_id)
-                    except BadRequest as excp:
-                        if excp.message in FBAN_ERRORS:
-                            try:
-                                dispatcher.bot.getChat(fedschat)
-                            except Unauthorized:
-                                targetfed_id = sql.get_fed_id(fedschat)
-                                sql.unsubs_fed(fed_id, targetfed_id)
-                                LOGGER.info(
-                                    "Chat {} has unsub fed {} because I was kicked".format(
-                                        fedschat, info["fname"]
-                                    )
-                                )
-                                continue
-                        elif excp.message == "User_id_invalid":
-                            break
-                        else:
-                            LOGGER.warning(
-                                "Unable to fban on {} because: {}".format(
-                                    fedschat, excp.message
-                                )
-                            )
-                    except TelegramError:
-                        pass
-    if chats_in_fed == 0:
-        send_message(update.effective_message, "Fedban affected 0 chats. ")
-    elif chats_in_fed > 0:
-        send_message(
-            update.effective_message,
-            "Fedban affected {} chats. ".format(chats_in_fed),
-        )
+    chats_in_fed = fanout_fban(fed_id, fban_user_id, "ban", chat.id)
+    send_message(
+        update.effective_message,
+        "Fedban is being applied in {} chats, I will report back when it is"
+        " done.".format(chats_in_fed),
+    )
 
 
 @typing_action
@@ -1051,7 +1005,6 @@ def unfban(update, context):
         )
     )
 
-    chat_list = sql.all_fed_chats(fed_id)
     # Will send to current chat
     context.bot.send_message(
         chat.id,
@@ -1101,35 +1054,6 @@ def unfban(update, context):
                 ),
                 parse_mode="HTML",
             )
-    unfbanned_in_chats = 0
-    for fedchats in chat_list:
-        unfbanned_in_chats += 1
-        try:
-            member = context.bot.get_chat_member(fedchats, user_id)
-            if member.status == "kicked":
-                context.bot.unban_chat_member(fedchats, user_id)
-            # Do not spamming all fed chats
-            """
-			context.bot.send_message(chat, "<b>Un-FedBan</b>" \
-						 "\n<b>Federation:</b> {}" \
-						 "\n<b>Federation Admin:</b> {}" \
-						 "\n<b>User:</b> {}" \
-						 "\n<b>User ID:</b> <code>{}</code>".format(info['fname'], mention_html(user.id, user.first_name), user_target, fban_user_id), parse_mode="HTML")
-			"""
-        except BadRequest as excp:
-            if excp.message in UNFBAN_ERRORS:
-                pass
-            elif excp.message == "User_id_invalid":
-                break
-            else:
-                LOGGER.warning(
-                    "Could not fban on {} because: {}".format(
-                        chat, excp.message
-                    )
-                )
-        except TelegramError:
-            pass
-
     try:
         x = sql.un_fban_user(fed_id, user_id)
         if not x:
@@ -1141,50 +1065,12 @@ def unfban(update, context):
     except Exception:
         pass
 
-    # UnFban for fed subscriber
-    subscriber = list(sql.get_subscriber(fed_id))
-    if len(subscriber) != 0:
-        for fedsid in subscriber:
-            all_fedschat = sql.all_fed_chats(fedsid)
-            for fedschat in all_fedschat:
-                try:
-                    context.bot.unban_chat_member(fedchats, user_id)
-                except BadRequest as excp:
-                    if excp.message in FBAN_ERRORS:
-                        try:
-                            dispatcher.bot.getChat(fedschat)
-                        except Unauthorized:
-                            targetfed_id = sql.get_fed_id(fedschat)
-                            sql.unsubs_fed(fed_id, targetfed_id)
-                            LOGGER.info(
-                                "Chat {} has unsub fed {} because I was kicked".format(
-                                    fedschat, info["fname"]
-                                )
-                            )
-                            continue
-                    elif excp.message == "User_id_invalid":
-                        break
-                    else:
-                        LOGGER.warning(
-                            "Unable to fban on {} because: {}".format(
-                                fedschat, excp.message
-                            )
-                        )
-                except TelegramError:
-                    pass
-
-    if unfbanned_in_chats == 0:
-        send_message(
-            update.effective_message,
-            "This person has been un-fbanned in 0 chats.",
-        )
-    if unfbanned_in_chats > 0:
-        send_message(
-            update.effective_message,
-            "This person has been un-fbanned in {} chats.".format(
-                unfbanned_in_chats
-            ),
-        )
+    unfbanned_in_chats = fanout_fban(fed_id, user_id, "unban", chat.id)
+    send_message(
+        update.effective_message,
+        "This person is being un-fbanned in {} chats, I will report back"
+        " when it is done.".format(unfbanned_in_chats),
+    )
     # Also do not spamming all fed admins
     """
 	FEDADMIN = sql.all_fed_users(fed_id)
@@ -1364,6 +1250,73 @@ def fed_broadcast(update, context):
         update.effective_message.reply_text(send_text)
 
 
+# keep every file well under the 50MB bot api upload limit
+EXPORT_PART_SIZE = 45 * 1024 * 1024
+# parts bigger than this are spooled to disk instead of memory
+EXPORT_SPOOL_SIZE = 1024 * 1024
+
+
+def export_fbans(fed_id, fileformat, compress=False):
+    """
+    Write a fed's ban list as json lines or csv, straight from the db.
+
+    :param fed_id: fed to export
+    :param fileformat: "json" or "csv"
+    :param compress: gzip the output
+    :return: generator of (file, row count) parts, each file rewound and
+        smaller than EXPORT_PART_SIZE, closed once the next part is asked for
+    """
+    output = None
+    for row in sql.iter_fban_rows(fed_id):
+        user_id, first_name, last_name, user_name, reason = row
+        if output is None:
+            output = SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+            if compress:
+                stream = gzip.GzipFile(fileobj=output, mode="wb")
+            else:
+                stream = output
+            text = TextIOWrapper(stream, encoding="utf8", newline="")
+            writer = csv.writer(text)
+            if fileformat == "csv":
+                writer.writerow(
+                    ["id", "firstname", "lastname", "username", "reason"]
+                )
+            rows = 0
+
+        if fileformat == "json":
+            json_parser = {
+                "user_id": int(user_id),
+                "first_name": first_name,
+                "last_name": last_name,
+                "user_name": user_name,
+                "reason": reason,
+            }
+            text.write(json.dumps(json_parser))
+            text.write("\n")
+        else:
+            writer.writerow(
+                [user_id, first_name, last_name, user_name, reason]
+            )
+        rows += 1
+
+        if output.tell() >= EXPORT_PART_SIZE:
+            yield finish_export_part(output, stream, text), rows
+            output = None
+
+    if output is not None:
+        yield finish_export_part(output, stream, text), rows
+
+
+def finish_export_part(output, stream, text):
+    text.flush()
+    text.detach()
+    if stream is not output:
+        # writes the gzip trailer, leaves output open
+        stream.close()
+    output.seek(0)
+    return output
+
+
 @send_action(ChatAction.UPLOAD_DOCUMENT)
 def fed_ban_list(update, context):
     chat = update.effective_chat  # type: Optional[Chat]
@@ -1395,8 +1348,8 @@ def fed_ban_list(update, context):
 
     user = update.effective_user  # type: Optional[Chat]
     chat = update.effective_chat  # type: Optional[Chat]
-    getfban = sql.get_all_fban_users(fed_id)
-    if len(getfban) == 0:
+    fban_count = sql.get_fban_count(fed_id)
+    if fban_count == 0:
         update.effective_message.reply_text(
             "The federation ban list of {} is empty".format(info["fname"]),
             parse_mode=ParseMode.HTML,
@@ -1404,144 +1357,86 @@ def fed_ban_list(update, context):
         return
 
     if args:
-        if args[0] == "json":
-            jam = time.time()
-            new_jam = jam + 1800
-            cek = get_chat(chat.id, chat_data)
-            if cek.get("status"):
-                if jam <= int(cek.get("value")):
-                    waktu = time.strftime(
-                        "%H:%M:%S %d/%m/%Y", time.localtime(cek.get("value"))
-                    )
-                    update.effective_message.reply_text(
-                        "You can backup your data once every 30 minutes!\nYou can back up data again at `{}`".format(
-                            waktu
-                        ),
-                        parse_mode=ParseMode.MARKDOWN,
-                    )
-                    return
-                else:
-                    if user.id not in SUDO_USERS:
-                        put_chat(chat.id, new_jam, chat_data)
-            else:
-                if user.id not in SUDO_USERS:
-                    put_chat(chat.id, new_jam, chat_data)
-            backups = ""
-            for users in getfban:
-                getuserinfo = sql.get_all_fban_users_target(fed_id, users)
-                json_parser = {
-                    "user_id": users,
-                    "first_name": getuserinfo["first_name"],
-                    "last_name": getuserinfo["last_name"],
-                    "user_name": getuserinfo["user_name"],
-                    "reason": getuserinfo["reason"],
-                }
-                backups += json.dumps(json_parser)
-                backups += "\n"
-            with BytesIO(str.encode(backups)) as output:
-                output.name = "perry_fbanned_users.json"
-                update.effective_message.reply_document(
-                    document=output,
-                    filename="perry_fbanned_users.json",
-                    caption="Total {} User are blocked by the Federation {}.".format(
-                        len(getfban), info["fname"]
-                    ),
-                )
-            return
-        elif args[0] == "csv":
-            jam = time.time()
-            new_jam = jam + 1800
-            cek = get_chat(chat.id, chat_data)
-            if cek.get("status"):
-                if jam <= int(cek.get("value")):
-                    waktu = time.strftime(
-                        "%H:%M:%S %d/%m/%Y", time.localtime(cek.get("value"))
-                    )
-                    update.effective_message.reply_text(
-                        "You can back up data once every 30 minutes!\nYou can back up data again at `{}`".format(
-                            waktu
-                        ),
-                        parse_mode=ParseMode.MARKDOWN,
-                    )
-                    return
-                else:
-                    if user.id not in SUDO_USERS:
-                        put_chat(chat.id, new_jam, chat_data)
-            else:
-                if user.id not in SUDO_USERS:
-                    put_chat(chat.id, new_jam, chat_data)
-            backups = "id,firstname,lastname,username,reason\n"
-            for users in getfban:
-                getuserinfo = sql.get_all_fban_users_target(fed_id, users)
-                backups += "{user_id},{first_name},{last_name},{user_name},{reason}".format(
-                    user_id=users,
-                    first_name=getuserinfo["first_name"],
-                    last_name=getuserinfo["last_name"],
-                    user_name=getuserinfo["user_name"],
-                    reason=getuserinfo["reason"],
-                )
-                backups += "\n"
-            with BytesIO(str.encode(backups)) as output:
-                output.name = "perry_fbanned_users.csv"
-                update.effective_message.reply_document(
-                    document=output,
-                    filename="perry_fbanned_users.csv",
-                    caption="Total {} User are blocked by Federation {}.".format(
-                        len(getfban), info["fname"]
-                    ),
-                )
+        fileformat, _, compress = args[0].lower().partition(".")
+        compress = compress in ("gz", "gzip") or (
+            len(args) > 1 and args[1].lower() in ("gz", "gzip")
+        )
+        if fileformat in ("json", "csv"):
+            if backup_allowed(update, chat_data):
+                send_fban_export(update, fed_id, info, fileformat, compress)
             return
 
-    text = "<b>{} users have been banned from the federation {}:</b>\n".format(
-        len(getfban), info["fname"]
-    )
-    for users in getfban:
-        getuserinfo = sql.get_all_fban_users_target(fed_id, users)
-        if getuserinfo == False:
-            text = "There are no users banned from the federation {}".format(
-                info["fname"]
-            )
-            break
-        user_name = getuserinfo["first_name"]
-        if getuserinfo["last_name"]:
-            user_name += " " + getuserinfo["last_name"]
-        text += " • {} (<code>{}</code>)\n".format(
-            mention_html(users, user_name), users
+    if fban_count <= FBANLIST_MESSAGE_ROWS:
+        text = "<b>{} users have been banned from the federation {}:</b>\n".format(
+            fban_count, info["fname"]
         )
+        for users, first_name, last_name, _, _ in sql.iter_fban_rows(fed_id):
+            user_name = first_name or ""
+            if last_name:
+                user_name += " " + last_name
+            text += " • {} (<code>{}</code>)\n".format(
+                mention_html(users, user_name), users
+            )
 
-    try:
-        update.effective_message.reply_text(text, parse_mode=ParseMode.HTML)
-    except:
-        jam = time.time()
-        new_jam = jam + 1800
-        cek = get_chat(chat.id, chat_data)
-        if cek.get("status"):
-            if jam <= int(cek.get("value")):
-                waktu = time.strftime(
-                    "%H:%M:%S %d/%m/%Y", time.localtime(cek.get("value"))
-                )
-                update.effective_message.reply_text(
-                    "You can back up data once every 30 minutes!\nYou can back up data again at `{}`".format(
-                        waktu
-                    ),
-                    parse_mode=ParseMode.MARKDOWN,
-                )
-                return
+        try:
+            update.effective_message.reply_text(
+                text, parse_mode=ParseMode.HTML
+            )
+            return
+        except BadRequest:
+            pass
+
+    # too long for a message, streamed from the db instead of building it
+    if backup_allowed(update, chat_data):
+        send_fban_export(update, fed_id, info, "csv")
+
+
+# lists longer than this don't fit in one message and are sent as a file
+FBANLIST_MESSAGE_ROWS = 50
+
+
+def backup_allowed(update, chat_data):
+    """
+    Whether the chat may export its fed's bans now, once every 30 minutes
+    except for sudo users; replies with when it may again if not.
+    """
+    chat = update.effective_chat
+    user = update.effective_user
+    jam = time.time()
+    new_jam = jam + 1800
+    cek = get_chat(chat.id, chat_data)
+    if cek.get("status") and jam <= int(cek.get("value")):
+        waktu = time.strftime(
+            "%H:%M:%S %d/%m/%Y", time.localtime(cek.get("value"))
+        )
+        update.effective_message.reply_text(
+            "You can backup your data once every 30 minutes!\nYou can back up data again at `{}`".format(
+                waktu
+            ),
+            parse_mode=ParseMode.MARKDOWN,
+        )
+        return False
+    if user.id not in SUDO_USERS:
+        put_chat(chat.id, new_jam, chat_data)
+    return True
+
+
+def send_fban_export(update, fed_id, info, fileformat, compress=False):
+    filename = "perry_fbanned_users.{}".format(fileformat)
+    if compress:
+        filename += ".gz"
+    parts = export_fbans(fed_id, fileformat, compress)
+    for part, (output, rows) in enumerate(parts, start=1):
+        with output:
+            if part > 1:
+                name = filename.replace(".", "_part{}.".format(part), 1)
             else:
-                if user.id not in SUDO_USERS:
-                    put_chat(chat.id, new_jam, chat_data)
-        else:
-            if user.id not in SUDO_USERS:
-                put_chat(chat.id, new_jam, chat_data)
-        cleanr = re.compile("<.*?>")
-        cleantext = re.sub(cleanr, "", text)
-        with BytesIO(str.encode(cleantext)) as output:
-            output.name = "fbanlist.txt"
+                name = filename
             update.effective_message.reply_document(
                 document=output,
-                filename="fbanlist.txt",
-                caption="The following is a list of users who are currently fbanned in the Federation {}.".format(
-                    info["fname"]
+                filename=name,
+                caption="Total {} User are blocked by the Federation {}.".format(
+                    rows, info["fname"]
                 ),
             )
 
@@ -1651,6 +1546,68 @@ def fed_chats(update, context):
             )
 
 
+IMPORT_CHUNK = 1000
+
+
+def fban_import_name(name):
+    # exports write a missing last name / username as None
+    if name in (None, "", "None"):
+        return None
+    return str(name)
+
+
+def iter_fban_import(file, fileformat):
+    """
+    Read a /fbanlist json or csv export one line at a time.
+
+    :param file: binary file object positioned at the start of the export
+    :param fileformat: "json" (one object per line) or "csv"
+    :return: generator of ban dicts, with None for rows that can't be read
+    """
+    lines = TextIOWrapper(file, encoding="utf8", errors="replace", newline="")
+    if fileformat == "json":
+        rows = (line for line in lines if line.strip())
+        keys = ("user_id", "first_name", "last_name", "user_name", "reason")
+    else:
+        rows = (data for data in csv.reader(lines) if data)
+        keys = (0, 1, 2, 3, 4)
+
+    for data in rows:
+        try:
+            if fileformat == "json":
+                data = json.loads(data)
+            user_id = int(data[keys[0]])  # Make sure it int
+        except (ValueError, KeyError, IndexError, TypeError):
+            # the csv export starts with a header row
+            if data != ["id", "firstname", "lastname", "username", "reason"]:
+                yield None
+            continue
+        try:
+            yield {
+                "user_id": user_id,
+                "first_name": fban_import_name(data[keys[1]])
+                or "user({})".format(user_id),
+                "last_name": fban_import_name(data[keys[2]]),
+                "user_name": fban_import_name(data[keys[3]]),
+                "reason": str(data[keys[4]] or ""),
+                "time": 0,
+            }
+        except (KeyError, IndexError):
+            yield None
+
+
+def import_fban_chunk(fed_id, chunk):
+    if not chunk:
+        return 0
+    written = sql.bulk_fban_users(fed_id, chunk)
+    if written is False:
+        LOGGER.warning(
+            "Failed to import {} fbans into {}".format(len(chunk), fed_id)
+        )
+        return 0
+    return written
+
+
 @typing_action
 def fed_import_bans(update, context):
     chat = update.effective_chat  # type: Optional[Chat]
@@ -1717,177 +1674,59 @@ def fed_import_bans(update, context):
                 "Try downloading and re-uploading the file, this one seems broken!"
             )
             return
-        fileformat = msg.reply_to_message.document.file_name.split(".")[-1]
-        if fileformat == "json":
-            multi_fed_id = []
-            multi_import_userid = []
-            multi_import_firstname = []
-            multi_import_lastname = []
-            multi_import_username = []
-            multi_import_reason = []
-            with BytesIO() as file:
-                file_info.download(out=file)
-                file.seek(0)
-                reading = file.read().decode("UTF-8")
-                splitting = reading.split("\n")
-                for x in splitting:
-                    if x == "":
-                        continue
-                    try:
-                        data = json.loads(x)
-                    except json.decoder.JSONDecodeError:
-                        failed += 1
-                        continue
-                    try:
-                        import_userid = int(
-                            data["user_id"]
-                        )  # Make sure it int
-                        import_firstname = str(data["first_name"])
-                        import_lastname = str(data["last_name"])
-                        import_username = str(data["user_name"])
-                        import_reason = str(data["reason"])
-                    except ValueError:
-                        failed += 1
-                        continue
-                    # Checking user
-                    if int(import_userid) == context.bot.id:
-                        failed += 1
-                        continue
-                    if is_user_fed_owner(fed_id, import_userid) == True:
-                        failed += 1
-                        continue
-                    if is_user_fed_admin(fed_id, import_userid) == True:
-                        failed += 1
-                        continue
-                    if str(import_userid) == str(OWNER_ID):
-                        failed += 1
-                        continue
-                    if int(import_userid) in SUDO_USERS:
-                        failed += 1
-                        continue
-                    if int(import_userid) in WHITELIST_USERS:
-                        failed += 1
-                        continue
-                    multi_fed_id.append(fed_id)
-                    multi_import_userid.append(str(import_userid))
-                    multi_import_firstname.append(import_firstname)
-                    multi_import_lastname.append(import_lastname)
-                    multi_import_username.append(import_username)
-                    multi_import_reason.append(import_reason)
-                    success += 1
-                sql.multi_fban_user(
-                    multi_fed_id,
-                    multi_import_userid,
-                    multi_import_firstname,
-                    multi_import_lastname,
-                    multi_import_username,
-                    multi_import_reason,
-                )
-            text = "Blocks were successfully imported. {} people are blocked.".format(
-                success
-            )
-            if failed >= 1:
-                text += " {} Failed to import.".format(failed)
-            get_fedlog = sql.get_fed_log(fed_id)
-            if get_fedlog:
-                if eval(get_fedlog):
-                    teks = "Fed *{}* has successfully imported data. {} banned.".format(
-                        getfed["fname"], success
-                    )
-                    if failed >= 1:
-                        teks += " {} Failed to import.".format(failed)
-                    context.bot.send_message(
-                        get_fedlog, teks, parse_mode="markdown"
-                    )
-        elif fileformat == "csv":
-            multi_fed_id = []
-            multi_import_userid = []
-            multi_import_firstname = []
-            multi_import_lastname = []
-            multi_import_username = []
-            multi_import_reason = []
-            file_info.download(
-                "fban_{}.csv".format(msg.reply_to_message.document.file_id)
-            )
-            with open(
-                "fban_{}.csv".format(msg.reply_to_message.document.file_id),
-                "r",
-                encoding="utf8",
-            ) as csvFile:
-                reader = csv.reader(csvFile)
-                for data in reader:
-                    try:
-                        import_userid = int(data[0])  # Make sure it int
-                        import_firstname = str(data[1])
-                        import_lastname = str(data[2])
-                        import_username = str(data[3])
-                        import_reason = str(data[4])
-                    except ValueError:
-                        failed += 1
-                        continue
-                    # Checking user
-                    if int(import_userid) == context.bot.id:
-                        failed += 1
-                        continue
-                    if is_user_fed_owner(fed_id, import_userid) == True:
-                        failed += 1
-                        continue
-                    if is_user_fed_admin(fed_id, import_userid) == True:
-                        failed += 1
-                        continue
-                    if str(import_userid) == str(OWNER_ID):
-                        failed += 1
-                        continue
-                    if int(import_userid) in SUDO_USERS:
-                        failed += 1
-                        continue
-                    if int(import_userid) in WHITELIST_USERS:
-                        failed += 1
-                        continue
-                    multi_fed_id.append(fed_id)
-                    multi_import_userid.append(str(import_userid))
-                    multi_import_firstname.append(import_firstname)
-                    multi_import_lastname.append(import_lastname)
-                    multi_import_username.append(import_username)
-                    multi_import_reason.append(import_reason)
-                    success += 1
-                    # t = ThreadWithReturnValue(target=sql.fban_user, args=(fed_id, str(import_userid), import_firstname, import_lastname, import_username, import_reason,))
-                    # t.start()
-                sql.multi_fban_user(
-                    multi_fed_id,
-                    multi_import_userid,
-                    multi_import_firstname,
-                    multi_import_lastname,
-                    multi_import_username,
-                    multi_import_reason,
-                )
-            csvFile.close()
-            os.remove(
-                "fban_{}.csv".format(msg.reply_to_message.document.file_id)
-            )
-            text = (
-                "Files were imported successfully. {} people banned.".format(
-                    success
-                )
-            )
-            if failed >= 1:
-                text += " {} Failed to import.".format(failed)
-            get_fedlog = sql.get_fed_log(fed_id)
-            if get_fedlog:
-                if eval(get_fedlog):
-                    teks = "Fed *{}* has successfully imported data. {} banned.".format(
-                        getfed["fname"], success
-                    )
-                    if failed >= 1:
-                        teks += " {} Failed to import.".format(failed)
-                    context.bot.send_message(
-                        get_fedlog, teks, parse_mode="markdown"
-                    )
-        else:
+        fileformat = msg.reply_to_message.document.file_name.split(".")
+        compressed = fileformat[-1] == "gz"
+        if compressed:
+            fileformat.pop()
+        fileformat = fileformat[-1]
+        if fileformat not in ("json", "csv"):
             send_message(
                 update.effective_message, "This file is not supported."
             )
             return
+
+        # nobody that can't be fbanned by hand gets in through an import
+        protected = set(sql.all_fed_users(fed_id))
+        protected.update(SUDO_USERS, WHITELIST_USERS)
+        protected.update((OWNER_ID, context.bot.id))
+
+        started = time.time()
+        with TemporaryFile() as file:
+            file_info.download(out=file)
+            file.seek(0)
+            if compressed:
+                file = gzip.GzipFile(fileobj=file, mode="rb")
+            chunk = []
+            for row in iter_fban_import(file, fileformat):
+                if row is None or row["user_id"] in protected:
+                    failed += 1
+                    continue
+                chunk.append(row)
+                if len(chunk) >= IMPORT_CHUNK:
+                    success += import_fban_chunk(fed_id, chunk)
+                    chunk = []
+            success += import_fban_chunk(fed_id, chunk)
+        took = max(time.time() - started, 0.001)
+
+        text = "Files were imported successfully. {} people banned.".format(
+            success
+        )
+        if failed >= 1:
+            text += " {} Failed to import.".format(failed)
+        text += " ({:.1f}s, {:.0f} rows/s)".format(
+            took, (success + failed) / took
+        )
+        get_fedlog = sql.get_fed_log(fed_id)
+        if get_fedlog:
+            if eval(get_fedlog):
+                teks = "Fed *{}* has successfully imported data. {} banned.".format(
+                    getfed["fname"], success
+                )
+                if failed >= 1:
+                    teks += " {} Failed to import.".format(failed)
+                context.bot.send_message(
+                    get_fedlog, teks, parse_mode="markdown"
+                )
         send_message(update.effective_message, text)
 
 
@@ -2314,24 +2153,18 @@ def get_myfeds_list(update, context):
 
 
 def is_user_fed_admin(fed_id, user_id):
-    fed_admins = sql.all_fed_users(fed_id)
-    if fed_admins == False:
+    if not sql.get_fed_info(fed_id):
         return False
-    if int(user_id) in fed_admins or int(user_id) == OWNER_ID:
+    if sql.is_user_fed_admin(fed_id, user_id) or int(user_id) == OWNER_ID:
         return True
     else:
         return False
 
 
 def is_user_fed_owner(fed_id, user_id):
-    getsql = sql.get_fed_info(fed_id)
-    if getsql == False:
-        return False
-    getfedowner = eval(getsql["fusers"])
-    if getfedowner == None or getfedowner == False:
+    if not sql.get_fed_info(fed_id):
         return False
-    getfedowner = getfedowner["owner"]
-    if str(user_id) == getfedowner or int(user_id) == OWNER_ID:
+    if sql.is_user_fed_owner(fed_id, user_id) or int(user_id) == OWNER_ID:
         return True
     else:
         return False
@@ -2354,10 +2187,9 @@ def welcome_fed(update, context):
 
 
 def __stats__():
-    all_fbanned = sql.get_all_fban_users_global()
     all_feds = sql.get_all_feds_users_global()
     return "× {} users banned, in {} federations".format(
-        len(all_fbanned), len(all_feds)
+        sql.num_fbanned_users(), len(all_feds)
     )
 
 
@@ -2430,10 +2262,10 @@ You can even designate admin federations, so your trusted admin can ban all the
  × /frules: See Federation regulations.
  × /chatfed: See the Federation in the current chat.
  × /fedadmins: Show Federation admin.
- × /fbanlist: Displays all users who are victimized at the Federation at this time.
+ × /fbanlist <json/csv> [gz]: Displays all users who are victimized at the Federation at this time, or sends them as a json/csv (optionally gzipped) file.
  × /fednotif <on / off>: Federation settings not in PM when there are users who are fban / unfban.
  × /fedchats: Get all the chats that are connected in the Federation.
- × /importfbans: Reply to the Federation backup message file to import the banned list to the Federation now.
+ × /importfbans: Reply to the Federation backup message file (json/csv, optionally gzipped) to import the banned list to the Federation now.
 """
 
 
@@ -2508,3 +2340,8 @@ dispatcher.add_handler(DELETEBTN_FED_HANDLER)
 dispatcher.add_handler(MY_FEDS_LIST)
 
 dispatcher.add_handler(DELETEBTN_FED_HANDLER)
+
+# pick up fan-out jobs a restart interrupted
+for job in jobs_sql.get_pending_jobs():
+    FANOUT.submit(job)
+FANOUT.start()
@@ -16,7 +16,21 @@ from kaguya import (
     MESSAGE_DUMP,
     spamwtc,
 )
-from kaguya.modules.helper_funcs.chat_status import user_admin, is_user_admin
+from kaguya.modules.helper_funcs.spamwatch_mirror import (
+    SW_SYNC_INTERVAL,
+    sync_spamwatch,
+)
+from kaguya.modules.helper_funcs.chat_status import (
+    user_admin,
+    is_user_admin,
+)
+from kaguya.modules.helper_funcs.join_guard import (
+    enforce_join,
+    forget_user,
+    forget_verdicts,
+    get_join_verdict,
+    get_stage_timings,
+)
 from kaguya.modules.helper_funcs.extraction import (
     extract_user,
     extract_user_and_text,
@@ -206,6 +220,7 @@ def gban(update, context):
             pass
 
     sql.gban_user(user_id, user_chat.username or user_chat.first_name, reason)
+    forget_user(user_id)
 
 
 @typing_action
@@ -276,6 +291,7 @@ def ungban(update, context):
             pass
 
     sql.ungban_user(user_id)
+    forget_user(user_id)
 
     context.bot.sendMessage(
         MESSAGE_DUMP,
@@ -312,62 +328,32 @@ def gbanlist(update, context):
         )
 
 
-def check_and_ban(update, user_id, should_message=True):
-
-    try:
-        spmban = spamwtc.get_ban(int(user_id))
-        if spmban:
-            update.effective_chat.kick_member(user_id)
-            if should_message:
-                update.effective_message.reply_text(
-                    f"This person has been detected as spambot by @SpamWatch and has been removed!\nReason: <code>{spmban.reason}</code>",
-                    parse_mode=ParseMode.HTML,
-                )
-                return
-            else:
-                return
-    except Exception:
-        pass
-
-    if sql.is_user_gbanned(user_id):
-        update.effective_chat.kick_member(user_id)
-        if should_message:
-            usr = sql.get_gbanned_user(user_id)
-            greason = usr.reason
-            if not greason:
-                greason = "No reason given"
-
-            update.effective_message.reply_text(
-                f"*Alert! this user was GBanned and have been removed!*\n*Reason*: {greason}",
-                parse_mode=ParseMode.MARKDOWN,
-            )
-            return
-
-
 def enforce_gban(update, context):
     # Not using @restrict handler to avoid spamming - just ignore if cant gban.
+    # Fbans are only enforced on joins, not on every message of a member.
+    user = update.effective_user
+    chat = update.effective_chat
+    msg = update.effective_message
+
     if (
-        sql.does_chat_gban(update.effective_chat.id)
-        and update.effective_chat.get_member(
-            context.bot.id
-        ).can_restrict_members
+        user
+        and get_join_verdict(chat.id, user.id).kind
+        and not is_user_admin(chat, user.id)
     ):
-        user = update.effective_user
-        chat = update.effective_chat
-        msg = update.effective_message
+        enforce_join(update, user.id, fbans=False)
 
-        if user and not is_user_admin(chat, user.id):
-            check_and_ban(update, user.id)
+    if msg.new_chat_members:
+        for mem in msg.new_chat_members:
+            enforce_join(update, mem.id)
 
-        if msg.new_chat_members:
-            new_members = update.effective_message.new_chat_members
-            for mem in new_members:
-                check_and_ban(update, mem.id)
-
-        if msg.reply_to_message:
-            user = msg.reply_to_message.from_user
-            if user and not is_user_admin(chat, user.id):
-                check_and_ban(update, user.id, should_message=False)
+    if msg.reply_to_message:
+        user = msg.reply_to_message.from_user
+        if (
+            user
+            and get_join_verdict(chat.id, user.id).kind
+            and not is_user_admin(chat, user.id)
+        ):
+            enforce_join(update, user.id, should_message=False, fbans=False)
 
 
 @user_admin
@@ -377,12 +363,14 @@ def gbanstat(update, context):
     if len(args) > 0:
         if args[0].lower() in ["on", "yes"]:
             sql.enable_gbans(update.effective_chat.id)
+            forget_verdicts()
             update.effective_message.reply_text(
                 "I've enabled Spam Sheild in this group. This will help protect you "
                 "from spammers, unsavoury characters, and the biggest trolls."
             )
         elif args[0].lower() in ["off", "no"]:
             sql.disable_gbans(update.effective_chat.id)
+            forget_verdicts()
             update.effective_message.reply_text(
                 "I've disabled Spam sheild in this group. GBans wont affect your users "
                 "anymore. You'll be less protected from any trolls and spammers "
@@ -399,7 +387,16 @@ def gbanstat(update, context):
 
 
 def __stats__():
-    return "× {} gbanned users.".format(sql.num_gbanned_users())
+    text = "× {} gbanned users.".format(sql.num_gbanned_users())
+    timings = get_stage_timings()
+    if timings:
+        text += "\n× Join checks: " + ", ".join(
+            "{} {:.3f}ms avg / {:.3f}ms max".format(
+                stage, timing["avg_ms"], timing["max_ms"]
+            )
+            for stage, timing in timings.items()
+        )
+    return text
 
 
 def __user_info__(user_id):
@@ -475,3 +472,8 @@ dispatcher.add_handler(GBAN_STATUS)
 
 if STRICT_GBAN:  # enforce GBANS if this is set
     dispatcher.add_handler(GBAN_ENFORCER, GBAN_ENFORCE_GROUP)
+
+if spamwtc:
+    dispatcher.job_queue.run_repeating(
+        sync_spamwatch, interval=SW_SYNC_INTERVAL, first=0
+    )
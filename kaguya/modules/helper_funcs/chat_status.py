@@ -1,12 +1,56 @@
 from functools import wraps
-from telegram import User, Chat, ChatMember
+from typing import Dict
+
+from telegram import Bot, User, Chat, ChatMember
 
 from kaguya import DEL_CMDS, SUDO_USERS, WHITELIST_USERS
-from kaguya.mwt import MWT
+from kaguya.mwt import TTLCache
+
+# The bot's own ChatMember, and the {user_id: ChatMember} admins, per chat.
+BOT_MEMBERS = TTLCache(timeout=60 * 5, maxsize=10000)
+ADMIN_ROSTERS = TTLCache(timeout=60 * 5, maxsize=10000)
+
+
+def set_bot_member(chat_id: int, member: ChatMember):
+    BOT_MEMBERS.set(chat_id, member)
+
+
+def invalidate_bot_member(chat_id: int):
+    BOT_MEMBERS.invalidate(chat_id)
+
+
+def get_bot_member(chat: Chat, bot_id: int) -> ChatMember:
+    """
+    Get the bot's ChatMember in chat, from cache when possible.
+
+    Entries are refreshed after five minutes, or earlier when users.py sees
+    the bot's status change in that chat.
+    """
+    return BOT_MEMBERS.get_or_load(chat.id, lambda: chat.get_member(bot_id))
+
+
+def invalidate_admin_roster(chat_id: int):
+    ADMIN_ROSTERS.invalidate(chat_id)
+
+
+def get_admin_roster(bot: Bot, chat_id: int) -> Dict[int, ChatMember]:
+    """
+    Get the admins of a chat keyed by user id, in the order Telegram lists
+    them, with a single getChatAdministrators call every five minutes.
+
+    Promoting, demoting and admin status updates drop the cached roster.
+    """
+    return ADMIN_ROSTERS.get_or_load(
+        chat_id,
+        lambda: {
+            admin.user.id: admin
+            for admin in bot.get_chat_administrators(chat_id)
+        },
+    )
 
 
 def can_delete(chat: Chat, bot_id: int) -> bool:
-    return chat.get_member(bot_id).can_delete_messages
+    return get_bot_member(chat, bot_id).can_delete_messages
 
 
 def is_user_ban_protected(
@@ -21,11 +65,10 @@ def is_user_ban_protected(
         return True
 
     if not member:
-        member = chat.get_member(user_id)
+        return user_id in get_admin_roster(chat.bot, chat.id)
     return member.status in ("administrator", "creator")
 
 
-@MWT(timeout=60 * 5)  # Cache admin status for 5 mins to avoid extra requests.
 def is_user_admin(chat: Chat, user_id: int, member: ChatMember = None) -> bool:
     if (
         chat.type == "private"
@@ -36,7 +79,7 @@ def is_user_admin(chat: Chat, user_id: int, member: ChatMember = None) -> bool:
         return True
 
     if not member:
-        member = chat.get_member(user_id)
+        return user_id in get_admin_roster(chat.bot, chat.id)
     return member.status in ("administrator", "creator")
 
 
@@ -47,7 +90,7 @@ def is_bot_admin(
         return True
 
     if not bot_member:
-        bot_member = chat.get_member(bot_id)
+        bot_member = get_bot_member(chat, bot_id)
     return bot_member.status in ("administrator", "creator")
 
 
@@ -73,7 +116,9 @@ def bot_can_delete(func):
 def can_pin(func):
     @wraps(func)
     def pin_rights(update, context, *args, **kwargs):
-        if update.effective_chat.get_member(context.bot.id).can_pin_messages:
+        if get_bot_member(
+            update.effective_chat, context.bot.id
+        ).can_pin_messages:
             return func(update, context, *args, **kwargs)
         else:
             update.effective_message.reply_text(
@@ -87,8 +132,8 @@ def can_pin(func):
 def can_promote(func):
     @wraps(func)
     def promote_rights(update, context, *args, **kwargs):
-        if update.effective_chat.get_member(
-            context.bot.id
+        if get_bot_member(
+            update.effective_chat, context.bot.id
         ).can_promote_members:
             return func(update, context, *args, **kwargs)
         else:
@@ -103,8 +148,8 @@ def can_promote(func):
 def can_restrict(func):
     @wraps(func)
     def promote_rights(update, context, *args, **kwargs):
-        if update.effective_chat.get_member(
-            context.bot.id
+        if get_bot_member(
+            update.effective_chat, context.bot.id
         ).can_restrict_members:
             return func(update, context, *args, **kwargs)
         else:
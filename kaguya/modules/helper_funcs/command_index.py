@@ -0,0 +1,76 @@
+from typing import List
+
+from telegram.ext import CommandHandler, Dispatcher, Handler
+
+from kaguya.modules.helper_funcs.handlers import parse_command
+
+
+class CommandRouter(Handler):
+    """
+    Stands in for a run of CommandHandlers of one handler group, and only
+    offers an update to the handlers of the command it starts with.
+
+    Handlers are still checked in the order they were added, and the
+    first one whose check_update passes handles the update, the same as
+    when the dispatcher tried them one by one.
+    """
+
+    def __init__(self, handlers: List[CommandHandler]):
+        super().__init__(self.handle_update)
+        self.handlers = handlers
+        self.index = {}
+        for handler in handlers:
+            for command in handler.command:
+                self.index.setdefault(command.lower(), []).append(handler)
+
+    def _candidates(self, parsed):
+        candidates = self.index.get(parsed.command, [])
+        if parsed.entity_command:
+            extra = self.index.get(parsed.entity_command, [])
+            if extra:
+                candidates = [
+                    x for x in self.handlers if x in candidates or x in extra
+                ]
+        return candidates
+
+    def check_update(self, update):
+        parsed = parse_command(update)
+        if parsed is None:
+            return None
+        for handler in self._candidates(parsed):
+            check = handler.check_update(update)
+            if check is not None and check is not False:
+                return handler, check
+        return None
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        handler, check = check_result
+        return handler.handle_update(update, dispatcher, check, context)
+
+
+def index_commands(dispatcher: Dispatcher, min_run: int = 2) -> int:
+    """
+    Replace every run of at least min_run consecutive CommandHandlers in
+    the dispatcher's handler groups with one CommandRouter. Call it once
+    all modules added their handlers.
+
+    :return: number of command handlers now behind a router
+    """
+    routed = 0
+    for group, handlers in dispatcher.handlers.items():
+        new_handlers = []
+        run = []
+        for handler in handlers + [None]:
+            if isinstance(handler, CommandHandler):
+                run.append(handler)
+                continue
+            if len(run) >= min_run:
+                new_handlers.append(CommandRouter(run))
+                routed += len(run)
+            else:
+                new_handlers.extend(run)
+            run = []
+            if handler is not None:
+                new_handlers.append(handler)
+        handlers[:] = new_handlers
+    return routed
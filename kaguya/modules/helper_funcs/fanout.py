@@ -0,0 +1,150 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable
+
+from telegram.error import RetryAfter
+
+from kaguya import LOGGER
+
+
+class AbortFanout(Exception):
+    """Raised by a fan-out action to stop the rest of its job."""
+
+
+class RateBudget(object):
+    """
+    Shared Bot API call budget: at most `rate` calls per second overall,
+    and one call per `per_chat` seconds in any single chat.
+    """
+
+    def __init__(self, rate: float = 20, per_chat: float = 1.0):
+        self.interval = 1.0 / rate
+        self.per_chat = per_chat
+        self._next = 0.0
+        self._chat_next = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, chat_id: Hashable):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = max(self._next, self._chat_next.get(chat_id, 0)) - now
+                if wait <= 0:
+                    self._next = max(self._next, now) + self.interval
+                    self._chat_next[chat_id] = now + self.per_chat
+                    if len(self._chat_next) > 10000:
+                        self._chat_next = {
+                            k: v for k, v in self._chat_next.items() if v > now
+                        }
+                    return
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Hold every caller back, eg. after telegram answered RetryAfter."""
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+class FanoutEngine(object):
+    """
+    Runs (job, target) actions in the background.
+
+    A job is a dict with at least "job_id", "targets" (a list of tuples
+    whose first item is the chat id), "progress" and "affected". Targets
+    are run `batch_size` at a time on a pool of `workers` threads, all
+    drawing from one RateBudget; after each batch `on_progress(job)` is
+    called so the job can be persisted and resumed from there. Once all
+    targets are done, or an action raised AbortFanout, `on_done(job)` is
+    called.
+
+    `execute(job, target)` returns whether the target was affected.
+    """
+
+    def __init__(
+        self,
+        execute: Callable[[dict, tuple], bool],
+        on_progress: Callable[[dict], None],
+        on_done: Callable[[dict], None],
+        workers: int = 4,
+        jobs: int = 2,
+        budget: RateBudget = None,
+    ):
+        self.execute = execute
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.batch_size = workers * 4
+        self.budget = budget or RateBudget()
+        self._jobs = queue.Queue()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._runners = [
+            threading.Thread(target=self._run, daemon=True)
+            for _ in range(jobs)
+        ]
+        self.running = 0
+        self._running_lock = threading.Lock()
+
+    def start(self):
+        for runner in self._runners:
+            runner.start()
+
+    def submit(self, job: dict):
+        self._jobs.put(job)
+
+    def pending(self) -> int:
+        return self._jobs.qsize() + self.running
+
+    def _call(self, job, target):
+        while True:
+            self.budget.acquire(target[0])
+            try:
+                return bool(self.execute(job, target))
+            except RetryAfter as excp:
+                LOGGER.warning(
+                    "Fan-out job {} flood waited for {}s".format(
+                        job["job_id"], excp.retry_after
+                    )
+                )
+                self.budget.pause(excp.retry_after)
+            except AbortFanout:
+                raise
+            except Exception:
+                LOGGER.exception(
+                    "Fan-out job {} failed on {}".format(job["job_id"], target)
+                )
+                return False
+
+    def _run_job(self, job):
+        targets = job["targets"]
+        while job["progress"] < len(targets):
+            batch = targets[
+                job["progress"] : job["progress"] + self.batch_size
+            ]
+            futures = [self._pool.submit(self._call, job, x) for x in batch]
+            aborted = False
+            for future in futures:
+                try:
+                    job["affected"] += future.result()
+                except AbortFanout:
+                    aborted = True
+            job["progress"] += len(batch)
+            self.on_progress(job)
+            if aborted:
+                break
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            with self._running_lock:
+                self.running += 1
+            try:
+                self._run_job(job)
+                self.on_done(job)
+            except Exception:
+                LOGGER.exception(
+                    "Fan-out job {} crashed".format(job["job_id"])
+                )
+            finally:
+                with self._running_lock:
+                    self.running -= 1
@@ -0,0 +1,117 @@
+import threading
+from collections import deque
+from typing import Dict, List, Set, Tuple
+
+
+class FedGraph(object):
+    """
+    Federation subscriptions and chats, for working out where a fed's
+    bans have to go.
+
+    A fed's ban reaches its own chats, the chats of every fed subscribed
+    to it, and so on down the subscription chain. Subscriptions may form
+    cycles; every fed is only visited once. The resulting target list is
+    cached per fed and kept up to date as chats join and leave.
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[str]] = {}
+        # the reverse: fed -> feds it subscribes to
+        self._subscriptions: Dict[str, Set[str]] = {}
+        self._chats: Dict[str, Dict[str, None]] = {}
+        # fed -> (feds reached, [(chat_id, fed_id the chat belongs to)],
+        #         chat ids in that list)
+        self._targets: Dict[str, Tuple[Set[str], List, Set]] = {}
+        self._lock = threading.RLock()
+
+    def add_subscription(self, fed_id: str, subscriber: str):
+        with self._lock:
+            self._subscribers.setdefault(fed_id, set()).add(subscriber)
+            self._subscriptions.setdefault(subscriber, set()).add(fed_id)
+            # any fed that reaches fed_id now reaches further
+            self._invalidate(fed_id)
+
+    def remove_subscription(self, fed_id: str, subscriber: str):
+        with self._lock:
+            self._subscribers.get(fed_id, set()).discard(subscriber)
+            self._subscriptions.get(subscriber, set()).discard(fed_id)
+            self._invalidate(fed_id)
+
+    def add_chat(self, fed_id: str, chat_id: str):
+        with self._lock:
+            chats = self._chats.setdefault(fed_id, {})
+            if chat_id in chats:
+                return
+            chats[chat_id] = None
+            for reached, targets, seen in self._targets.values():
+                if fed_id in reached and chat_id not in seen:
+                    seen.add(chat_id)
+                    targets.append((chat_id, fed_id))
+
+    def remove_chat(self, fed_id: str, chat_id: str):
+        with self._lock:
+            if self._chats.get(fed_id, {}).pop(chat_id, False) is False:
+                return
+            self._invalidate(fed_id)
+
+    def remove_fed(self, fed_id: str):
+        with self._lock:
+            self._invalidate(fed_id)
+            self._subscribers.pop(fed_id, None)
+            self._subscriptions.pop(fed_id, None)
+            self._chats.pop(fed_id, None)
+            for subscribers in self._subscribers.values():
+                subscribers.discard(fed_id)
+            for subscriptions in self._subscriptions.values():
+                subscriptions.discard(fed_id)
+
+    def _invalidate(self, fed_id):
+        for key in [k for k, v in self._targets.items() if fed_id in v[0]]:
+            del self._targets[key]
+
+    def _walk(self, fed_id, edges):
+        order = [fed_id]
+        seen = {fed_id}
+        queue = deque(order)
+        while queue:
+            for fedsid in edges.get(queue.popleft(), ()):
+                if fedsid not in seen:
+                    seen.add(fedsid)
+                    order.append(fedsid)
+                    queue.append(fedsid)
+        return order
+
+    def reached(self, fed_id: str) -> List[str]:
+        """fed_id followed by its direct and indirect subscribers."""
+        with self._lock:
+            return self._walk(fed_id, self._subscribers)
+
+    def sources(self, fed_id: str) -> List[str]:
+        """
+        Feds whose bans reach fed_id's chats: fed_id itself, then the feds
+        it subscribes to, directly or indirectly.
+        """
+        with self._lock:
+            return self._walk(fed_id, self._subscriptions)
+
+    def targets(self, fed_id: str) -> List[Tuple[str, str]]:
+        """
+        Every chat a ban in fed_id has to reach, each one only once.
+
+        :return: (chat_id, fed_id the chat belongs to) pairs, the fed's own
+            chats first
+        """
+        with self._lock:
+            cached = self._targets.get(fed_id)
+            if cached is None:
+                reached = self.reached(fed_id)
+                targets = []
+                seen = set()
+                for fedsid in reached:
+                    for chat_id in self._chats.get(fedsid, ()):
+                        if chat_id not in seen:
+                            seen.add(chat_id)
+                            targets.append((chat_id, fedsid))
+                cached = (set(reached), targets, seen)
+                self._targets[fed_id] = cached
+            return list(cached[1])
@@ -1,5 +1,7 @@
+from typing import Optional
+
 import telegram.ext as tg
-from telegram import Update
+from telegram import MessageEntity, Update
 
 try:
     from kaguya import CUSTOM_CMD
@@ -10,6 +12,67 @@ if CUSTOM_CMD:
     CMD_STARTERS = CUSTOM_CMD
 else:
     CMD_STARTERS = "/"
+# plain CommandHandlers always take "/"
+ALL_STARTERS = tuple(CMD_STARTERS) + ("/",)
+
+
+class ParsedCommand(object):
+    """The command a message starts with, split once per update."""
+
+    __slots__ = ("word", "command", "entity_command", "args")
+
+    def __init__(self, word, command, entity_command, args):
+        # the first word as sent, eg. "/Start@SomeBot"
+        self.word = word
+        # lowercased, without starter or @botname
+        self.command = command
+        # the same per telegram's bot_command entity, when it differs
+        self.entity_command = entity_command
+        self.args = args
+
+
+def parse_command(update) -> Optional[ParsedCommand]:
+    """
+    The command the update's message starts with, or None when it isn't
+    a command, or one meant for another bot.
+    """
+    if not isinstance(update, Update):
+        return None
+    try:
+        return update._command
+    except AttributeError:
+        pass
+
+    parsed = None
+    message = update.effective_message
+    if message and message.text and len(message.text) > 1:
+        words = message.text.split()
+        fst_word = words[0]
+        if len(fst_word) > 1 and any(
+            fst_word.startswith(start) for start in ALL_STARTERS
+        ):
+            command, _, username = fst_word[1:].partition("@")
+            if (
+                not username
+                or username.lower() == message.bot.username.lower()
+            ):
+                entity_command = None
+                entity = message.entities[0] if message.entities else None
+                if (
+                    entity
+                    and entity.type == MessageEntity.BOT_COMMAND
+                    and entity.offset == 0
+                ):
+                    entity_command = (
+                        message.text[1 : entity.length].split("@")[0].lower()
+                    )
+                    if entity_command == command.lower():
+                        entity_command = None
+                parsed = ParsedCommand(
+                    fst_word, command.lower(), entity_command, words[1:]
+                )
+    update._command = parsed
+    return parsed
 
 
 class CustomCommandHandler(tg.CommandHandler):
@@ -19,28 +82,16 @@ class CustomCommandHandler(tg.CommandHandler):
         super().__init__(command, callback, run_async=run_async, **kwargs)
 
     def check_update(self, update):
-        if isinstance(update, Update) and update.effective_message:
-            message = update.effective_message
+        parsed = parse_command(update)
+        if parsed is None or not any(
+            parsed.word.startswith(start) for start in CMD_STARTERS
+        ):
+            return None
+        if parsed.command not in self.command:
+            return None
 
-            if message.text and len(message.text) > 1:
-                fst_word = message.text.split(None, 1)[0]
-                if len(fst_word) > 1 and any(
-                    fst_word.startswith(start) for start in CMD_STARTERS
-                ):
-                    args = message.text.split()[1:]
-                    command = fst_word[1:].split("@")
-                    command.append(
-                        message.bot.username
-                    )  # in case the command was sent without a username
-
-                    if not (
-                        command[0].lower() in self.command
-                        and command[1].lower() == message.bot.username.lower()
-                    ):
-                        return None
-
-                    filter_result = self.filters(update)
-                    if filter_result:
-                        return args, filter_result
-                    else:
-                        return False
+        filter_result = self.filters(update)
+        if filter_result:
+            return parsed.args, filter_result
+        else:
+            return False
@@ -0,0 +1,69 @@
+import heapq
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Iterator
+
+
+class IntSet(object):
+    """
+    Set of 64 bit ints kept as one sorted array('q').
+
+    Takes 8 bytes per member instead of the ~60 of a python set, with
+    O(log n) lookups. Single adds and removes shift the array; add many
+    at once with `update`, which merges them in one pass.
+
+    Writers must be serialized by the caller's lock. Readers don't need
+    it, but may miss a member while an add or remove shifts the array.
+    """
+
+    __slots__ = ("_items",)
+
+    def __init__(self, items: Iterable[int] = ()):
+        self._items = array("q", sorted(set(int(x) for x in items)))
+
+    def __contains__(self, item) -> bool:
+        try:
+            item = int(item)
+        except (TypeError, ValueError):
+            return False
+        items = self._items
+        index = bisect_left(items, item)
+        return index < len(items) and items[index] == item
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._items)
+
+    def __bool__(self) -> bool:
+        return bool(self._items)
+
+    def add(self, item: int):
+        item = int(item)
+        items = self._items
+        index = bisect_left(items, item)
+        if index == len(items) or items[index] != item:
+            items.insert(index, item)
+
+    def discard(self, item: int):
+        item = int(item)
+        items = self._items
+        index = bisect_left(items, item)
+        if index < len(items) and items[index] == item:
+            del items[index]
+
+    def update(self, new_items: Iterable[int]):
+        new_items = sorted(
+            x for x in {int(x) for x in new_items} if x not in self
+        )
+        if len(new_items) <= 16:
+            for item in new_items:
+                self.add(item)
+        else:
+            # swap in a merged copy so readers never see a half built array
+            self._items = array("q", heapq.merge(self._items, new_items))
+
+    @property
+    def nbytes(self) -> int:
+        return self._items.itemsize * len(self._items)
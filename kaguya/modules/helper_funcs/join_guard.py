@@ -0,0 +1,186 @@
+import html
+import threading
+import time
+from collections import namedtuple
+
+from telegram import ParseMode
+from telegram.error import TelegramError
+
+import kaguya.modules.sql.feds_sql as fed_sql
+import kaguya.modules.sql.global_bans_sql as gban_sql
+from kaguya import STRICT_GBAN
+from kaguya.modules.helper_funcs.chat_status import get_bot_member
+from kaguya.modules.helper_funcs.spamwatch_mirror import (
+    get_sw_reason,
+    is_sw_banned,
+)
+from kaguya.mwt import TTLCache
+
+# kind is "spamwatch", "gban", "fban" or None when the user is clean here
+JoinVerdict = namedtuple("JoinVerdict", ["kind", "reason", "fed_id"])
+CLEAN = JoinVerdict(None, None, None)
+
+VERDICT_TIMEOUT = 60
+
+# keyed (user_id, chat_id) so a user's verdicts can be dropped in one go
+JOIN_VERDICTS = TTLCache(timeout=VERDICT_TIMEOUT, maxsize=20000)
+# (user_id, chat_id) pairs already kicked, so the welcome and gban
+# handlers seeing the same join don't both act on it
+JOIN_ENFORCED = TTLCache(timeout=VERDICT_TIMEOUT, maxsize=20000)
+ENFORCE_LOCK = threading.Lock()
+
+# stage -> [runs, total seconds, slowest run]
+STAGE_TIMINGS = {}
+STAGE_TIMINGS_LOCK = threading.Lock()
+
+
+def __check_spamwatch(chat_id, user_id):
+    if gban_sql.does_chat_gban(chat_id) and is_sw_banned(user_id):
+        return JoinVerdict("spamwatch", get_sw_reason(user_id), None)
+    return None
+
+
+def __check_gban(chat_id, user_id):
+    if gban_sql.does_chat_gban(chat_id) and gban_sql.is_user_gbanned(user_id):
+        user = gban_sql.get_gbanned_user(user_id)
+        return JoinVerdict("gban", user.reason if user else None, None)
+    return None
+
+
+def __check_fban(chat_id, user_id):
+    fban = fed_sql.get_chat_fban(chat_id, user_id)
+    if fban:
+        return JoinVerdict("fban", fban[1], fban[0])
+    return None
+
+
+# cheapest first, the first stage with a verdict wins. gbans and SpamWatch
+# bans are only enforced with STRICT_GBAN set, without it they aren't
+# checked at all so they can't hide an fban
+STAGES = (
+    (("spamwatch", __check_spamwatch), ("gban", __check_gban))
+    if STRICT_GBAN
+    else ()
+) + (("fban", __check_fban),)
+
+
+def __record_timing(stage, elapsed):
+    with STAGE_TIMINGS_LOCK:
+        timing = STAGE_TIMINGS.setdefault(stage, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += elapsed
+        timing[2] = max(timing[2], elapsed)
+
+
+def __evaluate(chat_id, user_id):
+    for stage, check in STAGES:
+        start = time.perf_counter()
+        verdict = check(chat_id, user_id)
+        __record_timing(stage, time.perf_counter() - start)
+        if verdict:
+            return verdict
+    return CLEAN
+
+
+def get_join_verdict(chat_id, user_id) -> JoinVerdict:
+    """
+    Whether user_id is banned anywhere that matters for chat_id: on
+    SpamWatch or globally (with STRICT_GBAN set, unless the chat turned
+    that off), or in the chat's fed chain. Verdicts are cached for
+    VERDICT_TIMEOUT seconds.
+    """
+    return JOIN_VERDICTS.get_or_load(
+        (user_id, chat_id), lambda: __evaluate(chat_id, user_id)
+    )
+
+
+def forget_user(user_id):
+    """Drop cached verdicts of user_id, after they were (un)banned."""
+    JOIN_VERDICTS.invalidate(user_id)
+    JOIN_ENFORCED.invalidate(user_id)
+
+
+def forget_verdicts():
+    """
+    Drop every cached verdict, after a chat turned gbans on or off. They
+    are keyed by user first, so one chat's can't be dropped on their own.
+    """
+    JOIN_VERDICTS.clear()
+
+
+def get_stage_timings() -> dict:
+    """stage -> {"runs", "avg_ms", "max_ms"}"""
+    with STAGE_TIMINGS_LOCK:
+        return {
+            stage: {
+                "runs": runs,
+                "avg_ms": total * 1000 / runs,
+                "max_ms": slowest * 1000,
+            }
+            for stage, (runs, total, slowest) in STAGE_TIMINGS.items()
+        }
+
+
+def __claim(chat_id, user_id) -> bool:
+    with ENFORCE_LOCK:
+        if JOIN_ENFORCED.get((user_id, chat_id)):
+            return False
+        JOIN_ENFORCED.set((user_id, chat_id), True)
+        return True
+
+
+def __release(chat_id, user_id):
+    JOIN_ENFORCED.invalidate((user_id, chat_id))
+
+
+def __verdict_text(verdict):
+    if verdict.kind == "spamwatch":
+        text = "This person has been detected as spambot by @SpamWatch and has been removed!"
+        if verdict.reason:
+            text += "\nReason: <code>{}</code>".format(
+                html.escape(verdict.reason)
+            )
+    elif verdict.kind == "gban":
+        text = "<b>Alert! this user was GBanned and have been removed!</b>\n<b>Reason</b>: {}".format(
+            html.escape(verdict.reason or "No reason given")
+        )
+    else:
+        text = "This user is banned in current federation! I will remove him."
+    return text
+
+
+def enforce_join(
+    update, user_id, should_message=True, fbans=True
+) -> JoinVerdict:
+    """
+    Kick user_id from the update's chat if get_join_verdict says so. Each
+    (chat, user) is only kicked, and messaged about, once per verdict; a
+    kick that failed is tried again on the next call.
+
+    :param fbans: act on fbans too, only done for users who just joined
+    :return: the verdict, whether or not it could be acted on
+    """
+    chat = update.effective_chat
+    verdict = get_join_verdict(chat.id, user_id)
+    if not verdict.kind:
+        return verdict
+    if verdict.kind == "fban" and not fbans:
+        return verdict
+    if not get_bot_member(chat, chat.bot.id).can_restrict_members:
+        return verdict
+    if not __claim(chat.id, user_id):
+        return verdict
+
+    try:
+        chat.kick_member(user_id)
+    except TelegramError:
+        __release(chat.id, user_id)
+        return verdict
+    if should_message:
+        try:
+            update.effective_message.reply_text(
+                __verdict_text(verdict), parse_mode=ParseMode.HTML
+            )
+        except TelegramError:
+            pass
+    return verdict
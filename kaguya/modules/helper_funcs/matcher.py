@@ -0,0 +1,170 @@
+import re
+import unicodedata
+from collections import deque
+from typing import Callable, Iterable, Optional
+
+WILDCARD_REGEX = re.compile(r"[*?]+")
+# opts a trigger in to wildcards, so * and ? in triggers saved before they
+# existed stay literal
+WILDCARD_PREFIX = "wildcard:"
+
+
+def casefold_text(text: str) -> str:
+    """
+    Normalize text for case and compatibility insensitive matching.
+
+    :param text: text to normalize
+    :return: NFKC normalized, casefolded string
+    """
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+def _is_word_char(char: str) -> bool:
+    # same definition of a word character as re's \w for str patterns
+    return char.isalnum() or char == "_"
+
+
+def _wildcard_to_regex(keyword: str) -> str:
+    parts = []
+    for char in keyword:
+        if char == "*":
+            parts.append(r"\S*")
+        elif char == "?":
+            parts.append(r"\S")
+        else:
+            parts.append(re.escape(char))
+    return r"(?:^|(?<=\W))" + "".join(parts) + r"(?=\W|$)"
+
+
+def wildcard_anchor(pattern: str) -> str:
+    """
+    The literal part a wildcard pattern is looked up by.
+
+    :param pattern: keyword without WILDCARD_PREFIX
+    :return: its longest literal part, stripped; empty if there is none,
+        eg. for ``*``, which would match every message
+    """
+    return max(WILDCARD_REGEX.split(pattern), key=len).strip()
+
+
+class KeywordMatcher(object):
+    """
+    Aho-Corasick automaton over a chat's trigger keywords.
+
+    Keywords use the same rule as the old per keyword
+    ``( |^|[^\\w])keyword( |$|[^\\w])`` search: they must not touch a word
+    character on either side. The order of the keywords is their priority,
+    so `search` returns the same keyword the old loop would have found
+    first, after a single pass over the text.
+
+    With ``wildcards`` set, keywords starting with WILDCARD_PREFIX are
+    patterns where ``*`` matches any run of non space characters and ``?``
+    a single one; they are anchored on their longest literal part and
+    confirmed with a regex only when that part is seen. Patterns without a
+    literal part are skipped. In all other keywords ``*`` and ``?`` are
+    literal.
+    """
+
+    def __init__(
+        self,
+        keywords: Iterable[str],
+        normalize: Callable[[str], str] = str.lower,
+        wildcards: bool = False,
+    ):
+        self.keywords = list(keywords)
+        self.normalize = normalize
+
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        self._patterns = {}
+
+        for index, keyword in enumerate(self.keywords):
+            keyword = normalize(keyword)
+            if wildcards and keyword.startswith(WILDCARD_PREFIX):
+                keyword = keyword[len(WILDCARD_PREFIX) :]
+                anchor = wildcard_anchor(keyword)
+                self._patterns[index] = re.compile(_wildcard_to_regex(keyword))
+            else:
+                anchor = keyword
+            if not anchor:
+                continue
+
+            self._insert(anchor, index)
+
+        self._build()
+
+    def __len__(self):
+        return len(self.keywords)
+
+    def _insert(self, anchor: str, index: int):
+        node = 0
+        for char in anchor:
+            nxt = self._goto[node].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append((index, len(anchor)))
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+        for out in self._out:
+            out.sort()
+
+    def _matches(self, index, text, start, end, checked) -> bool:
+        pattern = self._patterns.get(index)
+        if pattern is not None:
+            if index not in checked:
+                checked[index] = bool(pattern.search(text))
+            return checked[index]
+
+        return (start == 0 or not _is_word_char(text[start - 1])) and (
+            end == len(text) or not _is_word_char(text[end])
+        )
+
+    def search(self, text: str, normalized: bool = False) -> Optional[str]:
+        """
+        Find the highest priority keyword present in text.
+
+        :param text: text to scan
+        :param normalized: whether text was already passed through normalize
+        :return: the matching keyword as it was given, or None
+        """
+        if not text or not self.keywords:
+            return None
+        if not normalized:
+            text = self.normalize(text)
+
+        goto, fail, out = self._goto, self._fail, self._out
+        checked = {}
+        best = None
+        node = 0
+        for pos, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for index, length in out[node]:
+                if best is not None and index >= best:
+                    break
+                end = pos + 1
+                if self._matches(index, text, end - length, end, checked):
+                    best = index
+                    break
+            if best == 0:
+                break
+
+        return self.keywords[best] if best is not None else None
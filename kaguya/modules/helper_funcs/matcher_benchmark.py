@@ -0,0 +1,105 @@
+"""
+Compare the per message cost of the old one regex per trigger loop with
+KeywordMatcher, for chats with 10, 100, 1000 and 5000 filters:
+
+    python3 -m kaguya.modules.helper_funcs.matcher_benchmark [--sizes 10,100]
+
+Triggers are random words, and messages are 80 characters, with and
+without a trigger in them. Both ways are checked to find the same trigger
+before they are timed.
+"""
+
+import argparse
+import random
+import re
+import string
+import time
+
+from kaguya.modules.helper_funcs.matcher import KeywordMatcher
+
+
+def old_search(keywords, text):
+    # reply_filter before KeywordMatcher
+    for keyword in keywords:
+        pattern = r"( |^|[^\w])" + re.escape(keyword) + r"( |$|[^\w])"
+        if re.search(pattern, text, flags=re.IGNORECASE):
+            return keyword
+    return None
+
+
+def random_word(rand, low=3, high=12):
+    return "".join(
+        rand.choice(string.ascii_lowercase)
+        for _ in range(rand.randint(low, high))
+    )
+
+
+def random_message(rand, length=80, trigger=None):
+    words = []
+    while sum(len(x) + 1 for x in words) < length:
+        words.append(random_word(rand, 2, 8))
+    if trigger:
+        words[len(words) // 2] = trigger.upper()
+    return " ".join(words)[: max(length, len(trigger or ""))]
+
+
+def per_call(func, seconds):
+    """:return: average seconds per call over about seconds"""
+    calls = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        func()
+        calls += 1
+        now = time.perf_counter()
+        if now >= deadline:
+            return (now - start) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="10,100,1000,5000")
+    parser.add_argument("--seconds", type=float, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    print(
+        "{:>8} {:>12} {:>12} {:>12} {:>12} {:>12}".format(
+            "filters", "old miss", "new miss", "old hit", "new hit", "build"
+        )
+    )
+    for size in (int(x) for x in args.sizes.split(",")):
+        keywords = set()
+        while len(keywords) < size:
+            keywords.add(random_word(rand))
+        # the order CHAT_FILTERS keeps them in
+        keywords = sorted(keywords, key=lambda x: (-len(x), x))
+        miss = random_message(rand)
+        hit = random_message(rand, trigger=rand.choice(keywords))
+
+        start = time.perf_counter()
+        matcher = KeywordMatcher(keywords)
+        build = time.perf_counter() - start
+        for text in (miss, hit):
+            assert matcher.search(text) == old_search(keywords, text), text
+
+        old_miss = per_call(lambda: old_search(keywords, miss), args.seconds)
+        new_miss = per_call(lambda: matcher.search(miss), args.seconds)
+        old_hit = per_call(lambda: old_search(keywords, hit), args.seconds)
+        new_hit = per_call(lambda: matcher.search(hit), args.seconds)
+        print(
+            "{:>8} {:>10.1f}us {:>10.1f}us {:>10.1f}us {:>10.1f}us "
+            "{:>10.1f}ms".format(
+                size,
+                old_miss * 1e6,
+                new_miss * 1e6,
+                old_hit * 1e6,
+                new_hit * 1e6,
+                build * 1000,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from functools import wraps
+
+from sqlalchemy import event
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from kaguya import LOGGER, SLOW_QUERY_MS
+from kaguya.modules.helper_funcs.command_index import CommandRouter
+
+# histogram upper bounds, anything above the last goes in one more bucket
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+TIME_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 1000)
+
+
+class HandlerStats(object):
+    """
+    Statements run by one handler callback, over all of its calls; or by
+    all handlers of an update, over all updates.
+    """
+
+    __slots__ = (
+        "calls",
+        "statements",
+        "db_time",
+        "slowest",
+        "statement_hist",
+        "time_hist",
+    )
+
+    def __init__(self):
+        self.calls = 0
+        self.statements = 0
+        self.db_time = 0.0
+        # slowest single statement
+        self.slowest = 0.0
+        # calls by statements run, and by total db time
+        self.statement_hist = [0] * (len(STATEMENT_BUCKETS) + 1)
+        self.time_hist = [0] * (len(TIME_BUCKETS_MS) + 1)
+
+    def add(self, statements, db_time, slowest):
+        self.calls += 1
+        self.statements += statements
+        self.db_time += db_time
+        self.slowest = max(self.slowest, slowest)
+        self.statement_hist[bisect_left(STATEMENT_BUCKETS, statements)] += 1
+        self.time_hist[bisect_left(TIME_BUCKETS_MS, db_time * 1000)] += 1
+
+    def copy(self):
+        copy = HandlerStats()
+        copy.calls = self.calls
+        copy.statements = self.statements
+        copy.db_time = self.db_time
+        copy.slowest = self.slowest
+        copy.statement_hist = list(self.statement_hist)
+        copy.time_hist = list(self.time_hist)
+        return copy
+
+
+HANDLER_STATS = {}
+# every update's statements summed over all of its handler groups
+UPDATE_STATS = HandlerStats()
+STATS_LOCK = threading.Lock()
+# (when, seconds, handler, calling *_sql function, statement)
+SLOW_QUERIES = deque(maxlen=50)
+
+# [statements, db time, slowest, name] of the callback running on this
+# thread, if any
+CURRENT = threading.local()
+# the UpdateRecord of the update being handled on this thread, if any
+CURRENT_UPDATE = threading.local()
+
+
+class UpdateRecord(object):
+    """
+    Statements of one update, added to UPDATE_STATS once the update and
+    all of its run_async callbacks are done.
+    """
+
+    __slots__ = ("statements", "db_time", "slowest", "pending")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+        self.slowest = 0.0
+        # process_update plus the run_async callbacks not yet done
+        self.pending = 1
+
+    def finish(self):
+        with STATS_LOCK:
+            self.pending -= 1
+            if not self.pending:
+                UPDATE_STATS.add(self.statements, self.db_time, self.slowest)
+
+
+def __sql_caller(frame):
+    while frame:
+        filename = frame.f_code.co_filename
+        if filename.endswith("_sql.py"):
+            return "{}.{}".format(
+                os.path.basename(filename)[:-3], frame.f_code.co_name
+            )
+        frame = frame.f_back
+    return "unknown"
+
+
+def __before_execute(conn, cursor, statement, parameters, context, many):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def __after_execute(conn, cursor, statement, parameters, context, many):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    current = getattr(CURRENT, "value", None)
+    if current is not None:
+        current[0] += 1
+        current[1] += elapsed
+        current[2] = max(current[2], elapsed)
+    record = getattr(CURRENT_UPDATE, "value", None)
+    if record is not None:
+        # run_async callbacks of the update may be adding to it too
+        with STATS_LOCK:
+            record.statements += 1
+            record.db_time += elapsed
+            record.slowest = max(record.slowest, elapsed)
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        handler = current[3] if current is not None else None
+        # only walked for slow statements, it's the same stack as the query
+        caller = __sql_caller(sys._getframe(1))
+        statement = " ".join(statement.split())
+        SLOW_QUERIES.append((time.time(), elapsed, handler, caller, statement))
+        LOGGER.warning(
+            "Slow query (%.0fms) from %s in %s: %s",
+            elapsed * 1000,
+            caller,
+            handler,
+            statement[:300],
+        )
+
+
+def instrument_engine(engine):
+    """Time every statement run on engine."""
+    event.listen(engine, "before_cursor_execute", __before_execute)
+    event.listen(engine, "after_cursor_execute", __after_execute)
+
+
+def __instrument_callback(callback):
+    name = "{}.{}".format(
+        callback.__module__.replace("kaguya.modules.", ""),
+        callback.__qualname__,
+    )
+
+    @wraps(callback)
+    def wrapper(*args, **kwargs):
+        outer = getattr(CURRENT, "value", None)
+        current = CURRENT.value = [0, 0.0, 0.0, name]
+        try:
+            return callback(*args, **kwargs)
+        finally:
+            CURRENT.value = outer
+            with STATS_LOCK:
+                stats = HANDLER_STATS.get(name)
+                if stats is None:
+                    stats = HANDLER_STATS[name] = HandlerStats()
+                stats.add(*current[:3])
+
+    wrapper.query_stats = True
+    return wrapper
+
+
+def instrument_handlers(dispatcher: Dispatcher) -> int:
+    """
+    Count the statements each handler callback runs per update. Call it
+    once all modules added their handlers; run_async callbacks are counted
+    on the pool thread they end up running on.
+
+    :return: number of callbacks instrumented
+    """
+    count = 0
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, CommandRouter):
+                inner_handlers = handler.handlers
+            else:
+                inner_handlers = [handler]
+            for inner in inner_handlers:
+                # the same handler may be in more than one group
+                if not getattr(inner.callback, "query_stats", False):
+                    inner.callback = __instrument_callback(inner.callback)
+                    count += 1
+    return count
+
+
+def __run_with_record(record, func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        CURRENT_UPDATE.value = record
+        try:
+            return func(*args, **kwargs)
+        finally:
+            CURRENT_UPDATE.value = None
+            record.finish()
+
+    return wrapper
+
+
+def instrument_updates(dispatcher: Dispatcher, executor):
+    """
+    Count the statements each update runs over all handler groups,
+    including its run_async callbacks and the handlers' checks.
+
+    :param executor: the ChatShardedExecutor handling the updates
+    """
+    process_update = executor.process_update
+    run_async = dispatcher.run_async
+
+    def counted_process_update(update):
+        if not isinstance(update, Update):
+            return process_update(update)
+        record = update._query_stats = UpdateRecord()
+        return __run_with_record(record, process_update)(update)
+
+    def counted_run_async(func, *args, update=None, **kwargs):
+        record = getattr(update, "_query_stats", None)
+        if record is not None:
+            with STATS_LOCK:
+                record.pending += 1
+            func = __run_with_record(record, func)
+        return run_async(func, *args, update=update, **kwargs)
+
+    executor.process_update = counted_process_update
+    dispatcher.run_async = counted_run_async
+
+
+def get_update_stats() -> HandlerStats:
+    """Statements per update, a copy safe to read while handlers run"""
+    with STATS_LOCK:
+        return UPDATE_STATS.copy()
+
+
+def get_handler_stats() -> dict:
+    """name -> HandlerStats, a copy safe to read while handlers run"""
+    with STATS_LOCK:
+        return {name: x.copy() for name, x in HANDLER_STATS.items()}
+
+
+def reset_stats():
+    global UPDATE_STATS
+    with STATS_LOCK:
+        HANDLER_STATS.clear()
+        UPDATE_STATS = HandlerStats()
+    SLOW_QUERIES.clear()
@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import deque
+from typing import Dict, List
+
+# a chat is raided once RAID_JOINS members join within RAID_WINDOW seconds
+RAID_JOINS = 10
+RAID_WINDOW = 10
+# and goes back to normal after RAID_QUIET seconds without a join
+RAID_QUIET = 60
+# how often raids are processed, see RaidState
+RAID_TICK = 5
+
+
+class RaidState(object):
+    """
+    A chat in raid mode. Joins are only recorded here by the join
+    handler; restricting them and updating the summary message is left
+    to a job running every RAID_TICK seconds.
+    """
+
+    __slots__ = (
+        "chat",
+        "started",
+        "last_join",
+        "joins",
+        "pending",
+        "service_msgs",
+        "summary_id",
+        "shown",
+        "settings",
+    )
+
+    def __init__(self, chat, now):
+        self.chat = chat
+        self.started = now
+        self.last_join = now
+        self.joins = 0
+        # members joined since the last tick
+        self.pending = []
+        self.service_msgs = []
+        self.summary_id = None
+        # joins count the summary message currently shows
+        self.shown = 0
+        # welcome settings, read once by whoever started the raid
+        self.settings = None
+
+
+RAID_CHATS: Dict[int, RaidState] = {}
+JOIN_TIMES: Dict[int, deque] = {}
+RAID_LOCK = threading.Lock()
+
+
+def record_joins(chat, members, service_msg=None, now=None):
+    """
+    Count members joining chat, and record them on the chat's raid if it
+    is or now goes into raid mode.
+
+    :param members: ids of the joined members
+    :param service_msg: id of the join service message
+
+    :return: (RaidState, True if this call started the raid), or
+        (None, False) when the chat isn't raided
+    """
+    now = now or time.time()
+    with RAID_LOCK:
+        raid = RAID_CHATS.get(chat.id)
+        started = False
+        if raid is None:
+            times = JOIN_TIMES.setdefault(chat.id, deque())
+            times.extend([now] * len(members))
+            while times and times[0] <= now - RAID_WINDOW:
+                times.popleft()
+            if len(times) < RAID_JOINS:
+                return None, False
+            del JOIN_TIMES[chat.id]
+            raid = RAID_CHATS[chat.id] = RaidState(chat, now)
+            started = True
+        raid.last_join = now
+        raid.joins += len(members)
+        raid.pending.extend(members)
+        if service_msg:
+            raid.service_msgs.append(service_msg)
+        return raid, started
+
+
+def take_pending(raid: RaidState):
+    """:return: (members, service message ids) recorded since last call"""
+    with RAID_LOCK:
+        members, raid.pending = raid.pending, []
+        service_msgs, raid.service_msgs = raid.service_msgs, []
+        return members, service_msgs
+
+
+def active_raids() -> List[RaidState]:
+    with RAID_LOCK:
+        return list(RAID_CHATS.values())
+
+
+def end_raid_if_quiet(raid: RaidState, now=None) -> bool:
+    """Take the chat out of raid mode if nobody joined for RAID_QUIET."""
+    now = now or time.time()
+    with RAID_LOCK:
+        if raid.pending or now - raid.last_join < RAID_QUIET:
+            return False
+        RAID_CHATS.pop(raid.chat.id, None)
+        return True
+
+
+def end_raid(raid: RaidState):
+    """Take the chat out of raid mode now, dropping what's pending."""
+    with RAID_LOCK:
+        RAID_CHATS.pop(raid.chat.id, None)
+
+
+def forget_quiet_chats(now=None):
+    """Drop join counters of chats with no join in the last window."""
+    now = now or time.time()
+    with RAID_LOCK:
+        for chat_id in [
+            k
+            for k, v in JOIN_TIMES.items()
+            if not v or v[-1] <= now - RAID_WINDOW
+        ]:
+            del JOIN_TIMES[chat_id]
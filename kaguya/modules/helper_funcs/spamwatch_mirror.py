@@ -0,0 +1,98 @@
+import os
+import threading
+from typing import Optional
+
+from kaguya import LOGGER, SPAMWATCH_SNAPSHOT, spamwtc
+from kaguya.modules.helper_funcs.intset import IntSet
+from kaguya.mwt import TTLCache
+
+SW_SYNC_INTERVAL = 60 * 60
+
+# ids banned on SpamWatch as of the last sync, replaced as a whole so
+# readers never need the lock
+SW_BANNED = IntSet()
+SW_SYNC_LOCK = threading.Lock()
+
+# single user lookups: the Ban, or False when the user isn't banned
+SW_LOOKUPS = TTLCache(timeout=60 * 30, maxsize=10000)
+
+
+def is_sw_banned(user_id) -> bool:
+    """Check the local mirror, never touches the network."""
+    return user_id in SW_BANNED
+
+
+def get_sw_reason(user_id) -> Optional[str]:
+    """Ban reason if an earlier online lookup already fetched it."""
+    ban = SW_LOOKUPS.get(int(user_id))
+    if ban:
+        return ban.reason
+    return None
+
+
+def lookup_sw_ban(user_id):
+    """
+    Fetch a single user's ban from the SpamWatch API, for commands that
+    want the details. Answers, including "not banned", are cached.
+
+    :return: the Ban, or False when not banned or SpamWatch isn't set up
+    """
+    if spamwtc is None:
+        return False
+
+    user_id = int(user_id)
+
+    def load():
+        return spamwtc.get_ban(user_id) or False
+
+    try:
+        return SW_LOOKUPS.get_or_load(user_id, load)
+    except Exception:
+        LOGGER.warning("SpamWatch lookup for %d failed", user_id)
+        return False
+
+
+def set_sw_banned(user_ids):
+    global SW_BANNED
+    SW_BANNED = IntSet(user_ids)
+    # the bulk list is newer than any cached single lookup
+    SW_LOOKUPS.clear()
+
+
+def load_sw_snapshot(path=SPAMWATCH_SNAPSHOT) -> bool:
+    if not path or not os.path.isfile(path):
+        return False
+    with open(path) as snapshot:
+        set_sw_banned(int(x) for x in snapshot if x.strip())
+    LOGGER.info("Loaded %d SpamWatch bans from %s", len(SW_BANNED), path)
+    return True
+
+
+def save_sw_snapshot(path=SPAMWATCH_SNAPSHOT):
+    if not path:
+        return
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as snapshot:
+        snapshot.write("\n".join(str(x) for x in SW_BANNED))
+    os.replace(tmp_path, path)
+
+
+def sync_spamwatch(context=None):
+    """Replace the mirror with SpamWatch's full ban list."""
+    if spamwtc is None:
+        return
+    with SW_SYNC_LOCK:
+        try:
+            user_ids = spamwtc.get_bans_min()
+        except Exception:
+            LOGGER.exception("Failed to sync the SpamWatch ban list")
+            return
+        set_sw_banned(user_ids)
+        LOGGER.info("Synced %d SpamWatch bans", len(SW_BANNED))
+        try:
+            save_sw_snapshot()
+        except OSError:
+            LOGGER.exception("Failed to save the SpamWatch snapshot")
+
+
+load_sw_snapshot()
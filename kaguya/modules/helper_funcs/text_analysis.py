@@ -0,0 +1,66 @@
+from typing import List, Optional, Tuple
+
+from telegram import Message, MessageEntity, Update
+
+from kaguya.modules.helper_funcs.extraction import extract_text
+from kaguya.modules.helper_funcs.matcher import casefold_text
+from kaguya.modules.users import get_user_id
+
+# runs before every other handler group, see kaguya/__main__.py
+ANALYSIS_GROUP = -1
+
+
+class MessageAnalysis(object):
+    """
+    Text derived from a message, computed once and shared by every keyword
+    driven handler that sees the same update.
+    """
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.text = extract_text(message) or ""
+        self.lowered = self.text.lower()
+        self.normalized = casefold_text(self.text)
+        self.tokens = self.lowered.split()
+        if message.text:
+            self.entities = message.parse_entities()
+        elif message.caption:
+            self.entities = message.parse_caption_entities()
+        else:
+            self.entities = {}
+        self._mentions = None
+
+    def __bool__(self):
+        return bool(self.text)
+
+    @property
+    def mentions(self) -> List[Tuple[Optional[int], Optional[str]]]:
+        """
+        (user_id, first_name) pairs for the user mentions in the message.
+
+        @username mentions are resolved from the users table and have no
+        first name; user_id is None when the username is unknown.
+        """
+        if self._mentions is None:
+            mentions = []
+            for ent, ent_text in self.entities.items():
+                if ent.type == MessageEntity.TEXT_MENTION:
+                    mentions.append((ent.user.id, ent.user.first_name))
+                elif ent.type == MessageEntity.MENTION:
+                    mentions.append((get_user_id(ent_text), None))
+            self._mentions = mentions
+        return self._mentions
+
+
+def get_analysis(update: Update) -> MessageAnalysis:
+    analysis = getattr(update, "_analysis", None)
+    if analysis is None:
+        analysis = update._analysis = MessageAnalysis(update.effective_message)
+    return analysis
+
+
+def analyze_update(update, context):
+    # build the analysis in the dispatcher thread, before any async handler
+    # of a later group can race to build its own copy
+    if update.effective_message:
+        get_analysis(update)
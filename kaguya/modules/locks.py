@@ -14,7 +14,6 @@ from kaguya.modules.disable import DisableAbleCommandHandler
 from kaguya.modules.helper_funcs.chat_status import (
     can_delete,
     is_user_admin,
-    user_not_admin,
     is_bot_admin,
     user_admin,
 )
@@ -379,103 +378,70 @@ def unlock(update, context) -> str:
     return ""
 
 
-@user_not_admin
 def del_lockables(update, context):
     chat = update.effective_chat  # type: Optional[Chat]
     message = update.effective_message  # type: Optional[Message]
+    user = update.effective_user  # type: Optional[User]
+
+    # checked before the admin status so unlocked chats cost nothing
+    locked = sql.get_lock_bitmap(chat.id)
+    if not locked:
+        return
+    if not user or is_user_admin(chat, user.id):
+        return
 
     for lockable, filter in LOCK_TYPES.items():
-        if lockable == "rtl":
-            if sql.is_locked(chat.id, lockable) and can_delete(
-                chat, context.bot.id
-            ):
-                if message.caption:
-                    check = ad.detect_alphabet(u"{}".format(message.caption))
-                    if "ARABIC" in check:
-                        try:
-                            message.delete()
-                        except BadRequest as excp:
-                            if excp.message == "Message to delete not found":
-                                pass
-                            else:
-                                LOGGER.exception("ERROR in lockables")
-                        break
-                if message.text:
-                    check = ad.detect_alphabet(u"{}".format(message.text))
-                    if "ARABIC" in check:
-                        try:
-                            message.delete()
-                        except BadRequest as excp:
-                            if excp.message == "Message to delete not found":
-                                pass
-                            else:
-                                LOGGER.exception("ERROR in lockables")
-                        break
+        if not locked & sql.LOCK_BITS[lockable]:
             continue
-        if lockable == "button":
-            if sql.is_locked(chat.id, lockable) and can_delete(
-                chat, context.bot.id
-            ):
-                if (
-                    message.reply_markup
-                    and message.reply_markup.inline_keyboard
-                ):
-                    try:
-                        message.delete()
-                    except BadRequest as excp:
-                        if excp.message == "Message to delete not found":
-                            pass
-                        else:
-                            LOGGER.exception("ERROR in lockables")
-                    break
-            continue
-        if lockable == "inline":
-            if sql.is_locked(chat.id, lockable) and can_delete(
-                chat, context.bot.id
-            ):
-                if message and message.via_bot:
-                    try:
-                        message.delete()
-                    except BadRequest as excp:
-                        if excp.message == "Message to delete not found":
-                            pass
-                        else:
-                            LOGGER.exception("ERROR in lockables")
-                    break
+
+        if lockable == "rtl":
+            matched = any(
+                "ARABIC" in ad.detect_alphabet("{}".format(text))
+                for text in (message.caption, message.text)
+                if text
+            )
+        elif lockable == "button":
+            matched = bool(
+                message.reply_markup and message.reply_markup.inline_keyboard
+            )
+        elif lockable == "inline":
+            matched = bool(message.via_bot)
+        else:
+            matched = filter(update)
+
+        if not matched:
             continue
-        if (
-            filter(update)
-            and sql.is_locked(chat.id, lockable)
-            and can_delete(chat, context.bot.id)
-        ):
-            if lockable == "bots":
-                new_members = update.effective_message.new_chat_members
-                for new_mem in new_members:
-                    if new_mem.is_bot:
-                        if not is_bot_admin(chat, context.bot.id):
-                            send_message(
-                                update.effective_message,
-                                "I see a bot and I've been told to stop them from joining..."
-                                "but I'm not admin!",
-                            )
-                            return
-
-                        chat.kick_member(new_mem.id)
+        if not can_delete(chat, context.bot.id):
+            return
+
+        if lockable == "bots":
+            new_members = update.effective_message.new_chat_members
+            for new_mem in new_members:
+                if new_mem.is_bot:
+                    if not is_bot_admin(chat, context.bot.id):
                         send_message(
                             update.effective_message,
-                            "Only admins are allowed to add bots in this chat! Get outta here.",
+                            "I see a bot and I've been told to stop them from joining..."
+                            "but I'm not admin!",
                         )
-                        break
-            else:
-                try:
-                    message.delete()
-                except BadRequest as excp:
-                    if excp.message == "Message to delete not found":
-                        pass
-                    else:
-                        LOGGER.exception("ERROR in lockables")
-
-                break
+                        return
+
+                    chat.kick_member(new_mem.id)
+                    send_message(
+                        update.effective_message,
+                        "Only admins are allowed to add bots in this chat! Get outta here.",
+                    )
+                    break
+        else:
+            try:
+                message.delete()
+            except BadRequest as excp:
+                if excp.message == "Message to delete not found":
+                    pass
+                else:
+                    LOGGER.exception("ERROR in lockables")
+
+        break
 
 
 def build_lock_message(chat_id):
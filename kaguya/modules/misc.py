@@ -30,13 +30,21 @@ from kaguya import (
     SUPPORT_USERS,
     WHITELIST_USERS,
     WALL_API,
-    spamwtc,
+    EXECUTOR,
 )
 from kaguya.__main__ import STATS, USER_INFO, GDPR
 from kaguya.modules.disable import DisableAbleCommandHandler
 from kaguya.modules.helper_funcs.extraction import extract_user
 from kaguya.modules.helper_funcs.filters import CustomFilters
 from kaguya.modules.helper_funcs.alternate import typing_action, send_action
+from kaguya.modules.helper_funcs.spamwatch_mirror import lookup_sw_ban
+from kaguya.modules.helper_funcs.query_stats import (
+    STATEMENT_BUCKETS,
+    SLOW_QUERIES,
+    get_handler_stats,
+    get_update_stats,
+    reset_stats,
+)
 
 
 @typing_action
@@ -132,15 +140,10 @@ def info(update, context):
         context.bot.get_user_profile_photos(user.id).total_count
     )
 
-    try:
-        sw = spamwtc.get_ban(int(user.id))
-        if sw:
-            text += "\n\n<b>This person is banned in Spamwatch!</b>"
-            text += f"\nResason: <pre>{sw.reason}</pre>"
-        else:
-            pass
-    except:
-        pass  # Don't break on exceptions like if api is down?
+    sw = lookup_sw_ban(user.id)
+    if sw:
+        text += "\n\n<b>This person is banned in Spamwatch!</b>"
+        text += f"\nResason: <pre>{sw.reason}</pre>"
 
     if user.id == OWNER_ID:
         text += "\n\nAye this guy is my owner.\nI would never do anything against him!"
@@ -490,11 +493,88 @@ def staff_ids(update, context):
 
 
 def stats(update, context):
+    shards = "\n".join(
+        "× Shard {shard}: {depth} queued, {handled} handled, "
+        "{avg_ms:.1f}ms avg / {max_ms:.1f}ms max latency".format(**x)
+        for x in EXECUTOR.stats()
+    )
     update.effective_message.reply_text(
-        "Current stats:\n" + "\n".join([mod.__stats__() for mod in STATS])
+        "Current stats:\n"
+        + "\n".join([mod.__stats__() for mod in STATS])
+        + "\n"
+        + shards
     )
 
 
+def dbstats(update, context):
+    msg = update.effective_message
+    if context.args and context.args[0].lower() == "reset":
+        reset_stats()
+        msg.reply_text("Query stats reset.")
+        return
+
+    handlers = get_handler_stats()
+    updates = get_update_stats()
+    if not handlers and not updates.calls:
+        msg.reply_text("No queries recorded yet.")
+        return
+
+    labels = ["{}".format(x) for x in STATEMENT_BUCKETS] + [
+        ">{}".format(STATEMENT_BUCKETS[-1])
+    ]
+    text = ""
+    if updates.calls:
+        hist = ", ".join(
+            "{}: {}".format(label, count)
+            for label, count in zip(labels, updates.statement_hist)
+            if count
+        )
+        text += (
+            "Per update, over all handler groups: {} updates, {:.1f} "
+            "queries and {:.1f}ms avg, slowest query {:.1f}ms\n"
+            "× queries per update: {}\n\n"
+        ).format(
+            updates.calls,
+            updates.statements / updates.calls,
+            updates.db_time * 1000 / updates.calls,
+            updates.slowest * 1000,
+            hist,
+        )
+
+    text += "Top handlers by database time:\n"
+    for name, x in sorted(
+        handlers.items(), key=lambda x: x[1].db_time, reverse=True
+    )[:10]:
+        text += "× {}: {} calls, {:.1f}ms/call, slowest {:.1f}ms\n".format(
+            name, x.calls, x.db_time * 1000 / x.calls, x.slowest * 1000
+        )
+
+    text += "\nTop handlers by queries per call:\n"
+    for name, x in sorted(
+        handlers.items(),
+        key=lambda x: x[1].statements / x[1].calls,
+        reverse=True,
+    )[:5]:
+        hist = ", ".join(
+            "{}: {}".format(label, count)
+            for label, count in zip(labels, x.statement_hist)
+            if count
+        )
+        text += "× {}: {:.1f} avg ({})\n".format(
+            name, x.statements / x.calls, hist
+        )
+
+    slow = list(SLOW_QUERIES)[-5:]
+    if slow:
+        text += "\nLast slow queries:\n"
+        for _, elapsed, handler, caller, statement in reversed(slow):
+            text += "× {:.0f}ms {} in {}: {}\n".format(
+                elapsed * 1000, caller, handler, statement[:150]
+            )
+
+    msg.reply_text(text)
+
+
 # /ip is for private use
 __help__ = """
 An "odds and ends" module for small, simple commands which don't really fit anywhere
@@ -519,6 +599,9 @@ MD_HELP_HANDLER = CommandHandler(
     "markdownhelp", markdown_help, filters=Filters.private
 )
 STATS_HANDLER = CommandHandler("stats", stats, filters=Filters.user(OWNER_ID))
+DBSTATS_HANDLER = CommandHandler(
+    "dbstats", dbstats, filters=Filters.user(OWNER_ID)
+)
 GDPR_HANDLER = CommandHandler("gdpr", gdpr, filters=Filters.private)
 WIKI_HANDLER = DisableAbleCommandHandler("wiki", wiki)
 WALLPAPER_HANDLER = DisableAbleCommandHandler("wall", wall, pass_args=True)
@@ -539,6 +622,7 @@ dispatcher.add_handler(INFO_HANDLER)
 dispatcher.add_handler(ECHO_HANDLER)
 dispatcher.add_handler(MD_HELP_HANDLER)
 dispatcher.add_handler(STATS_HANDLER)
+dispatcher.add_handler(DBSTATS_HANDLER)
 dispatcher.add_handler(GDPR_HANDLER)
 dispatcher.add_handler(WIKI_HANDLER)
 dispatcher.add_handler(GETLINK_HANDLER)
@@ -1,20 +1,21 @@
-from kaguya import client, SUDO_USERS
+from kaguya import client, dispatcher, SUDO_USERS
+from kaguya.modules.helper_funcs.chat_status import get_admin_roster
 
 import asyncio
 from telethon import events
-from telethon.tl.types import ChannelParticipantsAdmins
 from telethon.errors.rpcerrorlist import MessageDeleteForbiddenError
 
+
 # Check if user has admin rights
 async def is_administrator(user_id: int, message):
-    admin = False
-    async for user in client.iter_participants(
-        message.chat_id, filter=ChannelParticipantsAdmins
-    ):
-        if user_id == user.id or user_id in SUDO_USERS:
-            admin = True
-            break
-    return admin
+    if user_id in SUDO_USERS:
+        return True
+    # shares the cached roster of the bot api side; a miss does one blocking
+    # request, so keep it off the event loop
+    roster = await asyncio.get_event_loop().run_in_executor(
+        None, get_admin_roster, dispatcher.bot, message.chat_id
+    )
+    return user_id in roster
 
 
 @client.on(events.NewMessage(pattern="^/purge"))
@@ -22,7 +23,7 @@ async def purge(event):
     chat = event.chat_id
     msgs = []
 
-    if not await is_administrator(user_id=event.from_id, message=event):
+    if not await is_administrator(user_id=event.sender_id, message=event):
         await event.reply("You're not an admin!")
         return
 
@@ -65,7 +66,7 @@ async def purge(event):
 @client.on(events.NewMessage(pattern="^/del$"))
 async def delete_msg(event):
 
-    if not await is_administrator(user_id=event.from_id, message=event):
+    if not await is_administrator(user_id=event.sender_id, message=event):
         await event.reply("You're not an admin!")
         return
 
@@ -13,7 +13,11 @@ from telegram.ext import (
 from telegram.utils.helpers import mention_html
 
 from kaguya import dispatcher, LOGGER
-from kaguya.modules.helper_funcs.chat_status import user_not_admin, user_admin
+from kaguya.modules.helper_funcs.chat_status import (
+    user_not_admin,
+    user_admin,
+    get_admin_roster,
+)
 from kaguya.modules.helper_funcs.alternate import typing_action
 from kaguya.modules.log_channel import loggable
 from kaguya.modules.sql import reporting_sql as sql
@@ -85,11 +89,11 @@ def report(update, context) -> str:
             message.reply_to_message.from_user
         )  # type: Optional[User]
         chat_name = chat.title or chat.first or chat.username
-        admin_list = chat.get_administrators()
+        admin_roster = get_admin_roster(context.bot, chat.id)
+        admin_list = admin_roster.values()
         messages = update.effective_message
 
-        isadmeme = chat.get_member(reported_user.id).status
-        if isadmeme == "administrator" or isadmeme == "creator":
+        if reported_user.id in admin_roster:
             return ""  # No point of reporting admins!
 
         if user.id == reported_user.id:
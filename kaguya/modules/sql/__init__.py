@@ -1,16 +1,69 @@
+import threading
+from contextlib import contextmanager
+
+import sqlalchemy
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
 
-from kaguya import DB_URI
+from kaguya import (
+    DB_URI,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_RECYCLE,
+    DB_QUERY_CACHE,
+)
+from kaguya.modules.helper_funcs.query_stats import instrument_engine
 
 
 def start() -> scoped_session:
-    engine = create_engine(DB_URI, client_encoding="utf8")
+    kwargs = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_recycle": DB_POOL_RECYCLE,
+        # replace connections the server dropped, eg. on a restart, before
+        # handing them out instead of failing the query
+        "pool_pre_ping": True,
+    }
+    # older versions have no compiled statement cache
+    if tuple(map(int, sqlalchemy.__version__.split(".")[:2])) >= (1, 4):
+        kwargs["query_cache_size"] = DB_QUERY_CACHE
+    engine = create_engine(DB_URI, client_encoding="utf8", **kwargs)
+    instrument_engine(engine)
     BASE.metadata.bind = engine
     BASE.metadata.create_all(engine)
-    return scoped_session(sessionmaker(bind=engine, autoflush=False))
+    # objects stay readable after their session is closed by session_scope
+    return scoped_session(
+        sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    )
 
 
 BASE = declarative_base()
 SESSION = start()
+
+SCOPE_DEPTH = threading.local()
+
+
+@contextmanager
+def session_scope(commit=False):
+    """
+    The calling thread's session, closed again when the outermost scope
+    exits so its connection goes back to the pool. Scopes nest, eg. when
+    a *_sql function calls another one.
+
+    :param commit: commit on the way out; on an error everything is rolled
+        back instead
+    """
+    depth = getattr(SCOPE_DEPTH, "value", 0)
+    SCOPE_DEPTH.value = depth + 1
+    try:
+        yield SESSION
+        if commit:
+            SESSION.commit()
+    except BaseException:
+        SESSION.rollback()
+        raise
+    finally:
+        SCOPE_DEPTH.value = depth
+        if not depth:
+            SESSION.close()
@@ -2,7 +2,7 @@ import threading
 
 from sqlalchemy import Column, UnicodeText, Boolean, Integer
 
-from kaguya.modules.sql import BASE, SESSION
+from kaguya.modules.sql import BASE, session_scope
 
 
 class AFK(BASE):
@@ -38,8 +38,8 @@ def check_afk_status(user_id):
 
 
 def set_afk(user_id, reason=""):
-    with INSERTION_LOCK:
-        curr = SESSION.query(AFK).get(user_id)
+    with INSERTION_LOCK, session_scope(commit=True) as session:
+        curr = session.query(AFK).get(user_id)
         if not curr:
             curr = AFK(user_id, reason, True)
         else:
@@ -48,34 +48,29 @@ def set_afk(user_id, reason=""):
 
         AFK_USERS[user_id] = reason
 
-        SESSION.add(curr)
-        SESSION.commit()
+        session.add(curr)
 
 
 def rm_afk(user_id):
-    with INSERTION_LOCK:
-        curr = SESSION.query(AFK).get(user_id)
+    with INSERTION_LOCK, session_scope(commit=True) as session:
+        curr = session.query(AFK).get(user_id)
         if curr:
             if user_id in AFK_USERS:  # sanity check
                 del AFK_USERS[user_id]
 
-            SESSION.delete(curr)
-            SESSION.commit()
+            session.delete(curr)
             return True
 
-        SESSION.close()
         return False
 
 
 def __load_afk_users():
     global AFK_USERS
-    try:
-        all_afk = SESSION.query(AFK).all()
+    with session_scope() as session:
+        all_afk = session.query(AFK).all()
         AFK_USERS = {
             user.user_id: user.reason for user in all_afk if user.is_afk
         }
-    finally:
-        SESSION.close()
 
 
 __load_afk_users()
@@ -2,7 +2,7 @@ import threading
 
 from sqlalchemy import String, Column, Integer, UnicodeText
 
-from kaguya.modules.sql import SESSION, BASE
+from kaguya.modules.sql import BASE, session_scope
 
 DEF_COUNT = 0
 DEF_LIMIT = 0
@@ -50,8 +50,8 @@ CHAT_FLOOD = {}
 
 
 def set_flood(chat_id, amount):
-    with INSERTION_FLOOD_LOCK:
-        flood = SESSION.query(FloodControl).get(str(chat_id))
+    with INSERTION_FLOOD_LOCK, session_scope(commit=True) as session:
+        flood = session.query(FloodControl).get(str(chat_id))
         if not flood:
             flood = FloodControl(str(chat_id))
 
@@ -60,11 +60,12 @@ def set_flood(chat_id, amount):
 
         CHAT_FLOOD[str(chat_id)] = (None, DEF_COUNT, amount)
 
-        SESSION.add(flood)
-        SESSION.commit()
+        session.add(flood)
 
 
 def update_flood(chat_id: str, user_id) -> bool:
+    # no lock: a chat's messages are all handled on the same shard thread,
+    # one at a time, see kaguya.sharding
     if str(chat_id) in CHAT_FLOOD:
         curr_user_id, count, limit = CHAT_FLOOD.get(str(chat_id), DEF_OBJ)
 
@@ -96,8 +97,8 @@ def set_flood_strength(chat_id, flood_type, value):
     # 3 = mute
     # 4 = tban
     # 5 = tmute
-    with INSERTION_FLOOD_SETTINGS_LOCK:
-        curr_setting = SESSION.query(FloodSettings).get(str(chat_id))
+    with INSERTION_FLOOD_SETTINGS_LOCK, session_scope(commit=True) as session:
+        curr_setting = session.query(FloodSettings).get(str(chat_id))
         if not curr_setting:
             curr_setting = FloodSettings(
                 chat_id, flood_type=int(flood_type), value=value
@@ -106,44 +107,35 @@ def set_flood_strength(chat_id, flood_type, value):
         curr_setting.flood_type = int(flood_type)
         curr_setting.value = str(value)
 
-        SESSION.add(curr_setting)
-        SESSION.commit()
+        session.add(curr_setting)
 
 
 def get_flood_setting(chat_id):
-    try:
-        setting = SESSION.query(FloodSettings).get(str(chat_id))
+    with session_scope() as session:
+        setting = session.query(FloodSettings).get(str(chat_id))
         if setting:
             return setting.flood_type, setting.value
         else:
             return 1, "0"
 
-    finally:
-        SESSION.close()
-
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with INSERTION_FLOOD_LOCK:
-        flood = SESSION.query(FloodControl).get(str(old_chat_id))
+    with INSERTION_FLOOD_LOCK, session_scope(commit=True) as session:
+        flood = session.query(FloodControl).get(str(old_chat_id))
         if flood:
             CHAT_FLOOD[str(new_chat_id)] = CHAT_FLOOD.get(
                 str(old_chat_id), DEF_OBJ
             )
             flood.chat_id = str(new_chat_id)
-            SESSION.commit()
-
-        SESSION.close()
 
 
 def __load_flood_settings():
     global CHAT_FLOOD
-    try:
-        all_chats = SESSION.query(FloodControl).all()
+    with session_scope() as session:
+        all_chats = session.query(FloodControl).all()
         CHAT_FLOOD = {
             chat.chat_id: (None, DEF_COUNT, chat.limit) for chat in all_chats
         }
-    finally:
-        SESSION.close()
 
 
 __load_flood_settings()
@@ -0,0 +1,83 @@
+"""
+Measure how many queries per second the SQL layer sustains with 1, 8 and
+32 threads calling it at once, the way handler threads do:
+
+    python3 -m kaguya.modules.sql.benchmark [--seconds 10] [--threads 1,8,32]
+
+Only reads keyed by a chat or user are run, so it's safe against the live
+database; the ids used don't exist, which still costs a full round trip.
+"""
+
+import argparse
+import threading
+import time
+
+from kaguya.modules.sql import (
+    session_scope,
+    reporting_sql,
+    rules_sql,
+    userinfo_sql,
+    warns_sql,
+)
+
+CHAT_ID = -1001000000000
+USER_ID = 1
+
+# one uncached primary key lookup each, like most handlers do per update
+QUERIES = (
+    lambda: rules_sql.get_rules(CHAT_ID),
+    lambda: warns_sql.get_warns(USER_ID, CHAT_ID),
+    lambda: reporting_sql.chat_should_report(CHAT_ID),
+    lambda: userinfo_sql.get_user_bio(USER_ID),
+)
+
+
+def run(threads, seconds):
+    """:return: (queries done, slowest query in seconds)"""
+    deadline = time.monotonic() + seconds
+    counts = [0] * threads
+    slowest = [0.0] * threads
+
+    def worker(index):
+        while time.monotonic() < deadline:
+            for query in QUERIES:
+                start = time.perf_counter()
+                query()
+                slowest[index] = max(
+                    slowest[index], time.perf_counter() - start
+                )
+            counts[index] += len(QUERIES)
+
+    workers = [
+        threading.Thread(target=worker, args=(x,)) for x in range(threads)
+    ]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return sum(counts), max(slowest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--threads", default="1,8,32")
+    args = parser.parse_args()
+
+    with session_scope() as session:
+        pool = session.get_bind().pool
+    # fill the pool first so opening connections isn't measured
+    run(max(int(x) for x in args.threads.split(",")), 1)
+    print("{:>8} {:>10} {:>10}".format("threads", "qps", "max ms"))
+    for threads in (int(x) for x in args.threads.split(",")):
+        queries, slowest = run(threads, args.seconds)
+        print(
+            "{:>8} {:>10.0f} {:>10.1f}".format(
+                threads, queries / args.seconds, slowest * 1000
+            )
+        )
+    print(pool.status())
+
+
+if __name__ == "__main__":
+    main()
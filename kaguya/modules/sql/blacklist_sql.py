@@ -2,7 +2,13 @@ import threading
 
 from sqlalchemy import func, distinct, Column, String, UnicodeText, Integer
 
-from kaguya.modules.sql import SESSION, BASE
+from kaguya.modules.helper_funcs.matcher import (
+    WILDCARD_PREFIX,
+    KeywordMatcher,
+    casefold_text,
+    wildcard_anchor,
+)
+from kaguya.modules.sql import BASE, session_scope
 
 
 class BlackListFilters(BASE):
@@ -49,70 +55,96 @@ BLACKLIST_FILTER_INSERTION_LOCK = threading.RLock()
 BLACKLIST_SETTINGS_INSERTION_LOCK = threading.RLock()
 
 CHAT_BLACKLISTS = {}
+CHAT_BLACKLIST_MATCHERS = {}
 CHAT_SETTINGS_BLACKLISTS = {}
 
 
 def add_to_blacklist(chat_id, trigger):
+    # a wildcard trigger with nothing literal in it matches every message
+    if trigger.startswith(WILDCARD_PREFIX) and not wildcard_anchor(
+        trigger[len(WILDCARD_PREFIX) :]
+    ):
+        return False
+
     with BLACKLIST_FILTER_INSERTION_LOCK:
         blacklist_filt = BlackListFilters(str(chat_id), trigger)
 
-        SESSION.merge(blacklist_filt)  # merge to avoid duplicate key issues
-        SESSION.commit()
+        # merge to avoid duplicate key issues
+        with session_scope(commit=True) as session:
+            session.merge(blacklist_filt)
         global CHAT_BLACKLISTS
         if CHAT_BLACKLISTS.get(str(chat_id), set()) == set():
             CHAT_BLACKLISTS[str(chat_id)] = {trigger}
         else:
             CHAT_BLACKLISTS.get(str(chat_id), set()).add(trigger)
+        CHAT_BLACKLIST_MATCHERS.pop(str(chat_id), None)
+        return True
 
 
 def rm_from_blacklist(chat_id, trigger):
     with BLACKLIST_FILTER_INSERTION_LOCK:
-        blacklist_filt = SESSION.query(BlackListFilters).get(
-            (str(chat_id), trigger)
-        )
-        if blacklist_filt:
-            if trigger in CHAT_BLACKLISTS.get(
-                str(chat_id), set()
-            ):  # sanity check
-                CHAT_BLACKLISTS.get(str(chat_id), set()).remove(trigger)
+        with session_scope(commit=True) as session:
+            blacklist_filt = session.query(BlackListFilters).get(
+                (str(chat_id), trigger)
+            )
+            if blacklist_filt:
+                if trigger in CHAT_BLACKLISTS.get(
+                    str(chat_id), set()
+                ):  # sanity check
+                    CHAT_BLACKLISTS.get(str(chat_id), set()).remove(trigger)
+                    CHAT_BLACKLIST_MATCHERS.pop(str(chat_id), None)
 
-            SESSION.delete(blacklist_filt)
-            SESSION.commit()
-            return True
+                session.delete(blacklist_filt)
+                return True
 
-        SESSION.close()
-        return False
+            return False
 
 
 def get_chat_blacklist(chat_id):
     return CHAT_BLACKLISTS.get(str(chat_id), set())
 
 
+def get_chat_blacklist_matcher(chat_id):
+    matcher = CHAT_BLACKLIST_MATCHERS.get(str(chat_id))
+    if matcher is None:
+        with BLACKLIST_FILTER_INSERTION_LOCK:
+            matcher = CHAT_BLACKLIST_MATCHERS[str(chat_id)] = KeywordMatcher(
+                sorted(
+                    CHAT_BLACKLISTS.get(str(chat_id), set()),
+                    key=lambda x: (-len(x), x),
+                ),
+                normalize=casefold_text,
+                wildcards=True,
+            )
+    return matcher
+
+
+def match_blacklist(chat_id, text):
+    # text is expected casefolded already, see MessageAnalysis.normalized
+    if not CHAT_BLACKLISTS.get(str(chat_id)):
+        return None
+    return get_chat_blacklist_matcher(chat_id).search(text, normalized=True)
+
+
 def num_blacklist_filters():
-    try:
-        return SESSION.query(BlackListFilters).count()
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(BlackListFilters).count()
 
 
 def num_blacklist_chat_filters(chat_id):
-    try:
+    with session_scope() as session:
         return (
-            SESSION.query(BlackListFilters.chat_id)
+            session.query(BlackListFilters.chat_id)
             .filter(BlackListFilters.chat_id == str(chat_id))
             .count()
         )
-    finally:
-        SESSION.close()
 
 
 def num_blacklist_filter_chats():
-    try:
-        return SESSION.query(
+    with session_scope() as session:
+        return session.query(
             func.count(distinct(BlackListFilters.chat_id))
         ).scalar()
-    finally:
-        SESSION.close()
 
 
 def set_blacklist_strength(chat_id, blacklist_type, value):
@@ -125,78 +157,74 @@ def set_blacklist_strength(chat_id, blacklist_type, value):
     # 5 = ban
     # 6 = tban
     # 7 = tmute
+    global CHAT_SETTINGS_BLACKLISTS
     with BLACKLIST_SETTINGS_INSERTION_LOCK:
-        global CHAT_SETTINGS_BLACKLISTS
-        curr_setting = SESSION.query(BlacklistSettings).get(str(chat_id))
-        if not curr_setting:
-            curr_setting = BlacklistSettings(
-                chat_id, blacklist_type=int(blacklist_type), value=value
-            )
-
-        curr_setting.blacklist_type = int(blacklist_type)
-        curr_setting.value = str(value)
-        CHAT_SETTINGS_BLACKLISTS[str(chat_id)] = {
-            "blacklist_type": int(blacklist_type),
-            "value": value,
-        }
+        with session_scope(commit=True) as session:
+            curr_setting = session.query(BlacklistSettings).get(str(chat_id))
+            if not curr_setting:
+                curr_setting = BlacklistSettings(
+                    chat_id, blacklist_type=int(blacklist_type), value=value
+                )
+
+            curr_setting.blacklist_type = int(blacklist_type)
+            curr_setting.value = str(value)
+            CHAT_SETTINGS_BLACKLISTS[str(chat_id)] = {
+                "blacklist_type": int(blacklist_type),
+                "value": value,
+            }
 
-        SESSION.add(curr_setting)
-        SESSION.commit()
+            session.add(curr_setting)
 
 
 def get_blacklist_setting(chat_id):
-    try:
-        setting = CHAT_SETTINGS_BLACKLISTS.get(str(chat_id))
-        if setting:
-            return setting["blacklist_type"], setting["value"]
-        else:
-            return 1, "0"
-
-    finally:
-        SESSION.close()
+    setting = CHAT_SETTINGS_BLACKLISTS.get(str(chat_id))
+    if setting:
+        return setting["blacklist_type"], setting["value"]
+    else:
+        return 1, "0"
 
 
 def __load_chat_blacklists():
     global CHAT_BLACKLISTS
-    try:
-        chats = SESSION.query(BlackListFilters.chat_id).distinct().all()
+    with session_scope() as session:
+        chats = session.query(BlackListFilters.chat_id).distinct().all()
         for (chat_id,) in chats:  # remove tuple by ( ,)
             CHAT_BLACKLISTS[chat_id] = []
 
-        all_filters = SESSION.query(BlackListFilters).all()
+        all_filters = session.query(BlackListFilters).all()
         for x in all_filters:
             CHAT_BLACKLISTS[x.chat_id] += [x.trigger]
 
         CHAT_BLACKLISTS = {x: set(y) for x, y in CHAT_BLACKLISTS.items()}
 
-    finally:
-        SESSION.close()
-
 
 def __load_chat_settings_blacklists():
     global CHAT_SETTINGS_BLACKLISTS
-    try:
-        chats_settings = SESSION.query(BlacklistSettings).all()
+    with session_scope() as session:
+        chats_settings = session.query(BlacklistSettings).all()
         for x in chats_settings:  # remove tuple by ( ,)
             CHAT_SETTINGS_BLACKLISTS[x.chat_id] = {
                 "blacklist_type": x.blacklist_type,
                 "value": x.value,
             }
 
-    finally:
-        SESSION.close()
-
 
 def migrate_chat(old_chat_id, new_chat_id):
     with BLACKLIST_FILTER_INSERTION_LOCK:
-        chat_filters = (
-            SESSION.query(BlackListFilters)
-            .filter(BlackListFilters.chat_id == str(old_chat_id))
-            .all()
-        )
-        for filt in chat_filters:
-            filt.chat_id = str(new_chat_id)
-        SESSION.commit()
+        with session_scope(commit=True) as session:
+            chat_filters = (
+                session.query(BlackListFilters)
+                .filter(BlackListFilters.chat_id == str(old_chat_id))
+                .all()
+            )
+            for filt in chat_filters:
+                filt.chat_id = str(new_chat_id)
+        if str(old_chat_id) in CHAT_BLACKLISTS:
+            CHAT_BLACKLISTS[str(new_chat_id)] = CHAT_BLACKLISTS.pop(
+                str(old_chat_id)
+            )
+        CHAT_BLACKLIST_MATCHERS.pop(str(old_chat_id), None)
+        CHAT_BLACKLIST_MATCHERS.pop(str(new_chat_id), None)
 
 
 __load_chat_blacklists()
@@ -4,7 +4,7 @@ from typing import Union
 
 from sqlalchemy import Column, String, Boolean, UnicodeText, Integer
 
-from kaguya.modules.sql import SESSION, BASE
+from kaguya.modules.sql import BASE, session_scope
 
 
 class ChatAccessConnectionSettings(BASE):
@@ -63,74 +63,64 @@ HISTORY_CONNECT = {}
 
 
 def allow_connect_to_chat(chat_id: Union[str, int]) -> bool:
-    try:
-        chat_setting = SESSION.query(ChatAccessConnectionSettings).get(
+    with session_scope() as session:
+        chat_setting = session.query(ChatAccessConnectionSettings).get(
             str(chat_id)
         )
         if chat_setting:
             return chat_setting.allow_connect_to_chat
         return False
-    finally:
-        SESSION.close()
 
 
 def set_allow_connect_to_chat(chat_id: Union[int, str], setting: bool):
-    with CHAT_ACCESS_LOCK:
-        chat_setting = SESSION.query(ChatAccessConnectionSettings).get(
+    with CHAT_ACCESS_LOCK, session_scope(commit=True) as session:
+        chat_setting = session.query(ChatAccessConnectionSettings).get(
             str(chat_id)
         )
         if not chat_setting:
             chat_setting = ChatAccessConnectionSettings(chat_id, setting)
 
         chat_setting.allow_connect_to_chat = setting
-        SESSION.add(chat_setting)
-        SESSION.commit()
+        session.add(chat_setting)
 
 
 def connect(user_id, chat_id):
-    with CONNECTION_INSERTION_LOCK:
-        prev = SESSION.query(Connection).get((int(user_id)))
+    with CONNECTION_INSERTION_LOCK, session_scope(commit=True) as session:
+        prev = session.query(Connection).get((int(user_id)))
         if prev:
-            SESSION.delete(prev)
+            session.delete(prev)
         connect_to_chat = Connection(int(user_id), chat_id)
-        SESSION.add(connect_to_chat)
-        SESSION.commit()
+        session.add(connect_to_chat)
         return True
 
 
 def get_connected_chat(user_id):
-    try:
-        return SESSION.query(Connection).get((int(user_id)))
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(Connection).get((int(user_id)))
 
 
 def curr_connection(chat_id):
-    try:
-        return SESSION.query(Connection).get((str(chat_id)))
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(Connection).get((str(chat_id)))
 
 
 def disconnect(user_id):
-    with CONNECTION_INSERTION_LOCK:
-        disconnect = SESSION.query(Connection).get((int(user_id)))
+    with CONNECTION_INSERTION_LOCK, session_scope(commit=True) as session:
+        disconnect = session.query(Connection).get((int(user_id)))
         if disconnect:
-            SESSION.delete(disconnect)
-            SESSION.commit()
+            session.delete(disconnect)
             return True
         else:
-            SESSION.close()
             return False
 
 
 def add_history_conn(user_id, chat_id, chat_name):
     global HISTORY_CONNECT
-    with CONNECTION_HISTORY_LOCK:
+    with CONNECTION_HISTORY_LOCK, session_scope(commit=True) as session:
         conn_time = int(time.time())
         if HISTORY_CONNECT.get(int(user_id)):
             counting = (
-                SESSION.query(ConnectionHistory.user_id)
+                session.query(ConnectionHistory.user_id)
                 .filter(ConnectionHistory.user_id == str(user_id))
                 .count()
             )
@@ -139,11 +129,11 @@ def add_history_conn(user_id, chat_id, chat_name):
                 getchat_id[HISTORY_CONNECT[int(user_id)][x]["chat_id"]] = x
             if chat_id in getchat_id:
                 todeltime = getchat_id[str(chat_id)]
-                delold = SESSION.query(ConnectionHistory).get(
+                delold = session.query(ConnectionHistory).get(
                     (int(user_id), str(chat_id))
                 )
                 if delold:
-                    SESSION.delete(delold)
+                    session.delete(delold)
                     HISTORY_CONNECT[int(user_id)].pop(todeltime)
             elif counting >= 5:
                 todel = list(HISTORY_CONNECT[int(user_id)])
@@ -151,24 +141,23 @@ def add_history_conn(user_id, chat_id, chat_name):
                 todel = todel[4:]
                 for x in todel:
                     chat_old = HISTORY_CONNECT[int(user_id)][x]["chat_id"]
-                    delold = SESSION.query(ConnectionHistory).get(
+                    delold = session.query(ConnectionHistory).get(
                         (int(user_id), str(chat_old))
                     )
                     if delold:
-                        SESSION.delete(delold)
+                        session.delete(delold)
                         HISTORY_CONNECT[int(user_id)].pop(x)
         else:
             HISTORY_CONNECT[int(user_id)] = {}
-        delold = SESSION.query(ConnectionHistory).get(
+        delold = session.query(ConnectionHistory).get(
             (int(user_id), str(chat_id))
         )
         if delold:
-            SESSION.delete(delold)
+            session.delete(delold)
         history = ConnectionHistory(
             int(user_id), str(chat_id), chat_name, conn_time
         )
-        SESSION.add(history)
-        SESSION.commit()
+        session.add(history)
         HISTORY_CONNECT[int(user_id)][conn_time] = {
             "chat_name": chat_name,
             "chat_id": str(chat_id),
@@ -184,22 +173,22 @@ def get_history_conn(user_id):
 def clear_history_conn(user_id):
     global HISTORY_CONNECT
     todel = list(HISTORY_CONNECT[int(user_id)])
-    for x in todel:
-        chat_old = HISTORY_CONNECT[int(user_id)][x]["chat_id"]
-        delold = SESSION.query(ConnectionHistory).get(
-            (int(user_id), str(chat_old))
-        )
-        if delold:
-            SESSION.delete(delold)
-            HISTORY_CONNECT[int(user_id)].pop(x)
-    SESSION.commit()
+    with session_scope(commit=True) as session:
+        for x in todel:
+            chat_old = HISTORY_CONNECT[int(user_id)][x]["chat_id"]
+            delold = session.query(ConnectionHistory).get(
+                (int(user_id), str(chat_old))
+            )
+            if delold:
+                session.delete(delold)
+                HISTORY_CONNECT[int(user_id)].pop(x)
     return True
 
 
 def __load_user_history():
     global HISTORY_CONNECT
-    try:
-        qall = SESSION.query(ConnectionHistory).all()
+    with session_scope() as session:
+        qall = session.query(ConnectionHistory).all()
         HISTORY_CONNECT = {}
         for x in qall:
             check = HISTORY_CONNECT.get(x.user_id)
@@ -209,8 +198,6 @@ def __load_user_history():
                 "chat_name": x.chat_name,
                 "chat_id": x.chat_id,
             }
-    finally:
-        SESSION.close()
 
 
 __load_user_history()
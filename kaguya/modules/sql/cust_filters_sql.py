@@ -10,8 +10,9 @@ from sqlalchemy import (
     func,
 )
 
+from kaguya.modules.helper_funcs.matcher import KeywordMatcher
 from kaguya.modules.helper_funcs.msg_types import Types
-from kaguya.modules.sql import BASE, SESSION
+from kaguya.modules.sql import BASE, session_scope
 
 
 class CustomFilters(BASE):
@@ -130,13 +131,12 @@ Buttons.__table__.create(checkfirst=True)
 CUST_FILT_LOCK = threading.RLock()
 BUTTON_LOCK = threading.RLock()
 CHAT_FILTERS = {}
+CHAT_MATCHERS = {}
 
 
 def get_all_filters():
-    try:
-        return SESSION.query(CustomFilters).all()
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(CustomFilters).all()
 
 
 def add_filter(
@@ -156,12 +156,12 @@ def add_filter(
     if buttons is None:
         buttons = []
 
-    with CUST_FILT_LOCK:
-        prev = SESSION.query(CustomFilters).get((str(chat_id), keyword))
+    with CUST_FILT_LOCK, session_scope(commit=True) as session:
+        prev = session.query(CustomFilters).get((str(chat_id), keyword))
         if prev:
             with BUTTON_LOCK:
                 prev_buttons = (
-                    SESSION.query(Buttons)
+                    session.query(Buttons)
                     .filter(
                         Buttons.chat_id == str(chat_id),
                         Buttons.keyword == keyword,
@@ -169,8 +169,8 @@ def add_filter(
                     .all()
                 )
                 for btn in prev_buttons:
-                    SESSION.delete(btn)
-            SESSION.delete(prev)
+                    session.delete(btn)
+            session.delete(prev)
 
         filt = CustomFilters(
             str(chat_id),
@@ -190,9 +190,9 @@ def add_filter(
                 CHAT_FILTERS.get(str(chat_id), []) + [keyword],
                 key=lambda x: (-len(x), x),
             )
+            CHAT_MATCHERS.pop(str(chat_id), None)
 
-        SESSION.add(filt)
-        SESSION.commit()
+        session.add(filt)
 
     for b_name, url, same_line in buttons:
         add_note_button_to_db(chat_id, keyword, b_name, url, same_line)
@@ -204,12 +204,12 @@ def new_add_filter(chat_id, keyword, reply_text, file_type, file_id, buttons):
     if buttons is None:
         buttons = []
 
-    with CUST_FILT_LOCK:
-        prev = SESSION.query(CustomFilters).get((str(chat_id), keyword))
+    with CUST_FILT_LOCK, session_scope(commit=True) as session:
+        prev = session.query(CustomFilters).get((str(chat_id), keyword))
         if prev:
             with BUTTON_LOCK:
                 prev_buttons = (
-                    SESSION.query(Buttons)
+                    session.query(Buttons)
                     .filter(
                         Buttons.chat_id == str(chat_id),
                         Buttons.keyword == keyword,
@@ -217,8 +217,8 @@ def new_add_filter(chat_id, keyword, reply_text, file_type, file_id, buttons):
                     .all()
                 )
                 for btn in prev_buttons:
-                    SESSION.delete(btn)
-            SESSION.delete(prev)
+                    session.delete(btn)
+            session.delete(prev)
 
         filt = CustomFilters(
             str(chat_id),
@@ -241,9 +241,9 @@ def new_add_filter(chat_id, keyword, reply_text, file_type, file_id, buttons):
                 CHAT_FILTERS.get(str(chat_id), []) + [keyword],
                 key=lambda x: (-len(x), x),
             )
+            CHAT_MATCHERS.pop(str(chat_id), None)
 
-        SESSION.add(filt)
-        SESSION.commit()
+        session.add(filt)
 
     for b_name, url, same_line in buttons:
         add_note_button_to_db(chat_id, keyword, b_name, url, same_line)
@@ -251,15 +251,16 @@ def new_add_filter(chat_id, keyword, reply_text, file_type, file_id, buttons):
 
 def remove_filter(chat_id, keyword):
     global CHAT_FILTERS
-    with CUST_FILT_LOCK:
-        filt = SESSION.query(CustomFilters).get((str(chat_id), keyword))
+    with CUST_FILT_LOCK, session_scope(commit=True) as session:
+        filt = session.query(CustomFilters).get((str(chat_id), keyword))
         if filt:
             if keyword in CHAT_FILTERS.get(str(chat_id), []):  # Sanity check
                 CHAT_FILTERS.get(str(chat_id), []).remove(keyword)
+                CHAT_MATCHERS.pop(str(chat_id), None)
 
             with BUTTON_LOCK:
                 prev_buttons = (
-                    SESSION.query(Buttons)
+                    session.query(Buttons)
                     .filter(
                         Buttons.chat_id == str(chat_id),
                         Buttons.keyword == keyword,
@@ -267,13 +268,11 @@ def remove_filter(chat_id, keyword):
                     .all()
                 )
                 for btn in prev_buttons:
-                    SESSION.delete(btn)
+                    session.delete(btn)
 
-            SESSION.delete(filt)
-            SESSION.commit()
+            session.delete(filt)
             return True
 
-        SESSION.close()
         return False
 
 
@@ -281,71 +280,77 @@ def get_chat_triggers(chat_id):
     return CHAT_FILTERS.get(str(chat_id), set())
 
 
+def get_chat_matcher(chat_id):
+    matcher = CHAT_MATCHERS.get(str(chat_id))
+    if matcher is None:
+        with CUST_FILT_LOCK:
+            matcher = CHAT_MATCHERS[str(chat_id)] = KeywordMatcher(
+                CHAT_FILTERS.get(str(chat_id), [])
+            )
+    return matcher
+
+
+def match_filter(chat_id, text):
+    # text is expected lowercased already, see MessageAnalysis.lowered
+    if not CHAT_FILTERS.get(str(chat_id)):
+        return None
+    return get_chat_matcher(chat_id).search(text, normalized=True)
+
+
 def get_chat_filters(chat_id):
-    try:
+    with session_scope() as session:
         return (
-            SESSION.query(CustomFilters)
+            session.query(CustomFilters)
             .filter(CustomFilters.chat_id == str(chat_id))
             .order_by(func.length(CustomFilters.keyword).desc())
             .order_by(CustomFilters.keyword.asc())
             .all()
         )
-    finally:
-        SESSION.close()
 
 
 def get_filter(chat_id, keyword):
-    try:
-        return SESSION.query(CustomFilters).get((str(chat_id), keyword))
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(CustomFilters).get((str(chat_id), keyword))
 
 
 def add_note_button_to_db(chat_id, keyword, b_name, url, same_line):
-    with BUTTON_LOCK:
+    with BUTTON_LOCK, session_scope(commit=True) as session:
         button = Buttons(chat_id, keyword, b_name, url, same_line)
-        SESSION.add(button)
-        SESSION.commit()
+        session.add(button)
 
 
 def get_buttons(chat_id, keyword):
-    try:
+    with session_scope() as session:
         return (
-            SESSION.query(Buttons)
+            session.query(Buttons)
             .filter(
                 Buttons.chat_id == str(chat_id), Buttons.keyword == keyword
             )
             .order_by(Buttons.id)
             .all()
         )
-    finally:
-        SESSION.close()
 
 
 def num_filters():
-    try:
-        return SESSION.query(CustomFilters).count()
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(CustomFilters).count()
 
 
 def num_chats():
-    try:
-        return SESSION.query(
+    with session_scope() as session:
+        return session.query(
             func.count(distinct(CustomFilters.chat_id))
         ).scalar()
-    finally:
-        SESSION.close()
 
 
 def __load_chat_filters():
     global CHAT_FILTERS
-    try:
-        chats = SESSION.query(CustomFilters.chat_id).distinct().all()
+    with session_scope() as session:
+        chats = session.query(CustomFilters.chat_id).distinct().all()
         for (chat_id,) in chats:  # remove tuple by ( ,)
             CHAT_FILTERS[chat_id] = []
 
-        all_filters = SESSION.query(CustomFilters).all()
+        all_filters = session.query(CustomFilters).all()
         for x in all_filters:
             CHAT_FILTERS[x.chat_id] += [x.keyword]
 
@@ -354,14 +359,11 @@ def __load_chat_filters():
             for x, y in CHAT_FILTERS.items()
         }
 
-    finally:
-        SESSION.close()
-
 
 # ONLY USE FOR MIGRATE OLD FILTERS TO NEW FILTERS
 def __migrate_filters():
-    try:
-        all_filters = SESSION.query(CustomFilters).distinct().all()
+    with session_scope(commit=True) as session:
+        all_filters = session.query(CustomFilters).distinct().all()
         for x in all_filters:
             if x.is_document:
                 file_type = Types.DOCUMENT
@@ -388,37 +390,33 @@ def __migrate_filters():
                     str(x.chat_id), x.keyword, None, file_type.value, x.reply
                 )
 
-            SESSION.add(filt)
-            SESSION.commit()
-
-    finally:
-        SESSION.close()
+            session.add(filt)
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with CUST_FILT_LOCK:
+    with CUST_FILT_LOCK, session_scope(commit=True) as session:
         chat_filters = (
-            SESSION.query(CustomFilters)
+            session.query(CustomFilters)
             .filter(CustomFilters.chat_id == str(old_chat_id))
             .all()
         )
         for filt in chat_filters:
             filt.chat_id = str(new_chat_id)
-        SESSION.commit()
         old_filt = CHAT_FILTERS.get(str(old_chat_id))
         if old_filt:
             CHAT_FILTERS[str(new_chat_id)] = old_filt
             del CHAT_FILTERS[str(old_chat_id)]
+        CHAT_MATCHERS.pop(str(old_chat_id), None)
+        CHAT_MATCHERS.pop(str(new_chat_id), None)
 
         with BUTTON_LOCK:
             chat_buttons = (
-                SESSION.query(Buttons)
+                session.query(Buttons)
                 .filter(Buttons.chat_id == str(old_chat_id))
                 .all()
             )
             for btn in chat_buttons:
                 btn.chat_id = str(new_chat_id)
-            SESSION.commit()
 
 
 __load_chat_filters()
@@ -2,7 +2,7 @@ import threading
 
 from sqlalchemy import Column, String, UnicodeText, func, distinct
 
-from kaguya.modules.sql import SESSION, BASE
+from kaguya.modules.sql import BASE, session_scope
 
 
 class Disable(BASE):
@@ -25,34 +25,30 @@ DISABLED = {}
 
 
 def disable_command(chat_id, disable):
-    with DISABLE_INSERTION_LOCK:
-        disabled = SESSION.query(Disable).get((str(chat_id), disable))
+    with DISABLE_INSERTION_LOCK, session_scope(commit=True) as session:
+        disabled = session.query(Disable).get((str(chat_id), disable))
 
         if not disabled:
             DISABLED.setdefault(str(chat_id), set()).add(disable)
 
             disabled = Disable(str(chat_id), disable)
-            SESSION.add(disabled)
-            SESSION.commit()
+            session.add(disabled)
             return True
 
-        SESSION.close()
         return False
 
 
 def enable_command(chat_id, enable):
-    with DISABLE_INSERTION_LOCK:
-        disabled = SESSION.query(Disable).get((str(chat_id), enable))
+    with DISABLE_INSERTION_LOCK, session_scope(commit=True) as session:
+        disabled = session.query(Disable).get((str(chat_id), enable))
 
         if disabled:
             if enable in DISABLED.get(str(chat_id)):  # sanity check
                 DISABLED.setdefault(str(chat_id), set()).remove(enable)
 
-            SESSION.delete(disabled)
-            SESSION.commit()
+            session.delete(disabled)
             return True
 
-        SESSION.close()
         return False
 
 
@@ -65,45 +61,36 @@ def get_all_disabled(chat_id):
 
 
 def num_chats():
-    try:
-        return SESSION.query(func.count(distinct(Disable.chat_id))).scalar()
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(func.count(distinct(Disable.chat_id))).scalar()
 
 
 def num_disabled():
-    try:
-        return SESSION.query(Disable).count()
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(Disable).count()
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with DISABLE_INSERTION_LOCK:
+    with DISABLE_INSERTION_LOCK, session_scope(commit=True) as session:
         chats = (
-            SESSION.query(Disable)
+            session.query(Disable)
             .filter(Disable.chat_id == str(old_chat_id))
             .all()
         )
         for chat in chats:
             chat.chat_id = str(new_chat_id)
-            SESSION.add(chat)
+            session.add(chat)
 
         if str(old_chat_id) in DISABLED:
             DISABLED[str(new_chat_id)] = DISABLED.get(str(old_chat_id), set())
 
-        SESSION.commit()
-
 
 def __load_disabled_commands():
     global DISABLED
-    try:
-        all_chats = SESSION.query(Disable).all()
+    with session_scope() as session:
+        all_chats = session.query(Disable).all()
         for chat in all_chats:
             DISABLED.setdefault(chat.chat_id, set()).add(chat.command)
 
-    finally:
-        SESSION.close()
-
 
 __load_disabled_commands()
@@ -0,0 +1,91 @@
+import json
+import threading
+import time
+
+from sqlalchemy import Column, String, UnicodeText, Integer
+
+from kaguya.modules.sql import BASE, session_scope
+
+
+class FedBanJobs(BASE):
+    __tablename__ = "fed_ban_jobs"
+    job_id = Column(Integer, primary_key=True)
+    fed_id = Column(UnicodeText, nullable=False)
+    user_id = Column(String(14), nullable=False)
+    action = Column(String(10), nullable=False)
+    origin_chat = Column(String(14))
+    # json list of [chat_id, fed_id the chat was reached through]
+    targets = Column(UnicodeText, nullable=False)
+    progress = Column(Integer, default=0)
+    affected = Column(Integer, default=0)
+    time = Column(Integer, default=0)
+
+    def __init__(self, fed_id, user_id, action, origin_chat, targets):
+        self.fed_id = fed_id
+        self.user_id = str(user_id)
+        self.action = action
+        self.origin_chat = str(origin_chat)
+        self.targets = json.dumps(targets)
+        self.progress = 0
+        self.affected = 0
+        self.time = int(time.time())
+
+    def __repr__(self):
+        return "<Fed {} job {} for {} ({}/{})>".format(
+            self.action, self.job_id, self.user_id, self.fed_id, self.progress
+        )
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "fed_id": self.fed_id,
+            "user_id": int(self.user_id),
+            "action": self.action,
+            "origin_chat": self.origin_chat,
+            "targets": [tuple(x) for x in json.loads(self.targets)],
+            "progress": self.progress,
+            "affected": self.affected,
+        }
+
+
+FedBanJobs.__table__.create(checkfirst=True)
+
+FED_JOBS_LOCK = threading.RLock()
+
+
+def add_job(fed_id, user_id, action, origin_chat, targets):
+    with FED_JOBS_LOCK, session_scope(commit=True) as session:
+        job = FedBanJobs(fed_id, user_id, action, origin_chat, targets)
+        session.add(job)
+        # assigns job_id
+        session.flush()
+        return job.to_dict()
+
+
+def set_progress(job_id, progress, affected):
+    with FED_JOBS_LOCK, session_scope(commit=True) as session:
+        job = session.query(FedBanJobs).get(job_id)
+        if not job:
+            return False
+        job.progress = progress
+        job.affected = affected
+        return True
+
+
+def finish_job(job_id):
+    with FED_JOBS_LOCK, session_scope(commit=True) as session:
+        job = session.query(FedBanJobs).get(job_id)
+        if job:
+            session.delete(job)
+            return True
+        return False
+
+
+def get_pending_jobs():
+    with session_scope() as session:
+        return [
+            x.to_dict()
+            for x in session.query(FedBanJobs)
+            .order_by(FedBanJobs.job_id)
+            .all()
+        ]
@@ -1,10 +1,15 @@
+import ast
 import threading
 
 from sqlalchemy import Column, String, UnicodeText, Integer, Boolean
+from sqlalchemy.dialects import postgresql
 from telegram.error import BadRequest, Unauthorized
 
 from kaguya import dispatcher
-from kaguya.modules.sql import SESSION, BASE
+from kaguya.mwt import TTLCache
+from kaguya.modules.helper_funcs.fed_graph import FedGraph
+from kaguya.modules.helper_funcs.intset import IntSet
+from kaguya.modules.sql import BASE, session_scope
 
 
 class Federations(BASE):
@@ -111,13 +116,22 @@ FEDERATION_BYFEDID = {}
 FEDERATION_CHATS = {}
 FEDERATION_CHATS_BYID = {}
 
-FEDERATION_BANNED_FULL = {}
+# fed_id -> IntSet of banned user ids; names and reasons are only read
+# from the db when needed, and kept in FEDERATION_BANNED_INFO for a while
 FEDERATION_BANNED_USERID = {}
+FEDERATION_BANNED_INFO = TTLCache(timeout=60 * 60, maxsize=10000)
+
+# user_id (int) -> fed ids they own / are an admin of
+FEDERATION_IDS_BYOWNER = {}
+FEDERATION_IDS_BYADMIN = {}
 
 FEDERATION_NOTIFICATION = {}
 FEDS_SUBSCRIBER = {}
 MYFEDS_SUBSCRIBER = {}
 
+# where a fed's bans have to go, through its subscribers
+FED_GRAPH = FedGraph()
+
 
 def get_fed_info(fed_id):
     get = FEDERATION_BYFEDID.get(str(fed_id))
@@ -143,64 +157,82 @@ def get_fed_name(chat_id):
 
 
 def get_user_fban(fed_id, user_id):
-    if not FEDERATION_BANNED_FULL.get(fed_id):
+    if not FEDERATION_BANNED_USERID.get(fed_id):
         return False, False, False
-    user_info = FEDERATION_BANNED_FULL[fed_id].get(user_id)
+    user_info = __get_fban_info(fed_id, user_id)
     if not user_info:
         return None, None, None
     return user_info["first_name"], user_info["reason"], user_info["time"]
 
 
 def get_user_admin_fed_name(user_id):
-    user_feds = []
-    for f in FEDERATION_BYFEDID:
-        if int(user_id) in eval(
-            eval(FEDERATION_BYFEDID[f]["fusers"])["members"]
-        ):
-            user_feds.append(FEDERATION_BYFEDID[f]["fname"])
-    return user_feds
+    return [
+        FEDERATION_BYFEDID[f]["fname"]
+        for f in FEDERATION_IDS_BYADMIN.get(int(user_id), ())
+    ]
 
 
 def get_user_owner_fed_name(user_id):
-    user_feds = []
-    for f in FEDERATION_BYFEDID:
-        if int(user_id) == int(eval(FEDERATION_BYFEDID[f]["fusers"])["owner"]):
-            user_feds.append(FEDERATION_BYFEDID[f]["fname"])
-    return user_feds
+    return [
+        FEDERATION_BYFEDID[f]["fname"]
+        for f in FEDERATION_IDS_BYOWNER.get(int(user_id), ())
+    ]
 
 
 def get_user_admin_fed_full(user_id):
-    user_feds = []
-    for f in FEDERATION_BYFEDID:
-        if int(user_id) in eval(
-            eval(FEDERATION_BYFEDID[f]["fusers"])["members"]
-        ):
-            user_feds.append({"fed_id": f, "fed": FEDERATION_BYFEDID[f]})
-    return user_feds
+    return [
+        {"fed_id": f, "fed": FEDERATION_BYFEDID[f]}
+        for f in FEDERATION_IDS_BYADMIN.get(int(user_id), ())
+    ]
 
 
 def get_user_owner_fed_full(user_id):
-    user_feds = []
-    for f in FEDERATION_BYFEDID:
-        if int(user_id) == int(eval(FEDERATION_BYFEDID[f]["fusers"])["owner"]):
-            user_feds.append({"fed_id": f, "fed": FEDERATION_BYFEDID[f]})
-    return user_feds
+    return [
+        {"fed_id": f, "fed": FEDERATION_BYFEDID[f]}
+        for f in FEDERATION_IDS_BYOWNER.get(int(user_id), ())
+    ]
 
 
 def get_user_fbanlist(user_id):
-    banlist = FEDERATION_BANNED_FULL
     user_name = ""
     fedname = []
-    for x in banlist:
-        if banlist[x].get(user_id):
-            if user_name == "":
-                user_name = banlist[x][user_id].get("first_name")
-            fedname.append([x, banlist[x][user_id].get("reason")])
+    for x, banned in list(FEDERATION_BANNED_USERID.items()):
+        if user_id not in banned:
+            continue
+        user_info = __get_fban_info(x, user_id)
+        if not user_info:
+            continue
+        if user_name == "":
+            user_name = user_info.get("first_name")
+        fedname.append([x, user_info.get("reason")])
     return user_name, fedname
 
 
+def __parse_fed_users(fed_users):
+    # fed_users is stored as str({"owner": "id", "members": "[id, ...]"})
+    fusers = ast.literal_eval(fed_users)
+    members = {int(x) for x in ast.literal_eval(fusers["members"])}
+    return int(fusers["owner"]), members
+
+
+def __dump_fed_users(owner_id, members):
+    return str({"owner": str(owner_id), "members": str(sorted(members))})
+
+
+def __index_fed(fed_id, owner_id, members):
+    FEDERATION_IDS_BYOWNER.setdefault(int(owner_id), set()).add(fed_id)
+    for user_id in members:
+        FEDERATION_IDS_BYADMIN.setdefault(user_id, set()).add(fed_id)
+
+
+def __unindex_fed(fed_id, owner_id, members):
+    FEDERATION_IDS_BYOWNER.get(int(owner_id), set()).discard(fed_id)
+    for user_id in members:
+        FEDERATION_IDS_BYADMIN.get(user_id, set()).discard(fed_id)
+
+
 def new_fed(owner_id, fed_name, fed_id):
-    with FEDS_LOCK:
+    with FEDS_LOCK, session_scope(commit=True) as session:
         global FEDERATION_BYOWNER, FEDERATION_BYFEDID, FEDERATION_BYNAME
         fed = Federations(
             str(owner_id),
@@ -210,8 +242,7 @@ def new_fed(owner_id, fed_name, fed_id):
             None,
             str({"owner": str(owner_id), "members": "[]"}),
         )
-        SESSION.add(fed)
-        SESSION.commit()
+        session.add(fed)
         FEDERATION_BYOWNER[str(owner_id)] = {
             "fid": str(fed_id),
             "fname": fed_name,
@@ -225,6 +256,7 @@ def new_fed(owner_id, fed_name, fed_id):
             "frules": "Rules is not set in this federation.",
             "flog": None,
             "fusers": str({"owner": str(owner_id), "members": "[]"}),
+            "members": set(),
         }
         FEDERATION_BYNAME[fed_name] = {
             "fid": str(fed_id),
@@ -233,12 +265,13 @@ def new_fed(owner_id, fed_name, fed_id):
             "flog": None,
             "fusers": str({"owner": str(owner_id), "members": "[]"}),
         }
+        __index_fed(str(fed_id), owner_id, ())
         return fed
 
 
 def del_fed(fed_id):
-    with FEDS_LOCK:
-        global FEDERATION_BYOWNER, FEDERATION_BYFEDID, FEDERATION_BYNAME, FEDERATION_CHATS, FEDERATION_CHATS_BYID, FEDERATION_BANNED_USERID, FEDERATION_BANNED_FULL
+    with FEDS_LOCK, session_scope(commit=True) as session:
+        global FEDERATION_BYOWNER, FEDERATION_BYFEDID, FEDERATION_BYNAME, FEDERATION_CHATS, FEDERATION_CHATS_BYID, FEDERATION_BANNED_USERID
         getcache = FEDERATION_BYFEDID.get(fed_id)
         if getcache == None:
             return False
@@ -247,54 +280,49 @@ def del_fed(fed_id):
         owner_id = getfed["owner"]
         fed_name = getfed["fname"]
         # Delete from cache
+        __unindex_fed(fed_id, owner_id, getfed["members"])
+        FED_GRAPH.remove_fed(fed_id)
         FEDERATION_BYOWNER.pop(owner_id)
         FEDERATION_BYFEDID.pop(fed_id)
         FEDERATION_BYNAME.pop(fed_name)
         if FEDERATION_CHATS_BYID.get(fed_id):
             for x in FEDERATION_CHATS_BYID[fed_id]:
-                delchats = SESSION.query(ChatF).get(str(x))
+                delchats = session.query(ChatF).get(str(x))
                 if delchats:
-                    SESSION.delete(delchats)
-                    SESSION.commit()
+                    session.delete(delchats)
                 FEDERATION_CHATS.pop(x)
             FEDERATION_CHATS_BYID.pop(fed_id)
         # Delete fedban users
-        getall = FEDERATION_BANNED_USERID.get(fed_id)
-        if getall:
-            for x in getall:
-                banlist = SESSION.query(BansF).get((fed_id, str(x)))
-                if banlist:
-                    SESSION.delete(banlist)
-                    SESSION.commit()
+        if FEDERATION_BANNED_USERID.get(fed_id):
+            session.query(BansF).filter(BansF.fed_id == fed_id).delete(
+                synchronize_session=False
+            )
         if FEDERATION_BANNED_USERID.get(fed_id):
             FEDERATION_BANNED_USERID.pop(fed_id)
-        if FEDERATION_BANNED_FULL.get(fed_id):
-            FEDERATION_BANNED_FULL.pop(fed_id)
+        FEDERATION_BANNED_INFO.invalidate(fed_id)
         # Delete fedsubs
         getall = MYFEDS_SUBSCRIBER.get(fed_id)
         if getall:
             for x in getall:
-                getsubs = SESSION.query(FedSubs).get((fed_id, str(x)))
+                getsubs = session.query(FedSubs).get((fed_id, str(x)))
                 if getsubs:
-                    SESSION.delete(getsubs)
-                    SESSION.commit()
+                    session.delete(getsubs)
         if FEDS_SUBSCRIBER.get(fed_id):
             FEDS_SUBSCRIBER.pop(fed_id)
         if MYFEDS_SUBSCRIBER.get(fed_id):
             MYFEDS_SUBSCRIBER.pop(fed_id)
         # Delete from database
-        curr = SESSION.query(Federations).get(fed_id)
+        curr = session.query(Federations).get(fed_id)
         if curr:
-            SESSION.delete(curr)
-            SESSION.commit()
+            session.delete(curr)
         return True
 
 
 def chat_join_fed(fed_id, chat_name, chat_id):
-    with FEDS_LOCK:
+    with FEDS_LOCK, session_scope(commit=True) as session:
         global FEDERATION_CHATS, FEDERATION_CHATS_BYID
         r = ChatF(chat_id, chat_name, fed_id)
-        SESSION.add(r)
+        session.add(r)
         FEDERATION_CHATS[str(chat_id)] = {
             "chat_name": chat_name,
             "fid": fed_id,
@@ -303,7 +331,7 @@ def chat_join_fed(fed_id, chat_name, chat_id):
         if checkid == None:
             FEDERATION_CHATS_BYID[fed_id] = []
         FEDERATION_CHATS_BYID[fed_id].append(str(chat_id))
-        SESSION.commit()
+        FED_GRAPH.add_chat(fed_id, str(chat_id))
         return r
 
 
@@ -318,103 +346,57 @@ def search_user_in_fed(fed_id, user_id):
     getfed = FEDERATION_BYFEDID.get(fed_id)
     if getfed == None:
         return False
-    getfed = eval(getfed["fusers"])["members"]
-    if user_id in eval(getfed):
-        return True
-    else:
+    if user_id is None:
         return False
+    return int(user_id) in getfed["members"]
+
+
+def __set_fed_members(fed_id, members):
+    getfed = FEDERATION_BYFEDID.get(str(fed_id))
+    owner_id = getfed["owner"]
+    fed_name = getfed["fname"]
+    fed_users = __dump_fed_users(owner_id, members)
+    # Set user
+    FEDERATION_BYOWNER[str(owner_id)]["fusers"] = fed_users
+    FEDERATION_BYFEDID[str(fed_id)]["fusers"] = fed_users
+    FEDERATION_BYNAME[fed_name]["fusers"] = fed_users
+    # Set on database
+    fed = Federations(
+        str(owner_id),
+        fed_name,
+        str(fed_id),
+        getfed["frules"],
+        getfed["flog"],
+        fed_users,
+    )
+    with session_scope(commit=True) as session:
+        session.merge(fed)
 
 
 def user_demote_fed(fed_id, user_id):
     with FEDS_LOCK:
-        global FEDERATION_BYOWNER, FEDERATION_BYFEDID, FEDERATION_BYNAME
-        # Variables
-        getfed = FEDERATION_BYFEDID.get(str(fed_id))
-        owner_id = getfed["owner"]
-        fed_name = getfed["fname"]
-        fed_rules = getfed["frules"]
-        fed_log = getfed["flog"]
-        # Temp set
-        try:
-            members = eval(eval(getfed["fusers"])["members"])
-        except ValueError:
+        user_id = int(user_id)
+        members = FEDERATION_BYFEDID[str(fed_id)]["members"]
+        if user_id not in members:
             return False
-        members.remove(user_id)
-        # Set user
-        FEDERATION_BYOWNER[str(owner_id)]["fusers"] = str(
-            {"owner": str(owner_id), "members": str(members)}
-        )
-        FEDERATION_BYFEDID[str(fed_id)]["fusers"] = str(
-            {"owner": str(owner_id), "members": str(members)}
-        )
-        FEDERATION_BYNAME[fed_name]["fusers"] = str(
-            {"owner": str(owner_id), "members": str(members)}
-        )
-        # Set on database
-        fed = Federations(
-            str(owner_id),
-            fed_name,
-            str(fed_id),
-            fed_rules,
-            fed_log,
-            str({"owner": str(owner_id), "members": str(members)}),
-        )
-        SESSION.merge(fed)
-        SESSION.commit()
+        __set_fed_members(fed_id, members - {user_id})
+        members.discard(user_id)
+        FEDERATION_IDS_BYADMIN.get(user_id, set()).discard(str(fed_id))
         return True
 
-        curr = SESSION.query(UserF).all()
-        result = False
-        for r in curr:
-            if int(r.user_id) == int(user_id):
-                if r.fed_id == fed_id:
-                    SESSION.delete(r)
-                    SESSION.commit()
-                    result = True
-
-        SESSION.close()
-        return result
-
 
 def user_join_fed(fed_id, user_id):
     with FEDS_LOCK:
-        global FEDERATION_BYOWNER, FEDERATION_BYFEDID, FEDERATION_BYNAME
-        # Variables
-        getfed = FEDERATION_BYFEDID.get(str(fed_id))
-        owner_id = getfed["owner"]
-        fed_name = getfed["fname"]
-        fed_rules = getfed["frules"]
-        fed_log = getfed["flog"]
-        # Temp set
-        members = eval(eval(getfed["fusers"])["members"])
-        members.append(user_id)
-        # Set user
-        FEDERATION_BYOWNER[str(owner_id)]["fusers"] = str(
-            {"owner": str(owner_id), "members": str(members)}
-        )
-        FEDERATION_BYFEDID[str(fed_id)]["fusers"] = str(
-            {"owner": str(owner_id), "members": str(members)}
-        )
-        FEDERATION_BYNAME[fed_name]["fusers"] = str(
-            {"owner": str(owner_id), "members": str(members)}
-        )
-        # Set on database
-        fed = Federations(
-            str(owner_id),
-            fed_name,
-            str(fed_id),
-            fed_rules,
-            fed_log,
-            str({"owner": str(owner_id), "members": str(members)}),
-        )
-        SESSION.merge(fed)
-        SESSION.commit()
-        __load_all_feds_chats()
+        user_id = int(user_id)
+        members = FEDERATION_BYFEDID[str(fed_id)]["members"]
+        __set_fed_members(fed_id, members | {user_id})
+        members.add(user_id)
+        FEDERATION_IDS_BYADMIN.setdefault(user_id, set()).add(str(fed_id))
         return True
 
 
 def chat_leave_fed(chat_id):
-    with FEDS_LOCK:
+    with FEDS_LOCK, session_scope(commit=True) as session:
         global FEDERATION_CHATS, FEDERATION_CHATS_BYID
         # Set variables
         fed_info = FEDERATION_CHATS.get(str(chat_id))
@@ -424,12 +406,11 @@ def chat_leave_fed(chat_id):
         # Delete from cache
         FEDERATION_CHATS.pop(str(chat_id))
         FEDERATION_CHATS_BYID[str(fed_id)].remove(str(chat_id))
+        FED_GRAPH.remove_chat(fed_id, str(chat_id))
         # Delete from db
-        curr = SESSION.query(ChatF).all()
-        for U in curr:
-            if int(U.chat_id) == int(chat_id):
-                SESSION.delete(U)
-                SESSION.commit()
+        curr = session.query(ChatF).get(str(chat_id))
+        if curr:
+            session.delete(curr)
         return True
 
 
@@ -447,21 +428,35 @@ def all_fed_users(fed_id):
         getfed = FEDERATION_BYFEDID.get(str(fed_id))
         if getfed == None:
             return False
-        fed_owner = eval(eval(getfed["fusers"])["owner"])
-        fed_admins = eval(eval(getfed["fusers"])["members"])
-        fed_admins.append(fed_owner)
+        fed_admins = list(getfed["members"])
+        fed_admins.append(int(getfed["owner"]))
         return fed_admins
 
 
 def all_fed_members(fed_id):
     with FEDS_LOCK:
         getfed = FEDERATION_BYFEDID.get(str(fed_id))
-        fed_admins = eval(eval(getfed["fusers"])["members"])
-        return fed_admins
+        if getfed == None:
+            return []
+        return list(getfed["members"])
+
+
+def is_user_fed_owner(fed_id, user_id):
+    getfed = FEDERATION_BYFEDID.get(str(fed_id))
+    if getfed == None:
+        return False
+    return str(user_id) == getfed["owner"]
+
+
+def is_user_fed_admin(fed_id, user_id):
+    getfed = FEDERATION_BYFEDID.get(str(fed_id))
+    if getfed == None:
+        return False
+    return str(user_id) == getfed["owner"] or int(user_id) in getfed["members"]
 
 
 def set_frules(fed_id, rules):
-    with FEDS_LOCK:
+    with FEDS_LOCK, session_scope(commit=True) as session:
         global FEDERATION_BYOWNER, FEDERATION_BYFEDID, FEDERATION_BYNAME
         # Variables
         getfed = FEDERATION_BYFEDID.get(str(fed_id))
@@ -483,8 +478,7 @@ def set_frules(fed_id, rules):
             fed_log,
             str(fed_members),
         )
-        SESSION.merge(fed)
-        SESSION.commit()
+        session.merge(fed)
         return True
 
 
@@ -494,14 +488,49 @@ def get_frules(fed_id):
         return rules
 
 
+def __get_fban_info(fed_id, user_id):
+    if user_id not in FEDERATION_BANNED_USERID.get(fed_id, ()):
+        return None
+
+    def load():
+        with session_scope() as session:
+            ban = session.query(BansF).get((str(fed_id), str(user_id)))
+            if not ban:
+                return None
+            return {
+                "first_name": ban.first_name,
+                "last_name": ban.last_name,
+                "user_name": ban.user_name,
+                "reason": ban.reason,
+                "time": ban.time,
+            }
+
+    return FEDERATION_BANNED_INFO.get_or_load((fed_id, str(user_id)), load)
+
+
+def __cache_fban(
+    fed_id, user_id, first_name, last_name, user_name, reason, time
+):
+    FEDERATION_BANNED_USERID.setdefault(fed_id, IntSet()).add(user_id)
+    FEDERATION_BANNED_INFO.set(
+        (fed_id, str(user_id)),
+        {
+            "first_name": first_name,
+            "last_name": last_name,
+            "user_name": user_name,
+            "reason": reason,
+            "time": time,
+        },
+    )
+
+
+def __uncache_fban(fed_id, user_id):
+    FEDERATION_BANNED_USERID.get(fed_id, IntSet()).discard(user_id)
+    FEDERATION_BANNED_INFO.invalidate((fed_id, str(user_id)))
+
+
 def fban_user(fed_id, user_id, first_name, last_name, user_name, reason, time):
     with FEDS_LOCK:
-        r = SESSION.query(BansF).all()
-        for I in r:
-            if I.fed_id == fed_id:
-                if int(I.user_id) == int(user_id):
-                    SESSION.delete(I)
-
         r = BansF(
             str(fed_id),
             str(user_id),
@@ -511,130 +540,141 @@ def fban_user(fed_id, user_id, first_name, last_name, user_name, reason, time):
             reason,
             time,
         )
-
-        SESSION.add(r)
         try:
-            SESSION.commit()
+            with session_scope(commit=True) as session:
+                # merge on the (fed_id, user_id) primary key replaces an
+                # old ban
+                r = session.merge(r)
         except:
-            SESSION.rollback()
             return False
-        finally:
-            SESSION.commit()
-        __load_all_feds_banned()
+        __cache_fban(
+            fed_id, user_id, first_name, last_name, user_name, reason, time
+        )
         return r
 
 
-def multi_fban_user(
-    multi_fed_id,
-    multi_user_id,
-    multi_first_name,
-    multi_last_name,
-    multi_user_name,
-    multi_reason,
-):
-    if True:  # with FEDS_LOCK:
-        counter = 0
-        time = 0
-        for x in range(len(multi_fed_id)):
-            fed_id = multi_fed_id[x]
-            user_id = multi_user_id[x]
-            first_name = multi_first_name[x]
-            last_name = multi_last_name[x]
-            user_name = multi_user_name[x]
-            reason = multi_reason[x]
-            r = SESSION.query(BansF).all()
-            for I in r:
-                if I.fed_id == fed_id:
-                    if int(I.user_id) == int(user_id):
-                        SESSION.delete(I)
-
-            r = BansF(
-                str(fed_id),
-                str(user_id),
-                first_name,
-                last_name,
-                user_name,
-                reason,
-                time,
-            )
-
-            SESSION.add(r)
-            counter += 1
-            if str(str(counter)[-2:]) == "00":
-                print(user_id)
-                print(first_name)
-                print(reason)
-                print(counter)
+def bulk_fban_users(fed_id, bans):
+    """
+    Insert or update many bans of one fed with a single statement.
+
+    :param bans: dicts with user_id, first_name, last_name, user_name,
+        reason and time keys; a later row for the same user wins
+    :return: number of bans written, or False if the write failed
+    """
+    rows = {}
+    for ban in bans:
+        rows[str(ban["user_id"])] = {
+            "fed_id": str(fed_id),
+            "user_id": str(ban["user_id"]),
+            "first_name": ban["first_name"],
+            "last_name": ban["last_name"],
+            "user_name": ban["user_name"],
+            "reason": ban["reason"],
+            "time": ban["time"],
+        }
+    if not rows:
+        return 0
+
+    stmt = postgresql.insert(BansF.__table__).values(list(rows.values()))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[BansF.fed_id, BansF.user_id],
+        set_={
+            "first_name": stmt.excluded.first_name,
+            "last_name": stmt.excluded.last_name,
+            "user_name": stmt.excluded.user_name,
+            "reason": stmt.excluded.reason,
+            "time": stmt.excluded.time,
+        },
+    )
+    with FEDS_LOCK:
         try:
-            SESSION.commit()
+            with session_scope(commit=True) as session:
+                session.execute(stmt)
         except:
-            SESSION.rollback()
             return False
-        finally:
-            SESSION.commit()
-        __load_all_feds_banned()
-        print("Done")
-        return counter
+        FEDERATION_BANNED_USERID.setdefault(fed_id, IntSet()).update(rows)
+        # cheaper than looking up each updated user in the cache
+        FEDERATION_BANNED_INFO.invalidate(fed_id)
+        return len(rows)
 
 
 def un_fban_user(fed_id, user_id):
     with FEDS_LOCK:
-        r = SESSION.query(BansF).all()
-        for I in r:
-            if I.fed_id == fed_id:
-                if int(I.user_id) == int(user_id):
-                    SESSION.delete(I)
         try:
-            SESSION.commit()
+            with session_scope(commit=True) as session:
+                I = session.query(BansF).get((str(fed_id), str(user_id)))
+                if not I:
+                    return False
+                session.delete(I)
         except:
-            SESSION.rollback()
             return False
-        finally:
-            SESSION.commit()
-        __load_all_feds_banned()
+        __uncache_fban(fed_id, user_id)
         return I
 
 
 def get_fban_user(fed_id, user_id):
-    list_fbanned = FEDERATION_BANNED_USERID.get(fed_id)
-    if list_fbanned == None:
-        FEDERATION_BANNED_USERID[fed_id] = []
-    if user_id in FEDERATION_BANNED_USERID[fed_id]:
-        r = SESSION.query(BansF).all()
-        reason = None
-        for I in r:
-            if I.fed_id == fed_id:
-                if int(I.user_id) == int(user_id):
-                    reason = I.reason
-                    time = I.time
-        return True, reason, time
+    if user_id in FEDERATION_BANNED_USERID.get(fed_id, ()):
+        user_info = __get_fban_info(fed_id, user_id) or {}
+        return True, user_info.get("reason"), user_info.get("time")
     else:
         return False, None, None
 
 
+def get_chat_fban(chat_id, user_id):
+    """
+    Find a ban of user_id that applies in chat_id: one from the chat's
+    fed, or from a fed that fed subscribes to, directly or not.
+
+    :return: (fed_id, reason) of the first ban found, or None
+    """
+    fed_id = get_fed_id(chat_id)
+    if not fed_id:
+        return None
+    for fedsid in FED_GRAPH.sources(fed_id):
+        if user_id in FEDERATION_BANNED_USERID.get(fedsid, ()):
+            user_info = __get_fban_info(fedsid, user_id) or {}
+            return fedsid, user_info.get("reason")
+    return None
+
+
 def get_all_fban_users(fed_id):
-    list_fbanned = FEDERATION_BANNED_USERID.get(fed_id)
-    if list_fbanned == None:
-        FEDERATION_BANNED_USERID[fed_id] = []
-    return FEDERATION_BANNED_USERID[fed_id]
+    return list(FEDERATION_BANNED_USERID.get(fed_id, ()))
+
+
+def get_fban_count(fed_id):
+    return len(FEDERATION_BANNED_USERID.get(fed_id, ()))
 
 
 def get_all_fban_users_target(fed_id, user_id):
-    list_fbanned = FEDERATION_BANNED_FULL.get(fed_id)
-    if list_fbanned == None:
-        FEDERATION_BANNED_FULL[fed_id] = []
-        return False
-    getuser = list_fbanned[str(user_id)]
-    return getuser
+    return __get_fban_info(fed_id, user_id) or False
+
+
+def iter_fban_rows(fed_id, batch=1000):
+    """
+    Stream a fed's bans from the database, `batch` rows at a time.
+
+    :return: generator of (user_id, first_name, last_name, user_name,
+        reason) tuples
+    """
+    with session_scope() as session:
+        query = (
+            session.query(
+                BansF.user_id,
+                BansF.first_name,
+                BansF.last_name,
+                BansF.user_name,
+                BansF.reason,
+            )
+            .filter(BansF.fed_id == str(fed_id))
+            .execution_options(stream_results=True)
+            .yield_per(batch)
+        )
+        for row in query:
+            yield row
 
 
-def get_all_fban_users_global():
-    list_fbanned = FEDERATION_BANNED_USERID
-    total = []
-    for x in list(FEDERATION_BANNED_USERID):
-        for y in FEDERATION_BANNED_USERID[x]:
-            total.append(y)
-    return total
+def num_fbanned_users():
+    return sum(len(x) for x in list(FEDERATION_BANNED_USERID.values()))
 
 
 def get_all_feds_users_global():
@@ -667,16 +707,15 @@ def user_feds_report(user_id: int) -> bool:
 
 
 def set_feds_setting(user_id: int, setting: bool):
-    with FEDS_SETTINGS_LOCK:
+    with FEDS_SETTINGS_LOCK, session_scope(commit=True) as session:
         global FEDERATION_NOTIFICATION
-        user_setting = SESSION.query(FedsUserSettings).get(user_id)
+        user_setting = session.query(FedsUserSettings).get(user_id)
         if not user_setting:
             user_setting = FedsUserSettings(user_id)
 
         user_setting.should_report = setting
         FEDERATION_NOTIFICATION[str(user_id)] = setting
-        SESSION.add(user_setting)
-        SESSION.commit()
+        session.add(user_setting)
 
 
 def get_fed_log(fed_id):
@@ -701,7 +740,7 @@ def get_fed_log(fed_id):
 
 
 def set_fed_log(fed_id, chat_id):
-    with FEDS_LOCK:
+    with FEDS_LOCK, session_scope(commit=True) as session:
         global FEDERATION_BYOWNER, FEDERATION_BYFEDID, FEDERATION_BYNAME
         # Variables
         getfed = FEDERATION_BYFEDID.get(str(fed_id))
@@ -723,8 +762,7 @@ def set_fed_log(fed_id, chat_id):
             fed_log,
             str(fed_members),
         )
-        SESSION.merge(fed)
-        SESSION.commit()
+        session.merge(fed)
         print(fed_log)
         return True
 
@@ -733,31 +771,27 @@ def subs_fed(fed_id, my_fed):
     check = get_spec_subs(fed_id, my_fed)
     if check:
         return False
-    with FEDS_SUBSCRIBER_LOCK:
+    with FEDS_SUBSCRIBER_LOCK, session_scope(commit=True) as session:
         subsfed = FedSubs(fed_id, my_fed)
 
-        SESSION.merge(subsfed)  # merge to avoid duplicate key issues
-        SESSION.commit()
-        global FEDS_SUBSCRIBER
-        if FEDS_SUBSCRIBER.get(fed_id, set()) == set():
-            FEDS_SUBSCRIBER[fed_id] = {my_fed}
-        else:
-            FEDS_SUBSCRIBER.get(fed_id, set()).add(my_fed)
+        session.merge(subsfed)  # merge to avoid duplicate key issues
+        FEDS_SUBSCRIBER.setdefault(fed_id, set()).add(my_fed)
+        MYFEDS_SUBSCRIBER.setdefault(my_fed, set()).add(fed_id)
+        FED_GRAPH.add_subscription(fed_id, my_fed)
         return True
 
 
 def unsubs_fed(fed_id, my_fed):
-    with FEDS_SUBSCRIBER_LOCK:
-        getsubs = SESSION.query(FedSubs).get((fed_id, my_fed))
+    with FEDS_SUBSCRIBER_LOCK, session_scope(commit=True) as session:
+        getsubs = session.query(FedSubs).get((fed_id, my_fed))
         if getsubs:
-            if my_fed in FEDS_SUBSCRIBER.get(fed_id, set()):  # sanity check
-                FEDS_SUBSCRIBER.get(fed_id, set()).remove(my_fed)
+            FEDS_SUBSCRIBER.get(fed_id, set()).discard(my_fed)
+            MYFEDS_SUBSCRIBER.get(my_fed, set()).discard(fed_id)
+            FED_GRAPH.remove_subscription(fed_id, my_fed)
 
-            SESSION.delete(getsubs)
-            SESSION.commit()
+            session.delete(getsubs)
             return True
 
-        SESSION.close()
         return False
 
 
@@ -782,10 +816,20 @@ def get_subscriber(fed_id):
     return FEDS_SUBSCRIBER.get(fed_id, set())
 
 
+def get_fed_targets(fed_id):
+    """
+    Every chat a ban in fed_id has to reach: the fed's own chats, then
+    those of its direct and indirect subscribers, each chat only once.
+
+    :return: list of (chat_id, fed_id the chat belongs to)
+    """
+    return FED_GRAPH.targets(fed_id)
+
+
 def __load_all_feds():
     global FEDERATION_BYOWNER, FEDERATION_BYFEDID, FEDERATION_BYNAME
-    try:
-        feds = SESSION.query(Federations).all()
+    with session_scope() as session:
+        feds = session.query(Federations).all()
         for x in feds:  # remove tuple by ( ,)
             # Fed by Owner
             check = FEDERATION_BYOWNER.get(x.owner_id)
@@ -802,13 +846,16 @@ def __load_all_feds():
             check = FEDERATION_BYFEDID.get(x.fed_id)
             if check == None:
                 FEDERATION_BYFEDID[x.fed_id] = []
+            owner_id, members = __parse_fed_users(x.fed_users)
             FEDERATION_BYFEDID[str(x.fed_id)] = {
                 "owner": str(x.owner_id),
                 "fname": x.fed_name,
                 "frules": x.fed_rules,
                 "flog": x.fed_log,
                 "fusers": str(x.fed_users),
+                "members": members,
             }
+            __index_fed(str(x.fed_id), owner_id, members)
             # Fed By Name
             check = FEDERATION_BYNAME.get(x.fed_name)
             if check == None:
@@ -820,14 +867,12 @@ def __load_all_feds():
                 "flog": x.fed_log,
                 "fusers": str(x.fed_users),
             }
-    finally:
-        SESSION.close()
 
 
 def __load_all_feds_chats():
     global FEDERATION_CHATS, FEDERATION_CHATS_BYID
-    try:
-        qall = SESSION.query(ChatF).all()
+    with session_scope() as session:
+        qall = session.query(ChatF).all()
         FEDERATION_CHATS = {}
         FEDERATION_CHATS_BYID = {}
         for x in qall:
@@ -844,71 +889,38 @@ def __load_all_feds_chats():
             if check == None:
                 FEDERATION_CHATS_BYID[x.fed_id] = []
             FEDERATION_CHATS_BYID[x.fed_id].append(x.chat_id)
-    finally:
-        SESSION.close()
+            FED_GRAPH.add_chat(x.fed_id, x.chat_id)
 
 
 def __load_all_feds_banned():
-    global FEDERATION_BANNED_USERID, FEDERATION_BANNED_FULL
-    try:
-        FEDERATION_BANNED_USERID = {}
-        FEDERATION_BANNED_FULL = {}
-        qall = SESSION.query(BansF).all()
-        for x in qall:
-            check = FEDERATION_BANNED_USERID.get(x.fed_id)
-            if check == None:
-                FEDERATION_BANNED_USERID[x.fed_id] = []
-            if int(x.user_id) not in FEDERATION_BANNED_USERID[x.fed_id]:
-                FEDERATION_BANNED_USERID[x.fed_id].append(int(x.user_id))
-            check = FEDERATION_BANNED_FULL.get(x.fed_id)
-            if check == None:
-                FEDERATION_BANNED_FULL[x.fed_id] = {}
-            FEDERATION_BANNED_FULL[x.fed_id][x.user_id] = {
-                "first_name": x.first_name,
-                "last_name": x.last_name,
-                "user_name": x.user_name,
-                "reason": x.reason,
-                "time": x.time,
-            }
-    finally:
-        SESSION.close()
+    global FEDERATION_BANNED_USERID
+    with session_scope() as session:
+        banned = {}
+        qall = session.query(BansF.fed_id, BansF.user_id).yield_per(10000)
+        for fed_id, user_id in qall:
+            banned.setdefault(fed_id, []).append(int(user_id))
+        FEDERATION_BANNED_USERID = {x: IntSet(y) for x, y in banned.items()}
+        FEDERATION_BANNED_INFO.clear()
 
 
 def __load_all_feds_settings():
     global FEDERATION_NOTIFICATION
-    try:
-        getuser = SESSION.query(FedsUserSettings).all()
+    with session_scope() as session:
+        getuser = session.query(FedsUserSettings).all()
         for x in getuser:
             FEDERATION_NOTIFICATION[str(x.user_id)] = x.should_report
-    finally:
-        SESSION.close()
 
 
 def __load_feds_subscriber():
     global FEDS_SUBSCRIBER
     global MYFEDS_SUBSCRIBER
-    try:
-        feds = SESSION.query(FedSubs.fed_id).distinct().all()
-        for (fed_id,) in feds:  # remove tuple by ( ,)
-            FEDS_SUBSCRIBER[fed_id] = []
-            MYFEDS_SUBSCRIBER[fed_id] = []
-
-        all_fedsubs = SESSION.query(FedSubs).all()
-        for x in all_fedsubs:
-            FEDS_SUBSCRIBER[x.fed_id] += [x.fed_subs]
-            try:
-                MYFEDS_SUBSCRIBER[x.fed_subs] += [x.fed_id]
-            except KeyError:
-                getsubs = SESSION.query(FedSubs).get((x.fed_id, x.fed_subs))
-                if getsubs:
-                    SESSION.delete(getsubs)
-                    SESSION.commit()
-
-        FEDS_SUBSCRIBER = {x: set(y) for x, y in FEDS_SUBSCRIBER.items()}
-        MYFEDS_SUBSCRIBER = {x: set(y) for x, y in MYFEDS_SUBSCRIBER.items()}
-
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        FEDS_SUBSCRIBER = {}
+        MYFEDS_SUBSCRIBER = {}
+        for x in session.query(FedSubs).all():
+            FEDS_SUBSCRIBER.setdefault(x.fed_id, set()).add(x.fed_subs)
+            MYFEDS_SUBSCRIBER.setdefault(x.fed_subs, set()).add(x.fed_id)
+            FED_GRAPH.add_subscription(x.fed_id, x.fed_subs)
 
 
 __load_all_feds()
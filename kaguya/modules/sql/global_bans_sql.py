@@ -2,7 +2,8 @@ import threading
 
 from sqlalchemy import Column, UnicodeText, Integer, String, Boolean
 
-from kaguya.modules.sql import BASE, SESSION
+from kaguya.modules.helper_funcs.intset import IntSet
+from kaguya.modules.sql import BASE, session_scope
 
 
 class GloballyBannedUsers(BASE):
@@ -45,46 +46,46 @@ GbanSettings.__table__.create(checkfirst=True)
 
 GBANNED_USERS_LOCK = threading.RLock()
 GBAN_SETTING_LOCK = threading.RLock()
-GBANNED_LIST = set()
+GBANNED_LIST = IntSet()
 GBANSTAT_LIST = set()
 
 
 def gban_user(user_id, name, reason=None):
     with GBANNED_USERS_LOCK:
-        user = SESSION.query(GloballyBannedUsers).get(user_id)
-        if not user:
-            user = GloballyBannedUsers(user_id, name, reason)
-        else:
-            user.name = name
-            user.reason = reason
+        with session_scope(commit=True) as session:
+            user = session.query(GloballyBannedUsers).get(user_id)
+            if not user:
+                user = GloballyBannedUsers(user_id, name, reason)
+            else:
+                user.name = name
+                user.reason = reason
 
-        SESSION.merge(user)
-        SESSION.commit()
-        __load_gbanned_userid_list()
+            session.merge(user)
+        # only once committed, the set must not hold bans the db doesn't
+        GBANNED_LIST.add(user_id)
 
 
 def update_gban_reason(user_id, name, reason=None):
-    with GBANNED_USERS_LOCK:
-        user = SESSION.query(GloballyBannedUsers).get(user_id)
+    with GBANNED_USERS_LOCK, session_scope(commit=True) as session:
+        user = session.query(GloballyBannedUsers).get(user_id)
         if not user:
             return None
         old_reason = user.reason
         user.name = name
         user.reason = reason
 
-        SESSION.merge(user)
-        SESSION.commit()
+        session.merge(user)
         return old_reason
 
 
 def ungban_user(user_id):
     with GBANNED_USERS_LOCK:
-        user = SESSION.query(GloballyBannedUsers).get(user_id)
-        if user:
-            SESSION.delete(user)
+        with session_scope(commit=True) as session:
+            user = session.query(GloballyBannedUsers).get(user_id)
+            if user:
+                session.delete(user)
 
-        SESSION.commit()
-        __load_gbanned_userid_list()
+        GBANNED_LIST.discard(user_id)
 
 
 def is_user_gbanned(user_id):
@@ -92,41 +93,35 @@ def is_user_gbanned(user_id):
 
 
 def get_gbanned_user(user_id):
-    try:
-        return SESSION.query(GloballyBannedUsers).get(user_id)
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(GloballyBannedUsers).get(user_id)
 
 
 def get_gban_list():
-    try:
-        return [x.to_dict() for x in SESSION.query(GloballyBannedUsers).all()]
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return [x.to_dict() for x in session.query(GloballyBannedUsers).all()]
 
 
 def enable_gbans(chat_id):
-    with GBAN_SETTING_LOCK:
-        chat = SESSION.query(GbanSettings).get(str(chat_id))
+    with GBAN_SETTING_LOCK, session_scope(commit=True) as session:
+        chat = session.query(GbanSettings).get(str(chat_id))
         if not chat:
             chat = GbanSettings(chat_id, True)
 
         chat.setting = True
-        SESSION.add(chat)
-        SESSION.commit()
+        session.add(chat)
         if str(chat_id) in GBANSTAT_LIST:
             GBANSTAT_LIST.remove(str(chat_id))
 
 
 def disable_gbans(chat_id):
-    with GBAN_SETTING_LOCK:
-        chat = SESSION.query(GbanSettings).get(str(chat_id))
+    with GBAN_SETTING_LOCK, session_scope(commit=True) as session:
+        chat = session.query(GbanSettings).get(str(chat_id))
         if not chat:
             chat = GbanSettings(chat_id, False)
 
         chat.setting = False
-        SESSION.add(chat)
-        SESSION.commit()
+        session.add(chat)
         GBANSTAT_LIST.add(str(chat_id))
 
 
@@ -140,34 +135,31 @@ def num_gbanned_users():
 
 def __load_gbanned_userid_list():
     global GBANNED_LIST
-    try:
-        GBANNED_LIST = {
-            x.user_id for x in SESSION.query(GloballyBannedUsers).all()
-        }
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        GBANNED_LIST = IntSet(
+            user_id
+            for user_id, in session.query(
+                GloballyBannedUsers.user_id
+            ).yield_per(10000)
+        )
 
 
 def __load_gban_stat_list():
     global GBANSTAT_LIST
-    try:
+    with session_scope() as session:
         GBANSTAT_LIST = {
             x.chat_id
-            for x in SESSION.query(GbanSettings).all()
+            for x in session.query(GbanSettings).all()
             if not x.setting
         }
-    finally:
-        SESSION.close()
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with GBAN_SETTING_LOCK:
-        chat = SESSION.query(GbanSettings).get(str(old_chat_id))
+    with GBAN_SETTING_LOCK, session_scope(commit=True) as session:
+        chat = session.query(GbanSettings).get(str(old_chat_id))
         if chat:
             chat.chat_id = new_chat_id
-            SESSION.add(chat)
-
-        SESSION.commit()
+            session.add(chat)
 
 
 # Create in memory userid to avoid disk access
@@ -3,7 +3,7 @@ import threading
 
 from sqlalchemy import Column, String, Boolean
 
-from kaguya.modules.sql import SESSION, BASE
+from kaguya.modules.sql import BASE, session_scope
 
 
 class Permissions(BASE):
@@ -79,32 +79,73 @@ Restrictions.__table__.create(checkfirst=True)
 PERM_LOCK = threading.RLock()
 RESTR_LOCK = threading.RLock()
 
+# Lock state per chat as bitmaps of the columns above, loaded lazily and
+# kept up to date by every write below.
+LOCK_BITS = {
+    name: 1 << bit
+    for bit, name in enumerate(
+        (
+            "audio",
+            "voice",
+            "contact",
+            "video",
+            "document",
+            "photo",
+            "sticker",
+            "gif",
+            "url",
+            "bots",
+            "forward",
+            "game",
+            "location",
+            "rtl",
+            "button",
+            "egame",
+            "inline",
+        )
+    )
+}
+RESTR_BITS = {
+    name: 1 << bit
+    for bit, name in enumerate(("messages", "media", "other", "preview"))
+}
+CHAT_LOCKS = {}
+CHAT_RESTRICTIONS = {}
+
+
+def _to_bitmap(row, bits):
+    if not row:
+        return 0
+    return sum(bit for name, bit in bits.items() if getattr(row, name))
+
 
 def init_permissions(chat_id, reset=False):
-    curr_perm = SESSION.query(Permissions).get(str(chat_id))
-    if reset:
-        SESSION.delete(curr_perm)
-        SESSION.flush()
-    perm = Permissions(str(chat_id))
-    SESSION.add(perm)
-    SESSION.commit()
+    with session_scope(commit=True) as session:
+        curr_perm = session.query(Permissions).get(str(chat_id))
+        if reset:
+            session.delete(curr_perm)
+            session.flush()
+        perm = Permissions(str(chat_id))
+        session.add(perm)
+    CHAT_LOCKS[str(chat_id)] = 0
     return perm
 
 
 def init_restrictions(chat_id, reset=False):
-    curr_restr = SESSION.query(Restrictions).get(str(chat_id))
-    if reset:
-        SESSION.delete(curr_restr)
-        SESSION.flush()
-    restr = Restrictions(str(chat_id))
-    SESSION.add(restr)
-    SESSION.commit()
+    with session_scope(commit=True) as session:
+        curr_restr = session.query(Restrictions).get(str(chat_id))
+        if reset:
+            session.delete(curr_restr)
+            session.flush()
+        restr = Restrictions(str(chat_id))
+        session.add(restr)
+    CHAT_RESTRICTIONS[str(chat_id)] = 0
     return restr
 
 
 def update_lock(chat_id, lock_type, locked):
-    with PERM_LOCK:
-        curr_perm = SESSION.query(Permissions).get(str(chat_id))
+    with PERM_LOCK, session_scope(commit=True) as session:
+        curr_perm = session.query(Permissions).get(str(chat_id))
         if not curr_perm:
             curr_perm = init_permissions(chat_id)
 
@@ -143,13 +184,13 @@ def update_lock(chat_id, lock_type, locked):
         elif lock_type == "inline":
             curr_perm.inline = locked
 
-        SESSION.add(curr_perm)
-        SESSION.commit()
+        session.add(curr_perm)
+        CHAT_LOCKS[str(chat_id)] = _to_bitmap(curr_perm, LOCK_BITS)
 
 
 def update_restriction(chat_id, restr_type, locked):
-    with RESTR_LOCK:
-        curr_restr = SESSION.query(Restrictions).get(str(chat_id))
+    with RESTR_LOCK, session_scope(commit=True) as session:
+        curr_restr = session.query(Restrictions).get(str(chat_id))
         if not curr_restr:
             curr_restr = init_restrictions(chat_id)
 
@@ -166,100 +207,68 @@ def update_restriction(chat_id, restr_type, locked):
             curr_restr.media = locked
             curr_restr.other = locked
             curr_restr.preview = locked
-        SESSION.add(curr_restr)
-        SESSION.commit()
+        session.add(curr_restr)
+        CHAT_RESTRICTIONS[str(chat_id)] = _to_bitmap(curr_restr, RESTR_BITS)
+
+
+def get_lock_bitmap(chat_id):
+    bitmap = CHAT_LOCKS.get(str(chat_id))
+    if bitmap is None:
+        with session_scope() as session:
+            curr_perm = session.query(Permissions).get(str(chat_id))
+        with PERM_LOCK:
+            bitmap = CHAT_LOCKS.setdefault(
+                str(chat_id), _to_bitmap(curr_perm, LOCK_BITS)
+            )
+    return bitmap
+
+
+def get_restr_bitmap(chat_id):
+    bitmap = CHAT_RESTRICTIONS.get(str(chat_id))
+    if bitmap is None:
+        with session_scope() as session:
+            curr_restr = session.query(Restrictions).get(str(chat_id))
+        with RESTR_LOCK:
+            bitmap = CHAT_RESTRICTIONS.setdefault(
+                str(chat_id), _to_bitmap(curr_restr, RESTR_BITS)
+            )
+    return bitmap
 
 
 def is_locked(chat_id, lock_type):
-    curr_perm = SESSION.query(Permissions).get(str(chat_id))
-    SESSION.close()
-
-    if not curr_perm:
-        return False
-
-    elif lock_type == "sticker":
-        return curr_perm.sticker
-    elif lock_type == "photo":
-        return curr_perm.photo
-    elif lock_type == "audio":
-        return curr_perm.audio
-    elif lock_type == "voice":
-        return curr_perm.voice
-    elif lock_type == "contact":
-        return curr_perm.contact
-    elif lock_type == "video":
-        return curr_perm.video
-    elif lock_type == "document":
-        return curr_perm.document
-    elif lock_type == "gif":
-        return curr_perm.gif
-    elif lock_type == "url":
-        return curr_perm.url
-    elif lock_type == "bots":
-        return curr_perm.bots
-    elif lock_type == "forward":
-        return curr_perm.forward
-    elif lock_type == "game":
-        return curr_perm.game
-    elif lock_type == "location":
-        return curr_perm.location
-    elif lock_type == "rtl":
-        return curr_perm.rtl
-    elif lock_type == "button":
-        return curr_perm.button
-    elif lock_type == "egame":
-        return curr_perm.egame
-    elif lock_type == "inline":
-        return curr_perm.inline
+    return bool(get_lock_bitmap(chat_id) & LOCK_BITS.get(lock_type, 0))
 
 
 def is_restr_locked(chat_id, lock_type):
-    curr_restr = SESSION.query(Restrictions).get(str(chat_id))
-    SESSION.close()
-
-    if not curr_restr:
-        return False
-
-    if lock_type == "messages":
-        return curr_restr.messages
-    elif lock_type == "media":
-        return curr_restr.media
-    elif lock_type == "other":
-        return curr_restr.other
-    elif lock_type == "previews":
-        return curr_restr.preview
-    elif lock_type == "all":
-        return (
-            curr_restr.messages
-            and curr_restr.media
-            and curr_restr.other
-            and curr_restr.preview
-        )
+    bitmap = get_restr_bitmap(chat_id)
+    if lock_type == "all":
+        return bitmap == sum(RESTR_BITS.values())
+    if lock_type == "previews":
+        lock_type = "preview"
+    return bool(bitmap & RESTR_BITS.get(lock_type, 0))
 
 
 def get_locks(chat_id):
-    try:
-        return SESSION.query(Permissions).get(str(chat_id))
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(Permissions).get(str(chat_id))
 
 
 def get_restr(chat_id):
-    try:
-        return SESSION.query(Restrictions).get(str(chat_id))
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(Restrictions).get(str(chat_id))
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with PERM_LOCK:
-        perms = SESSION.query(Permissions).get(str(old_chat_id))
+    with PERM_LOCK, session_scope(commit=True) as session:
+        perms = session.query(Permissions).get(str(old_chat_id))
         if perms:
             perms.chat_id = str(new_chat_id)
-        SESSION.commit()
+        CHAT_LOCKS.pop(str(old_chat_id), None)
+        CHAT_LOCKS.pop(str(new_chat_id), None)
 
-    with RESTR_LOCK:
-        rest = SESSION.query(Restrictions).get(str(old_chat_id))
+    with RESTR_LOCK, session_scope(commit=True) as session:
+        rest = session.query(Restrictions).get(str(old_chat_id))
         if rest:
             rest.chat_id = str(new_chat_id)
-        SESSION.commit()
+        CHAT_RESTRICTIONS.pop(str(old_chat_id), None)
+        CHAT_RESTRICTIONS.pop(str(new_chat_id), None)
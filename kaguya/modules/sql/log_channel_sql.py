@@ -2,7 +2,7 @@ import threading
 
 from sqlalchemy import Column, String, func, distinct
 
-from kaguya.modules.sql import BASE, SESSION
+from kaguya.modules.sql import BASE, session_scope
 
 
 class GroupLogs(BASE):
@@ -23,16 +23,15 @@ CHANNELS = {}
 
 
 def set_chat_log_channel(chat_id, log_channel):
-    with LOGS_INSERTION_LOCK:
-        res = SESSION.query(GroupLogs).get(str(chat_id))
+    with LOGS_INSERTION_LOCK, session_scope(commit=True) as session:
+        res = session.query(GroupLogs).get(str(chat_id))
         if res:
             res.log_channel = log_channel
         else:
             res = GroupLogs(chat_id, log_channel)
-            SESSION.add(res)
+            session.add(res)
 
         CHANNELS[str(chat_id)] = log_channel
-        SESSION.commit()
 
 
 def get_chat_log_channel(chat_id):
@@ -40,44 +39,37 @@ def get_chat_log_channel(chat_id):
 
 
 def stop_chat_logging(chat_id):
-    with LOGS_INSERTION_LOCK:
-        res = SESSION.query(GroupLogs).get(str(chat_id))
+    with LOGS_INSERTION_LOCK, session_scope(commit=True) as session:
+        res = session.query(GroupLogs).get(str(chat_id))
         if res:
             if str(chat_id) in CHANNELS:
                 del CHANNELS[str(chat_id)]
 
             log_channel = res.log_channel
-            SESSION.delete(res)
-            SESSION.commit()
+            session.delete(res)
             return log_channel
 
 
 def num_logchannels():
-    try:
-        return SESSION.query(func.count(distinct(GroupLogs.chat_id))).scalar()
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(func.count(distinct(GroupLogs.chat_id))).scalar()
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with LOGS_INSERTION_LOCK:
-        chat = SESSION.query(GroupLogs).get(str(old_chat_id))
+    with LOGS_INSERTION_LOCK, session_scope(commit=True) as session:
+        chat = session.query(GroupLogs).get(str(old_chat_id))
         if chat:
             chat.chat_id = str(new_chat_id)
-            SESSION.add(chat)
+            session.add(chat)
             if str(old_chat_id) in CHANNELS:
                 CHANNELS[str(new_chat_id)] = CHANNELS.get(str(old_chat_id))
 
-        SESSION.commit()
-
 
 def __load_log_channels():
     global CHANNELS
-    try:
-        all_chats = SESSION.query(GroupLogs).all()
+    with session_scope() as session:
+        all_chats = session.query(GroupLogs).all()
         CHANNELS = {chat.chat_id: chat.log_channel for chat in all_chats}
-    finally:
-        SESSION.close()
 
 
 __load_log_channels()
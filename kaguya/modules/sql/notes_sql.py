@@ -12,7 +12,7 @@ from sqlalchemy import (
 )
 
 from kaguya.modules.helper_funcs.msg_types import Types
-from kaguya.modules.sql import SESSION, BASE
+from kaguya.modules.sql import BASE, session_scope
 
 
 class Notes(BASE):
@@ -66,12 +66,12 @@ def add_note_to_db(
     if not buttons:
         buttons = []
 
-    with NOTES_INSERTION_LOCK:
-        prev = SESSION.query(Notes).get((str(chat_id), note_name))
+    with NOTES_INSERTION_LOCK, session_scope(commit=True) as session:
+        prev = session.query(Notes).get((str(chat_id), note_name))
         if prev:
             with BUTTONS_INSERTION_LOCK:
                 prev_buttons = (
-                    SESSION.query(Buttons)
+                    session.query(Buttons)
                     .filter(
                         Buttons.chat_id == str(chat_id),
                         Buttons.note_name == note_name,
@@ -79,8 +79,8 @@ def add_note_to_db(
                     .all()
                 )
                 for btn in prev_buttons:
-                    SESSION.delete(btn)
-            SESSION.delete(prev)
+                    session.delete(btn)
+            session.delete(prev)
         note = Notes(
             str(chat_id),
             note_name,
@@ -88,31 +88,28 @@ def add_note_to_db(
             msgtype=msgtype.value,
             file=file,
         )
-        SESSION.add(note)
-        SESSION.commit()
+        session.add(note)
 
     for b_name, url, same_line in buttons:
         add_note_button_to_db(chat_id, note_name, b_name, url, same_line)
 
 
 def get_note(chat_id, note_name):
-    try:
+    with session_scope() as session:
         return (
-            SESSION.query(Notes)
+            session.query(Notes)
             .filter(
                 func.lower(Notes.name) == note_name,
                 Notes.chat_id == str(chat_id),
             )
             .first()
         )
-    finally:
-        SESSION.close()
 
 
 def rm_note(chat_id, note_name):
-    with NOTES_INSERTION_LOCK:
+    with NOTES_INSERTION_LOCK, session_scope(commit=True) as session:
         note = (
-            SESSION.query(Notes)
+            session.query(Notes)
             .filter(
                 func.lower(Notes.name) == note_name,
                 Notes.chat_id == str(chat_id),
@@ -122,7 +119,7 @@ def rm_note(chat_id, note_name):
         if note:
             with BUTTONS_INSERTION_LOCK:
                 buttons = (
-                    SESSION.query(Buttons)
+                    session.query(Buttons)
                     .filter(
                         Buttons.chat_id == str(chat_id),
                         Buttons.note_name == note_name,
@@ -130,68 +127,57 @@ def rm_note(chat_id, note_name):
                     .all()
                 )
                 for btn in buttons:
-                    SESSION.delete(btn)
+                    session.delete(btn)
 
-            SESSION.delete(note)
-            SESSION.commit()
+            session.delete(note)
             return True
 
         else:
-            SESSION.close()
             return False
 
 
 def get_all_chat_notes(chat_id):
-    try:
+    with session_scope() as session:
         return (
-            SESSION.query(Notes)
+            session.query(Notes)
             .filter(Notes.chat_id == str(chat_id))
             .order_by(Notes.name.asc())
             .all()
         )
-    finally:
-        SESSION.close()
 
 
 def add_note_button_to_db(chat_id, note_name, b_name, url, same_line):
-    with BUTTONS_INSERTION_LOCK:
+    with BUTTONS_INSERTION_LOCK, session_scope(commit=True) as session:
         button = Buttons(chat_id, note_name, b_name, url, same_line)
-        SESSION.add(button)
-        SESSION.commit()
+        session.add(button)
 
 
 def get_buttons(chat_id, note_name):
-    try:
+    with session_scope() as session:
         return (
-            SESSION.query(Buttons)
+            session.query(Buttons)
             .filter(
                 Buttons.chat_id == str(chat_id), Buttons.note_name == note_name
             )
             .order_by(Buttons.id)
             .all()
         )
-    finally:
-        SESSION.close()
 
 
 def num_notes():
-    try:
-        return SESSION.query(Notes).count()
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(Notes).count()
 
 
 def num_chats():
-    try:
-        return SESSION.query(func.count(distinct(Notes.chat_id))).scalar()
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(func.count(distinct(Notes.chat_id))).scalar()
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with NOTES_INSERTION_LOCK:
+    with NOTES_INSERTION_LOCK, session_scope(commit=True) as session:
         chat_notes = (
-            SESSION.query(Notes)
+            session.query(Notes)
             .filter(Notes.chat_id == str(old_chat_id))
             .all()
         )
@@ -200,11 +186,9 @@ def migrate_chat(old_chat_id, new_chat_id):
 
         with BUTTONS_INSERTION_LOCK:
             chat_buttons = (
-                SESSION.query(Buttons)
+                session.query(Buttons)
                 .filter(Buttons.chat_id == str(old_chat_id))
                 .all()
             )
             for btn in chat_buttons:
                 btn.chat_id = str(new_chat_id)
-
-        SESSION.commit()
@@ -2,7 +2,7 @@ import threading
 
 from sqlalchemy import Column, String, UnicodeText, func, distinct
 
-from kaguya.modules.sql import SESSION, BASE
+from kaguya.modules.sql import BASE, session_scope
 
 
 class Rules(BASE):
@@ -23,36 +23,32 @@ INSERTION_LOCK = threading.RLock()
 
 
 def set_rules(chat_id, rules_text):
-    with INSERTION_LOCK:
-        rules = SESSION.query(Rules).get(str(chat_id))
+    with INSERTION_LOCK, session_scope(commit=True) as session:
+        rules = session.query(Rules).get(str(chat_id))
         if not rules:
             rules = Rules(str(chat_id))
         rules.rules = rules_text
 
-        SESSION.add(rules)
-        SESSION.commit()
+        session.add(rules)
 
 
 def get_rules(chat_id):
-    rules = SESSION.query(Rules).get(str(chat_id))
+    with session_scope() as session:
+        rules = session.query(Rules).get(str(chat_id))
     ret = ""
     if rules:
         ret = rules.rules
 
-    SESSION.close()
     return ret
 
 
 def num_chats():
-    try:
-        return SESSION.query(func.count(distinct(Rules.chat_id))).scalar()
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(func.count(distinct(Rules.chat_id))).scalar()
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with INSERTION_LOCK:
-        chat = SESSION.query(Rules).get(str(old_chat_id))
+    with INSERTION_LOCK, session_scope(commit=True) as session:
+        chat = session.query(Rules).get(str(old_chat_id))
         if chat:
             chat.chat_id = str(new_chat_id)
-        SESSION.commit()
@@ -1,3 +1,4 @@
+import atexit
 import threading
 
 from sqlalchemy import (
@@ -9,9 +10,11 @@ from sqlalchemy import (
     UniqueConstraint,
     func,
 )
+from sqlalchemy.dialects import postgresql
 
-from kaguya import dispatcher
-from kaguya.modules.sql import BASE, SESSION
+from kaguya import dispatcher, LOGGER
+from kaguya.mwt import TTLCache
+from kaguya.modules.sql import BASE, session_scope
 
 
 class Users(BASE):
@@ -77,39 +80,50 @@ ChatMembers.__table__.create(checkfirst=True)
 
 INSERTION_LOCK = threading.RLock()
 
+# Write-behind buffer for seen users/chats/memberships, see queue_user.
+USER_BUFFER_MAX = 500
+USER_BUFFER_INTERVAL = 2  # seconds between periodic flushes
+BUFFER_LOCK = threading.RLock()
+PENDING_USERS = {}
+PENDING_CHATS = {}
+PENDING_MEMBERS = set()
+
+# Rows as last written to the db, so repeat sightings skip the buffer.
+KNOWN_USERS = TTLCache(timeout=60 * 60, maxsize=200000)
+KNOWN_CHATS = TTLCache(timeout=60 * 60, maxsize=50000)
+KNOWN_MEMBERS = TTLCache(timeout=60 * 60, maxsize=500000)
+
 
 def ensure_bot_in_db():
-    with INSERTION_LOCK:
+    with INSERTION_LOCK, session_scope(commit=True) as session:
         bot = Users(dispatcher.bot.id, dispatcher.bot.username)
-        SESSION.merge(bot)
-        SESSION.commit()
+        session.merge(bot)
 
 
 def update_user(user_id, username, chat_id=None, chat_name=None):
-    with INSERTION_LOCK:
-        user = SESSION.query(Users).get(user_id)
+    with INSERTION_LOCK, session_scope(commit=True) as session:
+        user = session.query(Users).get(user_id)
         if not user:
             user = Users(user_id, username)
-            SESSION.add(user)
-            SESSION.flush()
+            session.add(user)
+            session.flush()
         else:
             user.username = username
 
         if not chat_id or not chat_name:
-            SESSION.commit()
             return
 
-        chat = SESSION.query(Chats).get(str(chat_id))
+        chat = session.query(Chats).get(str(chat_id))
         if not chat:
             chat = Chats(str(chat_id), chat_name)
-            SESSION.add(chat)
-            SESSION.flush()
+            session.add(chat)
+            session.flush()
 
         else:
             chat.chat_name = chat_name
 
         member = (
-            SESSION.query(ChatMembers)
+            session.query(ChatMembers)
             .filter(
                 ChatMembers.chat == chat.chat_id,
                 ChatMembers.user == user.user_id,
@@ -118,115 +132,189 @@ def update_user(user_id, username, chat_id=None, chat_name=None):
         )
         if not member:
             chat_member = ChatMembers(chat.chat_id, user.user_id)
-            SESSION.add(chat_member)
+            session.add(chat_member)
+
+
+def queue_user(user_id, username, chat_id=None, chat_name=None):
+    """
+    Buffered update_user: record a sighting to be written by flush_users.
 
-        SESSION.commit()
+    Sightings matching what was last written are dropped right away.
+    """
+    chat_id = str(chat_id) if chat_id and chat_name else None
+    if KNOWN_USERS.get(user_id, False) == (username,) and (
+        not chat_id
+        or (
+            KNOWN_CHATS.get(chat_id) == chat_name
+            and KNOWN_MEMBERS.get((chat_id, user_id))
+        )
+    ):
+        return
+
+    with BUFFER_LOCK:
+        PENDING_USERS[user_id] = username
+        if chat_id:
+            PENDING_CHATS[chat_id] = chat_name
+            PENDING_MEMBERS.add((chat_id, user_id))
+        should_flush = len(PENDING_USERS) >= USER_BUFFER_MAX
+
+    if should_flush:
+        flush_users()
+
+
+def flush_users():
+    """Write all buffered sightings as bulk upserts in one transaction."""
+    global PENDING_USERS, PENDING_CHATS, PENDING_MEMBERS
+    with BUFFER_LOCK:
+        if not PENDING_USERS:
+            return
+        users, PENDING_USERS = PENDING_USERS, {}
+        chats, PENDING_CHATS = PENDING_CHATS, {}
+        members, PENDING_MEMBERS = PENDING_MEMBERS, set()
+
+    with INSERTION_LOCK:
+        try:
+            with session_scope(commit=True) as session:
+                stmt = postgresql.insert(Users.__table__).values(
+                    [
+                        {"user_id": user_id, "username": username}
+                        for user_id, username in users.items()
+                    ]
+                )
+                session.execute(
+                    stmt.on_conflict_do_update(
+                        index_elements=[Users.user_id],
+                        set_={"username": stmt.excluded.username},
+                    )
+                )
+                if chats:
+                    stmt = postgresql.insert(Chats.__table__).values(
+                        [
+                            {"chat_id": chat_id, "chat_name": chat_name}
+                            for chat_id, chat_name in chats.items()
+                        ]
+                    )
+                    session.execute(
+                        stmt.on_conflict_do_update(
+                            index_elements=[Chats.chat_id],
+                            set_={"chat_name": stmt.excluded.chat_name},
+                        )
+                    )
+                    session.execute(
+                        postgresql.insert(ChatMembers.__table__)
+                        .values(
+                            [
+                                {"chat": chat_id, "user": user_id}
+                                for chat_id, user_id in members
+                            ]
+                        )
+                        .on_conflict_do_nothing(constraint="_chat_members_uc")
+                    )
+        except Exception:
+            LOGGER.exception("Failed to flush %d seen users", len(users))
+            return
+
+    for user_id, username in users.items():
+        # wrapped so a None username still counts as known
+        KNOWN_USERS.set(user_id, (username,))
+    for chat_id, chat_name in chats.items():
+        KNOWN_CHATS.set(chat_id, chat_name)
+    for key in members:
+        KNOWN_MEMBERS.set(key, True)
+
+
+atexit.register(flush_users)
 
 
 def get_userid_by_name(username):
-    try:
+    with session_scope() as session:
         return (
-            SESSION.query(Users)
+            session.query(Users)
             .filter(func.lower(Users.username) == username.lower())
             .all()
         )
-    finally:
-        SESSION.close()
 
 
 def get_name_by_userid(user_id):
-    try:
-        return SESSION.query(Users).get(Users.user_id == int(user_id)).first()
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(Users).get(Users.user_id == int(user_id)).first()
 
 
 def get_chat_members(chat_id):
-    try:
+    with session_scope() as session:
         return (
-            SESSION.query(ChatMembers)
+            session.query(ChatMembers)
             .filter(ChatMembers.chat == str(chat_id))
             .all()
         )
-    finally:
-        SESSION.close()
 
 
 def get_all_chats():
-    try:
-        return SESSION.query(Chats).all()
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(Chats).all()
 
 
 def get_user_num_chats(user_id):
-    try:
+    with session_scope() as session:
         return (
-            SESSION.query(ChatMembers)
+            session.query(ChatMembers)
             .filter(ChatMembers.user == int(user_id))
             .count()
         )
-    finally:
-        SESSION.close()
 
 
 def num_chats():
-    try:
-        return SESSION.query(Chats).count()
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(Chats).count()
 
 
 def num_users():
-    try:
-        return SESSION.query(Users).count()
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(Users).count()
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with INSERTION_LOCK:
-        chat = SESSION.query(Chats).get(str(old_chat_id))
+    flush_users()
+    KNOWN_CHATS.invalidate(str(old_chat_id))
+    KNOWN_MEMBERS.invalidate(str(old_chat_id))
+    with INSERTION_LOCK, session_scope(commit=True) as session:
+        chat = session.query(Chats).get(str(old_chat_id))
         if chat:
             chat.chat_id = str(new_chat_id)
-            SESSION.add(chat)
+            session.add(chat)
 
-        SESSION.flush()
+        session.flush()
 
         chat_members = (
-            SESSION.query(ChatMembers)
+            session.query(ChatMembers)
             .filter(ChatMembers.chat == str(old_chat_id))
             .all()
         )
         for member in chat_members:
             member.chat = str(new_chat_id)
-            SESSION.add(member)
-
-        SESSION.commit()
+            session.add(member)
 
 
 ensure_bot_in_db()
 
 
 def del_user(user_id):
-    with INSERTION_LOCK:
-        curr = SESSION.query(Users).get(user_id)
+    KNOWN_USERS.invalidate(user_id)
+    KNOWN_MEMBERS.clear()
+    with INSERTION_LOCK, session_scope(commit=True) as session:
+        curr = session.query(Users).get(user_id)
         if curr:
-            SESSION.delete(curr)
-            SESSION.commit()
+            session.delete(curr)
             return True
 
-        ChatMembers.query.filter(ChatMembers.user == user_id).delete()
-        SESSION.commit()
-        SESSION.close()
+        session.query(ChatMembers).filter(ChatMembers.user == user_id).delete()
     return False
 
 
 def rem_chat(chat_id):
-    with INSERTION_LOCK:
-        chat = SESSION.query(Chats).get(str(chat_id))
+    KNOWN_CHATS.invalidate(str(chat_id))
+    KNOWN_MEMBERS.invalidate(str(chat_id))
+    with INSERTION_LOCK, session_scope(commit=True) as session:
+        chat = session.query(Chats).get(str(chat_id))
         if chat:
-            SESSION.delete(chat)
-            SESSION.commit()
-        else:
-            SESSION.close()
+            session.delete(chat)
@@ -11,7 +11,8 @@ from sqlalchemy import (
 )
 from sqlalchemy.dialects import postgresql
 
-from kaguya.modules.sql import SESSION, BASE
+from kaguya.modules.helper_funcs.matcher import KeywordMatcher
+from kaguya.modules.sql import BASE, session_scope
 
 
 class Warns(BASE):
@@ -82,11 +83,12 @@ WARN_FILTER_INSERTION_LOCK = threading.RLock()
 WARN_SETTINGS_LOCK = threading.RLock()
 
 WARN_FILTERS = {}
+WARN_MATCHERS = {}
 
 
 def warn_user(user_id, chat_id, reason=None):
-    with WARN_INSERTION_LOCK:
-        warned_user = SESSION.query(Warns).get((user_id, str(chat_id)))
+    with WARN_INSERTION_LOCK, session_scope(commit=True) as session:
+        warned_user = session.query(Warns).get((user_id, str(chat_id)))
         if not warned_user:
             warned_user = Warns(user_id, str(chat_id))
 
@@ -106,16 +108,15 @@ def warn_user(user_id, chat_id, reason=None):
         reasons = warned_user.reasons
         num = warned_user.num_warns
 
-        SESSION.add(warned_user)
-        SESSION.commit()
+        session.add(warned_user)
 
         return num, reasons
 
 
 def remove_warn(user_id, chat_id):
-    with WARN_INSERTION_LOCK:
+    with WARN_INSERTION_LOCK, session_scope(commit=True) as session:
         removed = False
-        warned_user = SESSION.query(Warns).get((user_id, str(chat_id)))
+        warned_user = session.query(Warns).get((user_id, str(chat_id)))
         temp_reason = []
 
         if warned_user and warned_user.num_warns > 0:
@@ -128,40 +129,34 @@ def remove_warn(user_id, chat_id):
                 del temp_reason[-1]
                 warned_user.reasons = temp_reason
 
-            SESSION.add(warned_user)
-            SESSION.commit()
+            session.add(warned_user)
             removed = True
 
-        SESSION.close()
         return removed
 
 
 def reset_warns(user_id, chat_id):
-    with WARN_INSERTION_LOCK:
-        warned_user = SESSION.query(Warns).get((user_id, str(chat_id)))
+    with WARN_INSERTION_LOCK, session_scope(commit=True) as session:
+        warned_user = session.query(Warns).get((user_id, str(chat_id)))
         if warned_user:
             warned_user.num_warns = 0
             warned_user.reasons = []
 
-            SESSION.add(warned_user)
-            SESSION.commit()
-        SESSION.close()
+            session.add(warned_user)
 
 
 def get_warns(user_id, chat_id):
-    try:
-        user = SESSION.query(Warns).get((user_id, str(chat_id)))
+    with session_scope() as session:
+        user = session.query(Warns).get((user_id, str(chat_id)))
         if not user:
             return None
         reasons = user.reasons
         num = user.num_warns
         return num, reasons
-    finally:
-        SESSION.close()
 
 
 def add_warn_filter(chat_id, keyword, reply):
-    with WARN_FILTER_INSERTION_LOCK:
+    with WARN_FILTER_INSERTION_LOCK, session_scope(commit=True) as session:
         warn_filt = WarnFilters(str(chat_id), keyword, reply)
 
         if keyword not in WARN_FILTERS.get(str(chat_id), []):
@@ -169,22 +164,21 @@ def add_warn_filter(chat_id, keyword, reply):
                 WARN_FILTERS.get(str(chat_id), []) + [keyword],
                 key=lambda x: (-len(x), x),
             )
+            WARN_MATCHERS.pop(str(chat_id), None)
 
-        SESSION.merge(warn_filt)  # merge to avoid duplicate key issues
-        SESSION.commit()
+        session.merge(warn_filt)  # merge to avoid duplicate key issues
 
 
 def remove_warn_filter(chat_id, keyword):
-    with WARN_FILTER_INSERTION_LOCK:
-        warn_filt = SESSION.query(WarnFilters).get((str(chat_id), keyword))
+    with WARN_FILTER_INSERTION_LOCK, session_scope(commit=True) as session:
+        warn_filt = session.query(WarnFilters).get((str(chat_id), keyword))
         if warn_filt:
             if keyword in WARN_FILTERS.get(str(chat_id), []):  # sanity check
                 WARN_FILTERS.get(str(chat_id), []).remove(keyword)
+                WARN_MATCHERS.pop(str(chat_id), None)
 
-            SESSION.delete(warn_filt)
-            SESSION.commit()
+            session.delete(warn_filt)
             return True
-        SESSION.close()
         return False
 
 
@@ -192,109 +186,107 @@ def get_chat_warn_triggers(chat_id):
     return WARN_FILTERS.get(str(chat_id), set())
 
 
+def get_chat_warn_matcher(chat_id):
+    matcher = WARN_MATCHERS.get(str(chat_id))
+    if matcher is None:
+        with WARN_FILTER_INSERTION_LOCK:
+            matcher = WARN_MATCHERS[str(chat_id)] = KeywordMatcher(
+                WARN_FILTERS.get(str(chat_id), [])
+            )
+    return matcher
+
+
+def match_warn_filter(chat_id, text):
+    # text is expected lowercased already, see MessageAnalysis.lowered
+    if not WARN_FILTERS.get(str(chat_id)):
+        return None
+    return get_chat_warn_matcher(chat_id).search(text, normalized=True)
+
+
 def get_chat_warn_filters(chat_id):
-    try:
+    with session_scope() as session:
         return (
-            SESSION.query(WarnFilters)
+            session.query(WarnFilters)
             .filter(WarnFilters.chat_id == str(chat_id))
             .all()
         )
-    finally:
-        SESSION.close()
 
 
 def get_warn_filter(chat_id, keyword):
-    try:
-        return SESSION.query(WarnFilters).get((str(chat_id), keyword))
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(WarnFilters).get((str(chat_id), keyword))
 
 
 def set_warn_limit(chat_id, warn_limit):
-    with WARN_SETTINGS_LOCK:
-        curr_setting = SESSION.query(WarnSettings).get(str(chat_id))
+    with WARN_SETTINGS_LOCK, session_scope(commit=True) as session:
+        curr_setting = session.query(WarnSettings).get(str(chat_id))
         if not curr_setting:
             curr_setting = WarnSettings(chat_id, warn_limit=warn_limit)
 
         curr_setting.warn_limit = warn_limit
 
-        SESSION.add(curr_setting)
-        SESSION.commit()
+        session.add(curr_setting)
 
 
 def set_warn_strength(chat_id, soft_warn):
-    with WARN_SETTINGS_LOCK:
-        curr_setting = SESSION.query(WarnSettings).get(str(chat_id))
+    with WARN_SETTINGS_LOCK, session_scope(commit=True) as session:
+        curr_setting = session.query(WarnSettings).get(str(chat_id))
         if not curr_setting:
             curr_setting = WarnSettings(chat_id, soft_warn=soft_warn)
 
         curr_setting.soft_warn = soft_warn
 
-        SESSION.add(curr_setting)
-        SESSION.commit()
+        session.add(curr_setting)
 
 
 def get_warn_setting(chat_id):
-    try:
-        setting = SESSION.query(WarnSettings).get(str(chat_id))
+    with session_scope() as session:
+        setting = session.query(WarnSettings).get(str(chat_id))
         if setting:
             return setting.warn_limit, setting.soft_warn
         else:
             return 3, False
 
-    finally:
-        SESSION.close()
-
 
 def num_warns():
-    try:
-        return SESSION.query(func.sum(Warns.num_warns)).scalar() or 0
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(func.sum(Warns.num_warns)).scalar() or 0
 
 
 def num_warn_chats():
-    try:
-        return SESSION.query(func.count(distinct(Warns.chat_id))).scalar()
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(func.count(distinct(Warns.chat_id))).scalar()
 
 
 def num_warn_filters():
-    try:
-        return SESSION.query(WarnFilters).count()
-    finally:
-        SESSION.close()
+    with session_scope() as session:
+        return session.query(WarnFilters).count()
 
 
 def num_warn_chat_filters(chat_id):
-    try:
+    with session_scope() as session:
         return (
-            SESSION.query(WarnFilters.chat_id)
+            session.query(WarnFilters.chat_id)
             .filter(WarnFilters.chat_id == str(chat_id))
             .count()
         )
-    finally:
-        SESSION.close()
 
 
 def num_warn_filter_chats():
-    try:
-        return SESSION.query(
+    with session_scope() as session:
+        return session.query(
             func.count(distinct(WarnFilters.chat_id))
         ).scalar()
-    finally:
-        SESSION.close()
 
 
 def __load_chat_warn_filters():
     global WARN_FILTERS
-    try:
-        chats = SESSION.query(WarnFilters.chat_id).distinct().all()
+    with session_scope() as session:
+        chats = session.query(WarnFilters.chat_id).distinct().all()
         for (chat_id,) in chats:  # remove tuple by ( ,)
             WARN_FILTERS[chat_id] = []
 
-        all_filters = SESSION.query(WarnFilters).all()
+        all_filters = session.query(WarnFilters).all()
         for x in all_filters:
             WARN_FILTERS[x.chat_id] += [x.keyword]
 
@@ -303,42 +295,38 @@ def __load_chat_warn_filters():
             for x, y in WARN_FILTERS.items()
         }
 
-    finally:
-        SESSION.close()
-
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with WARN_INSERTION_LOCK:
+    with WARN_INSERTION_LOCK, session_scope(commit=True) as session:
         chat_notes = (
-            SESSION.query(Warns)
+            session.query(Warns)
             .filter(Warns.chat_id == str(old_chat_id))
             .all()
         )
         for note in chat_notes:
             note.chat_id = str(new_chat_id)
-        SESSION.commit()
 
-    with WARN_FILTER_INSERTION_LOCK:
+    with WARN_FILTER_INSERTION_LOCK, session_scope(commit=True) as session:
         chat_filters = (
-            SESSION.query(WarnFilters)
+            session.query(WarnFilters)
             .filter(WarnFilters.chat_id == str(old_chat_id))
             .all()
         )
         for filt in chat_filters:
             filt.chat_id = str(new_chat_id)
-        SESSION.commit()
         WARN_FILTERS[str(new_chat_id)] = WARN_FILTERS[str(old_chat_id)]
         del WARN_FILTERS[str(old_chat_id)]
+        WARN_MATCHERS.pop(str(old_chat_id), None)
+        WARN_MATCHERS.pop(str(new_chat_id), None)
 
-    with WARN_SETTINGS_LOCK:
+    with WARN_SETTINGS_LOCK, session_scope(commit=True) as session:
         chat_settings = (
-            SESSION.query(WarnSettings)
+            session.query(WarnSettings)
             .filter(WarnSettings.chat_id == str(old_chat_id))
             .all()
         )
         for setting in chat_settings:
             setting.chat_id = str(new_chat_id)
-        SESSION.commit()
 
 
 __load_chat_warn_filters()
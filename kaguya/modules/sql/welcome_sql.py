@@ -1,4 +1,6 @@
+import heapq
 import threading
+from collections import namedtuple
 from typing import Union
 from sqlalchemy import (
     Column,
@@ -7,10 +9,12 @@ from sqlalchemy import (
     UnicodeText,
     Integer,
     BigInteger,
+    tuple_,
 )
 
 from kaguya.modules.helper_funcs.msg_types import Types
-from kaguya.modules.sql import SESSION, BASE
+from kaguya.modules.sql import BASE, session_scope
+from kaguya.mwt import TTLCache
 
 DEFAULT_WELCOME = "Hi {first}, how are you?"
 DEFAULT_GOODBYE = "{first} has left the game."
@@ -105,43 +109,131 @@ class CleanServiceSetting(BASE):
         return "<Chat used clean service ({})>".format(self.chat_id)
 
 
+class HumanCheckPending(BASE):
+    __tablename__ = "human_check_pending"
+    chat_id = Column(String(14), primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    deadline = Column(Integer, nullable=False)
+
+    def __init__(self, chat_id, user_id, deadline):
+        self.chat_id = str(chat_id)
+        self.user_id = user_id
+        self.deadline = int(deadline)
+
+    def __repr__(self):
+        return "<Human check of {} in {} due {}>".format(
+            self.user_id, self.chat_id, self.deadline
+        )
+
+
 Welcome.__table__.create(checkfirst=True)
 WelcomeButtons.__table__.create(checkfirst=True)
 GoodbyeButtons.__table__.create(checkfirst=True)
 WelcomeMute.__table__.create(checkfirst=True)
 WelcomeMuteUsers.__table__.create(checkfirst=True)
 CleanServiceSetting.__table__.create(checkfirst=True)
+HumanCheckPending.__table__.create(checkfirst=True)
 
 INSERTION_LOCK = threading.RLock()
 WELC_BTN_LOCK = threading.RLock()
 LEAVE_BTN_LOCK = threading.RLock()
 WM_LOCK = threading.RLock()
 CS_LOCK = threading.RLock()
+HC_LOCK = threading.RLock()
+
+# (chat_id, user_id) -> deadline of users who still have to press the
+# welcomemute button, and the same as a heap of (deadline, chat_id,
+# user_id) which may hold outdated entries; see pop_expired_checks
+PENDING_CHECKS = {}
+PENDING_DEADLINES = []
+# (chat_id, user_id) of users who left, for sweeping their human checks
+STALE_CHECKS = set()
+
+# chat_id -> all of a chat's welcome settings, see __load_chat_settings.
+# Dropped by every setter, so the timeout only bounds the memory used.
+CHAT_SETTINGS = TTLCache(timeout=60 * 60, maxsize=5000)
+
+Button = namedtuple("Button", ["name", "url", "same_line"])
+
+
+def __load_chat_settings(chat_id):
+    with session_scope() as session:
+        welc = session.query(Welcome).get(chat_id)
+        mutes = session.query(WelcomeMute).get(chat_id)
+        cleanserv = session.query(CleanServiceSetting).get(chat_id)
+        welc_buttons = (
+            session.query(WelcomeButtons)
+            .filter(WelcomeButtons.chat_id == chat_id)
+            .order_by(WelcomeButtons.id)
+            .all()
+        )
+        gdbye_buttons = (
+            session.query(GoodbyeButtons)
+            .filter(GoodbyeButtons.chat_id == chat_id)
+            .order_by(GoodbyeButtons.id)
+            .all()
+        )
+        if welc:
+            welcome = (
+                welc.should_welcome,
+                welc.custom_welcome,
+                welc.welcome_type,
+            )
+            goodbye = (welc.should_goodbye, welc.custom_leave, welc.leave_type)
+        else:
+            # Welcome by default.
+            welcome = (True, DEFAULT_WELCOME, Types.TEXT)
+            goodbye = (True, DEFAULT_GOODBYE, Types.TEXT)
+        return {
+            "welcome": welcome,
+            "goodbye": goodbye,
+            "clean_welcome": welc.clean_welcome if welc else False,
+            "welcome_mutes": mutes.welcomemutes if mutes else False,
+            "clean_service": cleanserv.clean_service if cleanserv else False,
+            "welcome_buttons": [
+                Button(x.name, x.url, x.same_line) for x in welc_buttons
+            ],
+            "goodbye_buttons": [
+                Button(x.name, x.url, x.same_line) for x in gdbye_buttons
+            ],
+        }
+
+
+def get_chat_settings(chat_id) -> dict:
+    """
+    Every welcome setting of chat_id, read with one round of queries
+    and cached until one of the set_* functions changes them.
+
+    The dict is shared, don't modify it; a new one is made on changes.
+    """
+    chat_id = str(chat_id)
+    return CHAT_SETTINGS.get_or_load(
+        chat_id, lambda: __load_chat_settings(chat_id)
+    )
+
+
+def __invalidate(chat_id):
+    CHAT_SETTINGS.invalidate(str(chat_id))
 
 
 def welcome_mutes(chat_id):
-    try:
-        welcomemutes = SESSION.query(WelcomeMute).get(str(chat_id))
-        if welcomemutes:
-            return welcomemutes.welcomemutes
-        return False
-    finally:
-        SESSION.close()
+    return get_chat_settings(chat_id)["welcome_mutes"]
 
 
 def set_welcome_mutes(chat_id, welcomemutes):
     with WM_LOCK:
-        prev = SESSION.query(WelcomeMute).get((str(chat_id)))
-        if prev:
-            SESSION.delete(prev)
-        welcome_m = WelcomeMute(str(chat_id), welcomemutes)
-        SESSION.add(welcome_m)
-        SESSION.commit()
+        with session_scope(commit=True) as session:
+            prev = session.query(WelcomeMute).get((str(chat_id)))
+            if prev:
+                session.delete(prev)
+            welcome_m = WelcomeMute(str(chat_id), welcomemutes)
+            session.add(welcome_m)
+        __invalidate(chat_id)
 
 
 def set_human_checks(user_id, chat_id):
-    with INSERTION_LOCK:
-        human_check = SESSION.query(WelcomeMuteUsers).get(
+    with INSERTION_LOCK, session_scope(commit=True) as session:
+        human_check = session.query(WelcomeMuteUsers).get(
             (user_id, str(chat_id))
         )
         if not human_check:
@@ -150,99 +242,161 @@ def set_human_checks(user_id, chat_id):
         else:
             human_check.human_check = True
 
-        SESSION.add(human_check)
-        SESSION.commit()
+        session.add(human_check)
+        pending = session.query(HumanCheckPending).get((str(chat_id), user_id))
+        if pending:
+            session.delete(pending)
+        PENDING_CHECKS.pop((str(chat_id), user_id), None)
 
         return human_check
 
 
 def get_human_checks(user_id, chat_id):
-    try:
-        human_check = SESSION.query(WelcomeMuteUsers).get(
+    with session_scope() as session:
+        human_check = session.query(WelcomeMuteUsers).get(
             (user_id, str(chat_id))
         )
         if not human_check:
             return None
         human_check = human_check.human_check
         return human_check
-    finally:
-        SESSION.close()
 
 
-def get_welc_pref(chat_id):
-    welc = SESSION.query(Welcome).get(str(chat_id))
-    SESSION.close()
-    if welc:
-        return welc.should_welcome, welc.custom_welcome, welc.welcome_type
-    else:
-        # Welcome by default.
-        return True, DEFAULT_WELCOME, Types.TEXT
+def add_pending_check(user_id, chat_id, deadline):
+    with HC_LOCK, session_scope(commit=True) as session:
+        session.merge(HumanCheckPending(chat_id, user_id, deadline))
+        __track_pending(str(chat_id), user_id, int(deadline))
 
 
-def get_gdbye_pref(chat_id):
-    welc = SESSION.query(Welcome).get(str(chat_id))
-    SESSION.close()
-    if welc:
-        return welc.should_goodbye, welc.custom_leave, welc.leave_type
-    else:
-        # Welcome by default.
-        return True, DEFAULT_GOODBYE, Types.TEXT
+def __track_pending(chat_id, user_id, deadline):
+    PENDING_CHECKS[(chat_id, user_id)] = deadline
+    heapq.heappush(PENDING_DEADLINES, (deadline, chat_id, user_id))
 
 
-def set_clean_welcome(chat_id, clean_welcome):
-    with INSERTION_LOCK:
-        curr = SESSION.query(Welcome).get(str(chat_id))
-        if not curr:
-            curr = Welcome(str(chat_id))
+def get_pending_check(user_id, chat_id):
+    return PENDING_CHECKS.get((str(chat_id), user_id))
 
-        curr.clean_welcome = int(clean_welcome)
 
-        SESSION.add(curr)
-        SESSION.commit()
+def pop_expired_checks(now, limit):
+    """
+    Take up to limit pending checks whose deadline passed out of memory;
+    delete them with delete_human_checks.
 
+    :return: list of (chat_id, user_id)
+    """
+    expired = []
+    with HC_LOCK:
+        while (
+            PENDING_DEADLINES
+            and PENDING_DEADLINES[0][0] <= now
+            and len(expired) < limit
+        ):
+            deadline, chat_id, user_id = heapq.heappop(PENDING_DEADLINES)
+            # skip checks passed, swept or re-added since
+            if PENDING_CHECKS.get((chat_id, user_id)) == deadline:
+                del PENDING_CHECKS[(chat_id, user_id)]
+                expired.append((chat_id, user_id))
+    return expired
 
-def get_clean_pref(chat_id):
-    welc = SESSION.query(Welcome).get(str(chat_id))
-    SESSION.close()
 
-    if welc:
-        return welc.clean_welcome
+def forget_human_check(user_id, chat_id):
+    """user_id left chat_id, their rows go with the next sweep."""
+    with HC_LOCK:
+        PENDING_CHECKS.pop((str(chat_id), user_id), None)
+        STALE_CHECKS.add((str(chat_id), user_id))
 
-    return False
 
+def take_stale_checks(limit):
+    with HC_LOCK:
+        stale = []
+        while STALE_CHECKS and len(stale) < limit:
+            stale.append(STALE_CHECKS.pop())
+        return stale
 
-def get_welc_mutes_pref(chat_id):
-    welcomemutes = SESSION.query(WelcomeMute).get(str(chat_id))
-    SESSION.close()
 
-    if welcomemutes:
-        return welcomemutes.welcomemutes
+def delete_human_checks(checks):
+    """
+    Delete human checks and pending checks of many users at once.
 
-    return False
+    :param checks: list of (chat_id, user_id)
+    :return: False if the delete failed
+    """
+    if not checks:
+        return True
+    with HC_LOCK:
+        try:
+            with session_scope(commit=True) as session:
+                for table in (WelcomeMuteUsers, HumanCheckPending):
+                    session.query(table).filter(
+                        tuple_(table.chat_id, table.user_id).in_(checks)
+                    ).delete(synchronize_session=False)
+        except:
+            return False
+        return True
 
 
-def set_welc_preference(chat_id, should_welcome):
+def get_welc_pref(chat_id):
+    return get_chat_settings(chat_id)["welcome"]
+
+
+def get_gdbye_pref(chat_id):
+    return get_chat_settings(chat_id)["goodbye"]
+
+
+def set_clean_welcome(chat_id, clean_welcome):
     with INSERTION_LOCK:
-        curr = SESSION.query(Welcome).get(str(chat_id))
-        if not curr:
-            curr = Welcome(str(chat_id), should_welcome=should_welcome)
+        with session_scope(commit=True) as session:
+            curr = session.query(Welcome).get(str(chat_id))
+            created = not curr
+            if created:
+                curr = Welcome(str(chat_id))
+
+            curr.clean_welcome = int(clean_welcome)
+
+            session.add(curr)
+        # runs on every welcome with cleanwelcome on, so update the
+        # cached settings rather than reloading them on the next join
+        settings = CHAT_SETTINGS.get(str(chat_id))
+        if settings and not created:
+            CHAT_SETTINGS.set(
+                str(chat_id), dict(settings, clean_welcome=int(clean_welcome))
+            )
         else:
-            curr.should_welcome = should_welcome
+            __invalidate(chat_id)
+
 
-        SESSION.add(curr)
-        SESSION.commit()
+def get_clean_pref(chat_id):
+    return get_chat_settings(chat_id)["clean_welcome"]
+
+
+def get_welc_mutes_pref(chat_id):
+    return get_chat_settings(chat_id)["welcome_mutes"]
+
+
+def set_welc_preference(chat_id, should_welcome):
+    with INSERTION_LOCK:
+        with session_scope(commit=True) as session:
+            curr = session.query(Welcome).get(str(chat_id))
+            if not curr:
+                curr = Welcome(str(chat_id), should_welcome=should_welcome)
+            else:
+                curr.should_welcome = should_welcome
+
+            session.add(curr)
+        __invalidate(chat_id)
 
 
 def set_gdbye_preference(chat_id, should_goodbye):
     with INSERTION_LOCK:
-        curr = SESSION.query(Welcome).get(str(chat_id))
-        if not curr:
-            curr = Welcome(str(chat_id), should_goodbye=should_goodbye)
-        else:
-            curr.should_goodbye = should_goodbye
+        with session_scope(commit=True) as session:
+            curr = session.query(Welcome).get(str(chat_id))
+            if not curr:
+                curr = Welcome(str(chat_id), should_goodbye=should_goodbye)
+            else:
+                curr.should_goodbye = should_goodbye
 
-        SESSION.add(curr)
-        SESSION.commit()
+            session.add(curr)
+        __invalidate(chat_id)
 
 
 def set_custom_welcome(chat_id, custom_welcome, welcome_type, buttons=None):
@@ -250,44 +404,39 @@ def set_custom_welcome(chat_id, custom_welcome, welcome_type, buttons=None):
         buttons = []
 
     with INSERTION_LOCK:
-        welcome_settings = SESSION.query(Welcome).get(str(chat_id))
-        if not welcome_settings:
-            welcome_settings = Welcome(str(chat_id), True)
+        with session_scope(commit=True) as session:
+            welcome_settings = session.query(Welcome).get(str(chat_id))
+            if not welcome_settings:
+                welcome_settings = Welcome(str(chat_id), True)
 
-        if custom_welcome:
-            welcome_settings.custom_welcome = custom_welcome
-            welcome_settings.welcome_type = welcome_type.value
+            if custom_welcome:
+                welcome_settings.custom_welcome = custom_welcome
+                welcome_settings.welcome_type = welcome_type.value
 
-        else:
-            welcome_settings.custom_welcome = DEFAULT_GOODBYE
-            welcome_settings.welcome_type = Types.TEXT.value
+            else:
+                welcome_settings.custom_welcome = DEFAULT_GOODBYE
+                welcome_settings.welcome_type = Types.TEXT.value
 
-        SESSION.add(welcome_settings)
+            session.add(welcome_settings)
 
-        with WELC_BTN_LOCK:
-            prev_buttons = (
-                SESSION.query(WelcomeButtons)
-                .filter(WelcomeButtons.chat_id == str(chat_id))
-                .all()
-            )
-            for btn in prev_buttons:
-                SESSION.delete(btn)
+            with WELC_BTN_LOCK:
+                prev_buttons = (
+                    session.query(WelcomeButtons)
+                    .filter(WelcomeButtons.chat_id == str(chat_id))
+                    .all()
+                )
+                for btn in prev_buttons:
+                    session.delete(btn)
 
-            for b_name, url, same_line in buttons:
-                button = WelcomeButtons(chat_id, b_name, url, same_line)
-                SESSION.add(button)
+                for b_name, url, same_line in buttons:
+                    button = WelcomeButtons(chat_id, b_name, url, same_line)
+                    session.add(button)
 
-        SESSION.commit()
+        __invalidate(chat_id)
 
 
 def get_custom_welcome(chat_id):
-    welcome_settings = SESSION.query(Welcome).get(str(chat_id))
-    ret = DEFAULT_WELCOME
-    if welcome_settings and welcome_settings.custom_welcome:
-        ret = welcome_settings.custom_welcome
-
-    SESSION.close()
-    return ret
+    return get_chat_settings(chat_id)["welcome"][1] or DEFAULT_WELCOME
 
 
 def set_custom_gdbye(chat_id, custom_goodbye, goodbye_type, buttons=None):
@@ -295,113 +444,102 @@ def set_custom_gdbye(chat_id, custom_goodbye, goodbye_type, buttons=None):
         buttons = []
 
     with INSERTION_LOCK:
-        welcome_settings = SESSION.query(Welcome).get(str(chat_id))
-        if not welcome_settings:
-            welcome_settings = Welcome(str(chat_id), True)
+        with session_scope(commit=True) as session:
+            welcome_settings = session.query(Welcome).get(str(chat_id))
+            if not welcome_settings:
+                welcome_settings = Welcome(str(chat_id), True)
 
-        if custom_goodbye:
-            welcome_settings.custom_leave = custom_goodbye
-            welcome_settings.leave_type = goodbye_type.value
+            if custom_goodbye:
+                welcome_settings.custom_leave = custom_goodbye
+                welcome_settings.leave_type = goodbye_type.value
 
-        else:
-            welcome_settings.custom_leave = DEFAULT_GOODBYE
-            welcome_settings.leave_type = Types.TEXT.value
+            else:
+                welcome_settings.custom_leave = DEFAULT_GOODBYE
+                welcome_settings.leave_type = Types.TEXT.value
 
-        SESSION.add(welcome_settings)
+            session.add(welcome_settings)
 
-        with LEAVE_BTN_LOCK:
-            prev_buttons = (
-                SESSION.query(GoodbyeButtons)
-                .filter(GoodbyeButtons.chat_id == str(chat_id))
-                .all()
-            )
-            for btn in prev_buttons:
-                SESSION.delete(btn)
+            with LEAVE_BTN_LOCK:
+                prev_buttons = (
+                    session.query(GoodbyeButtons)
+                    .filter(GoodbyeButtons.chat_id == str(chat_id))
+                    .all()
+                )
+                for btn in prev_buttons:
+                    session.delete(btn)
 
-            for b_name, url, same_line in buttons:
-                button = GoodbyeButtons(chat_id, b_name, url, same_line)
-                SESSION.add(button)
+                for b_name, url, same_line in buttons:
+                    button = GoodbyeButtons(chat_id, b_name, url, same_line)
+                    session.add(button)
 
-        SESSION.commit()
+        __invalidate(chat_id)
 
 
 def get_custom_gdbye(chat_id):
-    welcome_settings = SESSION.query(Welcome).get(str(chat_id))
-    ret = DEFAULT_GOODBYE
-    if welcome_settings and welcome_settings.custom_leave:
-        ret = welcome_settings.custom_leave
-
-    SESSION.close()
-    return ret
+    return get_chat_settings(chat_id)["goodbye"][1] or DEFAULT_GOODBYE
 
 
 def get_welc_buttons(chat_id):
-    try:
-        return (
-            SESSION.query(WelcomeButtons)
-            .filter(WelcomeButtons.chat_id == str(chat_id))
-            .order_by(WelcomeButtons.id)
-            .all()
-        )
-    finally:
-        SESSION.close()
+    return get_chat_settings(chat_id)["welcome_buttons"]
 
 
 def get_gdbye_buttons(chat_id):
-    try:
-        return (
-            SESSION.query(GoodbyeButtons)
-            .filter(GoodbyeButtons.chat_id == str(chat_id))
-            .order_by(GoodbyeButtons.id)
-            .all()
-        )
-    finally:
-        SESSION.close()
+    return get_chat_settings(chat_id)["goodbye_buttons"]
 
 
 def clean_service(chat_id: Union[str, int]) -> bool:
-    try:
-        chat_setting = SESSION.query(CleanServiceSetting).get(str(chat_id))
-        if chat_setting:
-            return chat_setting.clean_service
-        return False
-    finally:
-        SESSION.close()
+    return get_chat_settings(chat_id)["clean_service"]
 
 
 def set_clean_service(chat_id: Union[int, str], setting: bool):
     with CS_LOCK:
-        chat_setting = SESSION.query(CleanServiceSetting).get(str(chat_id))
-        if not chat_setting:
-            chat_setting = CleanServiceSetting(chat_id)
+        with session_scope(commit=True) as session:
+            chat_setting = session.query(CleanServiceSetting).get(str(chat_id))
+            if not chat_setting:
+                chat_setting = CleanServiceSetting(chat_id)
 
-        chat_setting.clean_service = setting
-        SESSION.add(chat_setting)
-        SESSION.commit()
+            chat_setting.clean_service = setting
+            session.add(chat_setting)
+        __invalidate(chat_id)
 
 
 def migrate_chat(old_chat_id, new_chat_id):
     with INSERTION_LOCK:
-        chat = SESSION.query(Welcome).get(str(old_chat_id))
-        if chat:
-            chat.chat_id = str(new_chat_id)
-
-        with WELC_BTN_LOCK:
-            chat_buttons = (
-                SESSION.query(WelcomeButtons)
-                .filter(WelcomeButtons.chat_id == str(old_chat_id))
-                .all()
-            )
-            for btn in chat_buttons:
-                btn.chat_id = str(new_chat_id)
-
-        with LEAVE_BTN_LOCK:
-            chat_buttons = (
-                SESSION.query(GoodbyeButtons)
-                .filter(GoodbyeButtons.chat_id == str(old_chat_id))
-                .all()
-            )
-            for btn in chat_buttons:
-                btn.chat_id = str(new_chat_id)
-
-        SESSION.commit()
+        with session_scope(commit=True) as session:
+            chat = session.query(Welcome).get(str(old_chat_id))
+            if chat:
+                chat.chat_id = str(new_chat_id)
+
+            with WELC_BTN_LOCK:
+                chat_buttons = (
+                    session.query(WelcomeButtons)
+                    .filter(WelcomeButtons.chat_id == str(old_chat_id))
+                    .all()
+                )
+                for btn in chat_buttons:
+                    btn.chat_id = str(new_chat_id)
+
+            with LEAVE_BTN_LOCK:
+                chat_buttons = (
+                    session.query(GoodbyeButtons)
+                    .filter(GoodbyeButtons.chat_id == str(old_chat_id))
+                    .all()
+                )
+                for btn in chat_buttons:
+                    btn.chat_id = str(new_chat_id)
+
+        __invalidate(old_chat_id)
+        __invalidate(new_chat_id)
+
+
+def __load_pending_checks():
+    with session_scope() as session:
+        for chat_id, user_id, deadline in session.query(
+            HumanCheckPending.chat_id,
+            HumanCheckPending.user_id,
+            HumanCheckPending.deadline,
+        ).yield_per(10000):
+            __track_pending(chat_id, user_id, deadline)
+
+
+__load_pending_checks()
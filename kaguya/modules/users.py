@@ -6,8 +6,19 @@ from telegram import TelegramError
 from telegram.error import BadRequest
 from telegram.ext import MessageHandler, Filters, CommandHandler
 
+try:
+    from telegram.ext import ChatMemberHandler
+except ImportError:  # my_chat_member updates need python-telegram-bot 13.4+
+    ChatMemberHandler = None
+
 import kaguya.modules.sql.users_sql as sql
 from kaguya import dispatcher, OWNER_ID, LOGGER
+from kaguya.modules.helper_funcs.chat_status import (
+    get_bot_member,
+    invalidate_admin_roster,
+    invalidate_bot_member,
+    set_bot_member,
+)
 from kaguya.modules.helper_funcs.filters import CustomFilters
 
 USERS_GROUP = 4
@@ -73,12 +84,12 @@ def log_user(update, context):
     chat = update.effective_chat
     msg = update.effective_message
 
-    sql.update_user(
+    sql.queue_user(
         msg.from_user.id, msg.from_user.username, chat.id, chat.title
     )
 
     if msg.reply_to_message:
-        sql.update_user(
+        sql.queue_user(
             msg.reply_to_message.from_user.id,
             msg.reply_to_message.from_user.username,
             chat.id,
@@ -86,7 +97,11 @@ def log_user(update, context):
         )
 
     if msg.forward_from:
-        sql.update_user(msg.forward_from.id, msg.forward_from.username)
+        sql.queue_user(msg.forward_from.id, msg.forward_from.username)
+
+
+def flush_seen_users(context):
+    sql.flush_users()
 
 
 def chats(update, context):
@@ -105,13 +120,32 @@ def chats(update, context):
 
 
 def chat_checker(update, context):
-    if (
-        update.effective_message.chat.get_member(
-            context.bot.id
-        ).can_send_messages
-        is False
-    ):
-        context.bot.leaveChat(update.effective_message.chat.id)
+    msg = update.effective_message
+    # our own rights may have changed when we get added or removed
+    if msg.left_chat_member and msg.left_chat_member.id == context.bot.id:
+        invalidate_bot_member(msg.chat.id)
+        return
+    if any(mem.id == context.bot.id for mem in msg.new_chat_members):
+        invalidate_bot_member(msg.chat.id)
+
+    if get_bot_member(msg.chat, context.bot.id).can_send_messages is False:
+        context.bot.leaveChat(msg.chat.id)
+
+
+def chat_member_update(update, context):
+    member_update = update.my_chat_member or update.chat_member
+    chat_id = member_update.chat.id
+    if {
+        member_update.old_chat_member.status,
+        member_update.new_chat_member.status,
+    } & {"administrator", "creator"}:
+        invalidate_admin_roster(chat_id)
+
+    if update.my_chat_member:
+        if member_update.new_chat_member.status in ("left", "kicked"):
+            invalidate_bot_member(chat_id)
+        else:
+            set_bot_member(chat_id, member_update.new_chat_member)
 
 
 def __user_info__(user_id):
@@ -130,6 +164,7 @@ def __stats__():
 
 
 def __migrate__(old_chat_id, new_chat_id):
+    # buffered sightings of the old chat are flushed before the move
     sql.migrate_chat(old_chat_id, new_chat_id)
 
 
@@ -152,3 +187,13 @@ dispatcher.add_handler(USER_HANDLER, USERS_GROUP)
 dispatcher.add_handler(BROADCAST_HANDLER)
 dispatcher.add_handler(CHATLIST_HANDLER)
 dispatcher.add_handler(CHAT_CHECKER_HANDLER, CHAT_GROUP)
+dispatcher.job_queue.run_repeating(
+    flush_seen_users, interval=sql.USER_BUFFER_INTERVAL
+)
+
+if ChatMemberHandler:
+    # chat_member updates only arrive when listed in allowed_updates
+    CHAT_MEMBER_HANDLER = ChatMemberHandler(
+        chat_member_update, ChatMemberHandler.ANY_CHAT_MEMBER
+    )
+    dispatcher.add_handler(CHAT_MEMBER_HANDLER, CHAT_GROUP)
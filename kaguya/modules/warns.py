@@ -30,13 +30,13 @@ from kaguya.modules.helper_funcs.chat_status import (
     can_restrict,
 )
 from kaguya.modules.helper_funcs.extraction import (
-    extract_text,
     extract_user_and_text,
     extract_user,
 )
 from kaguya.modules.helper_funcs.filters import CustomFilters
 from kaguya.modules.helper_funcs.misc import split_message
 from kaguya.modules.helper_funcs.string_handling import split_quotes
+from kaguya.modules.helper_funcs.text_analysis import get_analysis
 from kaguya.modules.helper_funcs.alternate import typing_action
 from kaguya.modules.log_channel import loggable
 from kaguya.modules.sql import warns_sql as sql
@@ -425,17 +425,15 @@ def reply_filter(update, context) -> str:
     chat = update.effective_chat  # type: Optional[Chat]
     message = update.effective_message  # type: Optional[Message]
 
-    chat_warn_filters = sql.get_chat_warn_triggers(chat.id)
-    to_match = extract_text(message)
-    if not to_match:
+    analysis = get_analysis(update)
+    if not analysis:
         return ""
 
-    for keyword in chat_warn_filters:
-        pattern = r"( |^|[^\w])" + re.escape(keyword) + r"( |$|[^\w])"
-        if re.search(pattern, to_match, flags=re.IGNORECASE):
-            user = update.effective_user  # type: Optional[User]
-            warn_filter = sql.get_warn_filter(chat.id, keyword)
-            return warn(user, chat, warn_filter.reply, message)
+    keyword = sql.match_warn_filter(chat.id, analysis.lowered)
+    if keyword:
+        user = update.effective_user  # type: Optional[User]
+        warn_filter = sql.get_warn_filter(chat.id, keyword)
+        return warn(user, chat, warn_filter.reply, message)
     return ""
 
 
@@ -1,4 +1,5 @@
 from html import escape
+from string import Formatter
 import time
 import re
 
@@ -20,20 +21,32 @@ from telegram.utils.helpers import mention_html
 
 import kaguya.modules.sql.welcome_sql as sql
 from kaguya.modules.sql.global_bans_sql import is_user_gbanned
-from kaguya import dispatcher, OWNER_ID, LOGGER, MESSAGE_DUMP, spamwtc
+from kaguya import (
+    dispatcher,
+    OWNER_ID,
+    LOGGER,
+    MESSAGE_DUMP,
+    HUMAN_CHECK_TIMEOUT,
+    KICK_UNVERIFIED,
+)
 from kaguya.modules.helper_funcs.chat_status import (
     user_admin,
     is_user_ban_protected,
 )
+from kaguya.modules.helper_funcs import raid_mode
+from kaguya.modules.helper_funcs.fanout import FanoutEngine, RateBudget
+from kaguya.modules.helper_funcs.join_guard import enforce_join
 from kaguya.modules.helper_funcs.misc import build_keyboard, revert_buttons
 from kaguya.modules.helper_funcs.msg_types import get_welcome_type
 from kaguya.modules.helper_funcs.alternate import typing_action
+from kaguya.modules.helper_funcs.spamwatch_mirror import is_sw_banned
 from kaguya.modules.helper_funcs.string_handling import (
     markdown_parser,
     escape_invalid_curly_brackets,
     markdown_to_html,
 )
 from kaguya.modules.log_channel import loggable
+from kaguya.mwt import TTLCache
 
 VALID_WELCOME_FORMATTERS = [
     "first",
@@ -46,6 +59,9 @@ VALID_WELCOME_FORMATTERS = [
     "mention",
 ]
 
+HUMAN_CHECK_SWEEP = 60
+SWEEP_BATCH = 500
+
 ENUM_FUNC_MAP = {
     sql.Types.TEXT.value: dispatcher.bot.send_message,
     sql.Types.BUTTON_TEXT.value: dispatcher.bot.send_message,
@@ -58,6 +74,74 @@ ENUM_FUNC_MAP = {
 }
 
 
+class Greeting(object):
+    """
+    A chat's custom welcome or goodbye, converted to html and split into
+    text and fields once, with its keyboard already built. Only the
+    member's fields are filled in per join or leave.
+    """
+
+    __slots__ = ("parts", "fields", "keyboard")
+
+    def __init__(self, text, buttons):
+        text = escape_invalid_curly_brackets(
+            markdown_to_html(text), VALID_WELCOME_FORMATTERS
+        )
+        self.parts = [
+            (literal, field)
+            for literal, field, _, _ in Formatter().parse(text)
+        ]
+        self.fields = {field for _, field in self.parts if field}
+        self.keyboard = InlineKeyboardMarkup(build_keyboard(buttons))
+
+    def render(self, chat, member):
+        first_name = (
+            member.first_name or "PersonWithNoName"
+        )  # edge case of empty name - occurs for some bugs.
+        if member.last_name:
+            fullname = "{} {}".format(first_name, member.last_name)
+        else:
+            fullname = first_name
+        mention = mention_html(member.id, first_name)
+        if member.username:
+            username = "@" + escape(member.username)
+        else:
+            username = mention
+        values = {
+            "first": escape(first_name),
+            "last": escape(member.last_name or first_name),
+            "fullname": escape(fullname),
+            "username": username,
+            "mention": mention,
+            "chatname": escape(chat.title),
+            "id": member.id,
+        }
+        # the only field that costs an api call
+        if "count" in self.fields:
+            values["count"] = chat.get_members_count()
+        return "".join(
+            literal + str(values[field]) if field else literal
+            for literal, field in self.parts
+        )
+
+
+# (chat_id, "welcome" or "goodbye") -> (text, buttons, Greeting)
+GREETINGS = TTLCache(timeout=60 * 60, maxsize=5000)
+
+
+def get_greeting(chat_id, kind) -> Greeting:
+    settings = sql.get_chat_settings(chat_id)
+    text = settings[kind][1]
+    buttons = settings[kind + "_buttons"]
+    cached = GREETINGS.get((chat_id, kind))
+    # settings are replaced, never modified, when they change
+    if cached and cached[0] is text and cached[1] is buttons:
+        return cached[2]
+    greeting = Greeting(text, buttons)
+    GREETINGS.set((chat_id, kind), (text, buttons, greeting))
+    return greeting
+
+
 # do not async
 def send(update, message, keyboard, backup_message):
     chat = update.effective_chat
@@ -152,9 +236,31 @@ def new_member(update, context):
     chat = update.effective_chat
     user = update.effective_user
     msg = update.effective_message
-    chat_name = chat.title or chat.first or chat.username
+    # Remove users banned on SpamWatch, globally or in the chat's feds
+    # before anything is spent on welcoming them
+    banned = {
+        mem.id
+        for mem in msg.new_chat_members
+        if enforce_join(update, mem.id).kind
+    }
     should_welc, cust_welcome, welc_type = sql.get_welc_pref(chat.id)
-    cust_welcome = markdown_to_html(cust_welcome)
+    # During a raid joins are only counted, see raid_tick. Chats with
+    # welcomes off get neither welcomes nor welcomemutes, so no raids
+    if should_welc:
+        raid, started = raid_mode.record_joins(
+            chat,
+            [
+                mem.id
+                for mem in msg.new_chat_members
+                if mem.id not in banned and mem.id != context.bot.id
+            ],
+            msg.message_id,
+        )
+        if raid:
+            if started:
+                start_raid(context.bot, raid)
+            return
+    chat_name = chat.title or chat.first or chat.username
     welc_mutes = sql.welcome_mutes(chat.id)
     user_id = user.id
     human_checks = sql.get_human_checks(user_id, chat.id)
@@ -175,17 +281,9 @@ def new_member(update, context):
                     pass
                 reply = False
 
-            # Ignore spamwatch banned users
-            try:
-                sw = spamwtc.get_ban(int(new_mem.id))
-                if sw:
-                    return
-            except Exception:
-                pass
-
-            # Ignore gbanned users
-            if is_user_gbanned(new_mem.id):
-                return
+            # Ignore banned users
+            if new_mem.id in banned:
+                continue
 
             # Give the owner a special welcome
             if new_mem.id == OWNER_ID:
@@ -226,40 +324,13 @@ def new_member(update, context):
                     new_mem.first_name or "PersonWithNoName"
                 )  # edge case of empty name - occurs for some bugs.
 
-                if cust_welcome:
-                    if new_mem.last_name:
-                        fullname = "{} {}".format(
-                            first_name, new_mem.last_name
-                        )
-                    else:
-                        fullname = first_name
-                    count = chat.get_members_count()
-                    mention = mention_html(new_mem.id, first_name)
-                    if new_mem.username:
-                        username = "@" + escape(new_mem.username)
-                    else:
-                        username = mention
-
-                    valid_format = escape_invalid_curly_brackets(
-                        cust_welcome, VALID_WELCOME_FORMATTERS
-                    )
-                    res = valid_format.format(
-                        first=escape(first_name),
-                        last=escape(new_mem.last_name or first_name),
-                        fullname=escape(fullname),
-                        username=username,
-                        mention=mention,
-                        count=count,
-                        chatname=escape(chat.title),
-                        id=new_mem.id,
-                    )
-                    buttons = sql.get_welc_buttons(chat.id)
-                    keyb = build_keyboard(buttons)
+                greeting = get_greeting(chat.id, "welcome")
+                if greeting.parts:
+                    res = greeting.render(chat, new_mem)
+                    keyboard = greeting.keyboard
                 else:
                     res = sql.DEFAULT_WELCOME.format(first=first_name)
-                    keyb = []
-
-                keyboard = InlineKeyboardMarkup(keyb)
+                    keyboard = InlineKeyboardMarkup([])
 
                 sent = send(
                     update,
@@ -331,6 +402,9 @@ def new_member(update, context):
                             can_add_web_page_previews=False,
                         ),
                     )
+                    sql.add_pending_check(
+                        new_mem.id, chat.id, time.time() + HUMAN_CHECK_TIMEOUT
+                    )
         prev_welc = sql.get_clean_pref(chat.id)
         if prev_welc:
             try:
@@ -342,10 +416,195 @@ def new_member(update, context):
                 sql.set_clean_welcome(chat.id, sent.message_id)
 
 
+def raid_summary(raid, ended=False):
+    mutes = raid.settings[0] if raid.settings else False
+    elapsed = int(raid.last_join - raid.started)
+    if ended:
+        text = "Raid mode is over: {} members joined in {} seconds.".format(
+            raid.joins, elapsed
+        )
+    else:
+        text = (
+            "⚠️ <b>Raid mode</b>\n{} members joined in {} seconds, welcome "
+            "messages are paused until things calm down.".format(
+                raid.joins, elapsed
+            )
+        )
+    if mutes == "strong":
+        text += "\nNew members are muted, press the button below to talk."
+    elif mutes == "soft":
+        text += "\nNew members can't send media for 24 hours."
+    return text
+
+
+def raid_keyboard(raid):
+    if not raid.settings or raid.settings[0] != "strong":
+        return None
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    text="Yus, I'm a human",
+                    callback_data="user_join_(raid)",
+                )
+            ]
+        ]
+    )
+
+
+def start_raid(bot, raid):
+    chat_id = raid.chat.id
+    try:
+        settings = (sql.welcome_mutes(chat_id), sql.clean_service(chat_id))
+    except Exception:
+        # raid_tick skips raids without settings, so this one would never
+        # end and keep swallowing the chat's joins
+        raid_mode.end_raid(raid)
+        raise
+    raid.settings = settings
+    raid.shown = raid.joins
+    try:
+        sent = bot.send_message(
+            chat_id,
+            raid_summary(raid),
+            parse_mode=ParseMode.HTML,
+            reply_markup=raid_keyboard(raid),
+        )
+        raid.summary_id = sent.message_id
+    except BadRequest:
+        pass
+
+
+def queued_action(job, target):
+    chat_id, action, target_id = target
+    try:
+        if action == "delete":
+            dispatcher.bot.delete_message(chat_id, target_id)
+        elif action == "kick":
+            if dispatcher.bot.kick_chat_member(chat_id, target_id):
+                dispatcher.bot.unban_chat_member(chat_id, target_id)
+        elif action == "soft":
+            dispatcher.bot.restrict_chat_member(
+                chat_id,
+                target_id,
+                permissions=ChatPermissions(
+                    can_send_messages=True,
+                    can_send_media_messages=False,
+                    can_send_other_messages=False,
+                    can_add_web_page_previews=False,
+                ),
+                until_date=int(time.time() + 24 * 60 * 60),
+            )
+        else:
+            # their pending check lets them use the raid summary's button;
+            # the mute ends with it so nobody is left muted without one
+            deadline = time.time() + HUMAN_CHECK_TIMEOUT
+            if dispatcher.bot.restrict_chat_member(
+                chat_id,
+                target_id,
+                permissions=ChatPermissions(can_send_messages=False),
+                until_date=int(deadline),
+            ):
+                sql.add_pending_check(target_id, chat_id, deadline)
+    except BadRequest:
+        return False
+    return True
+
+
+# restrictions and service message deletes of raided chats, and kicks of
+# unverified users, through one shared budget so a raid can't flood us
+# into a RetryAfter
+ACTION_QUEUE = FanoutEngine(
+    queued_action,
+    lambda job: None,
+    lambda job: None,
+    workers=2,
+    jobs=1,
+    budget=RateBudget(rate=10, per_chat=0),
+)
+
+
+def raid_tick(context):
+    raid_mode.forget_quiet_chats()
+    for raid in raid_mode.active_raids():
+        if raid.settings is None:
+            # start_raid is still reading the settings
+            continue
+        chat = raid.chat
+        mutes, cleanserv = raid.settings
+        members, service_msgs = raid_mode.take_pending(raid)
+        targets = []
+        if cleanserv:
+            targets.extend((chat.id, "delete", x) for x in service_msgs)
+        if mutes in ("soft", "strong"):
+            targets.extend(
+                (chat.id, mutes, x)
+                for x in members
+                if not is_user_ban_protected(chat, x)
+            )
+        if targets:
+            ACTION_QUEUE.submit(
+                {
+                    "job_id": "raid {}".format(chat.id),
+                    "targets": targets,
+                    "progress": 0,
+                    "affected": 0,
+                }
+            )
+
+        ended = raid_mode.end_raid_if_quiet(raid)
+        if raid.summary_id and (ended or raid.shown != raid.joins):
+            raid.shown = raid.joins
+            try:
+                context.bot.edit_message_text(
+                    raid_summary(raid, ended),
+                    chat_id=chat.id,
+                    message_id=raid.summary_id,
+                    parse_mode=ParseMode.HTML,
+                    reply_markup=raid_keyboard(raid),
+                )
+            except BadRequest:
+                pass
+
+
+def sweep_human_checks(context):
+    """
+    Drop human checks of users who left and of users who didn't press
+    the welcomemute button in time, SWEEP_BATCH rows per delete; the
+    latter are kicked too with KICK_UNVERIFIED set.
+    """
+    now = time.time()
+    while True:
+        expired = sql.pop_expired_checks(now, SWEEP_BATCH)
+        stale = sql.take_stale_checks(SWEEP_BATCH - len(expired))
+        if not expired and not stale:
+            break
+        if KICK_UNVERIFIED and expired:
+            ACTION_QUEUE.submit(
+                {
+                    "job_id": "unverified",
+                    "targets": [
+                        (int(chat_id), "kick", user_id)
+                        for chat_id, user_id in expired
+                    ],
+                    "progress": 0,
+                    "affected": 0,
+                }
+            )
+        if not sql.delete_human_checks(expired + stale):
+            LOGGER.warning(
+                "Failed to sweep %d human checks", len(expired + stale)
+            )
+            break
+
+
 def left_member(update, context):
     chat = update.effective_chat  # type: Optional[Chat]
+    if update.effective_message.left_chat_member:
+        sql.forget_human_check(
+            update.effective_message.left_chat_member.id, chat.id
+        )
     should_goodbye, cust_goodbye, goodbye_type = sql.get_gdbye_pref(chat.id)
-    cust_goodbye = markdown_to_html(cust_goodbye)
     if should_goodbye:
         reply = update.message.message_id
         cleanserv = sql.clean_service(chat.id)
@@ -367,12 +626,8 @@ def left_member(update, context):
                 return
 
             # Ignore spamwatch banned users
-            try:
-                sw = spamwtc.get_ban(int(left_mem.id))
-                if sw:
-                    return
-            except:
-                pass
+            if is_sw_banned(left_mem.id):
+                return
 
             # Ignore bot being kicked
             if left_mem.id == context.bot.id:
@@ -393,42 +648,13 @@ def left_member(update, context):
                 ENUM_FUNC_MAP[goodbye_type](chat.id, cust_goodbye)
                 return
 
-            first_name = (
-                left_mem.first_name or "PersonWithNoName"
-            )  # edge case of empty name - occurs for some bugs.
-            if cust_goodbye:
-                if left_mem.last_name:
-                    fullname = "{} {}".format(first_name, left_mem.last_name)
-                else:
-                    fullname = first_name
-                count = chat.get_members_count()
-                mention = mention_html(left_mem.id, first_name)
-                if left_mem.username:
-                    username = "@" + escape(left_mem.username)
-                else:
-                    username = mention
-
-                valid_format = escape_invalid_curly_brackets(
-                    cust_goodbye, VALID_WELCOME_FORMATTERS
-                )
-                res = valid_format.format(
-                    first=escape(first_name),
-                    last=escape(left_mem.last_name or first_name),
-                    fullname=escape(fullname),
-                    username=username,
-                    mention=mention,
-                    count=count,
-                    chatname=escape(chat.title),
-                    id=left_mem.id,
-                )
-                buttons = sql.get_gdbye_buttons(chat.id)
-                keyb = build_keyboard(buttons)
-
+            greeting = get_greeting(chat.id, "goodbye")
+            if greeting.parts:
+                res = greeting.render(chat, left_mem)
+                keyboard = greeting.keyboard
             else:
                 res = sql.DEFAULT_GOODBYE
-                keyb = []
-
-            keyboard = InlineKeyboardMarkup(keyb)
+                keyboard = InlineKeyboardMarkup([])
 
             send(update, res, keyboard, sql.DEFAULT_GOODBYE)
 
@@ -796,10 +1022,14 @@ def user_button(update, context):
     query = update.callback_query  # type: Optional[CallbackQuery]
     match = re.match(r"user_join_\((.+?)\)", query.data)
     message = update.effective_message  # type: Optional[Message]
-    db_checks = sql.set_human_checks(user.id, chat.id)
-    join_user = int(match.group(1))
+    join_user = match.group(1)
+    if join_user == "raid":
+        # muted by raid mode, anyone muted can use the summary's button
+        allowed = sql.get_pending_check(user.id, chat.id) is not None
+    else:
+        allowed = int(join_user) == user.id
 
-    if join_user == user.id:
+    if allowed:
         query.answer(text="Yus! You're a human, Unmuted!")
         context.bot.restrict_chat_member(
             chat.id,
@@ -815,8 +1045,9 @@ def user_button(update, context):
                 can_add_web_page_previews=True,
             ),
         )
-        context.bot.deleteMessage(chat.id, message.message_id)
-        db_checks
+        if join_user != "raid":
+            context.bot.deleteMessage(chat.id, message.message_id)
+        sql.set_human_checks(user.id, chat.id)
     else:
         query.answer(text="You're not allowed to do this!")
 
@@ -906,6 +1137,9 @@ __help__ = """
  × /cleanservice <on/off>: Clean 'user is joined' service messages automatically.
  × /welcomemute <off/soft/strong>: All users that join, get muted; a button gets added to the welcome message for them to unmute themselves. \
 This proves they aren't a bot! soft - restricts users ability to post media for 24 hours. strong - mutes on join until they prove they're not bots.
+
+When lots of people join at once, I switch to raid mode: welcomes are paused, new members get the welcomemute treatment \
+and one summary message is kept up to date instead. Raid mode ends by itself once joins calm down.
  × /welcomehelp: View more formatting information for custom welcome/goodbye messages.
 
 Buttons in welcome messages are made easy, everyone hates URLs visible. With button links you can make your chats look more \
@@ -976,3 +1210,11 @@ dispatcher.add_handler(WELCOMEMUTE_HANDLER)
 dispatcher.add_handler(CLEAN_SERVICE_HANDLER)
 dispatcher.add_handler(BUTTON_VERIFY_HANDLER)
 dispatcher.add_handler(WELCOME_HELP)
+
+ACTION_QUEUE.start()
+dispatcher.job_queue.run_repeating(
+    sweep_human_checks, interval=HUMAN_CHECK_SWEEP, first=HUMAN_CHECK_SWEEP
+)
+dispatcher.job_queue.run_repeating(
+    raid_tick, interval=raid_mode.RAID_TICK, first=raid_mode.RAID_TICK
+)
@@ -1,43 +1,177 @@
+import threading
 import time
+from collections import OrderedDict
+from functools import wraps
 
+_MISSING = object()
+
+
+class _Flight(object):
+    """A load in progress, waited on by concurrent misses of the same key."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.stale = False
+
+
+def _key_startswith(key, prefix) -> bool:
+    if not isinstance(key, tuple):
+        key = (key,)
+    if not isinstance(prefix, tuple):
+        prefix = (prefix,)
+    return key[: len(prefix)] == prefix
 
-class MWT(object):
-    """Memoize With Timeout"""
 
-    _caches = {}
-    _timeouts = {}
+class TTLCache(object):
+    """
+    Thread safe cache with per entry expiry and LRU eviction.
 
-    def __init__(self, timeout=2):
+    Concurrent misses on the same key through get_or_load only run the
+    loader once; the other callers wait for its result.
+    """
+
+    def __init__(self, timeout: float, maxsize: int = 1024):
         self.timeout = timeout
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._loading = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _lookup(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return _MISSING
+        if entry[1] <= time.time():
+            del self._data[key]
+            return _MISSING
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            flight = self._loading.get(key)
+            if flight is not None:
+                # newer than whatever the running load will return
+                flight.stale = True
+            self._data[key] = (value, time.time() + self.timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """
+        Get key, calling loader() to fill it on a miss.
+
+        :param key: hashable cache key
+        :param loader: zero argument callable returning the value
+        :return: the cached or freshly loaded value
+        """
+        with self._lock:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+            self.misses += 1
+            flight = self._loading.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._loading[key] = _Flight()
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+        except Exception as excp:
+            flight.error = excp
+            raise
+        else:
+            with self._lock:
+                # don't store a value that was invalidated while loading
+                if not flight.stale:
+                    self.set(key, flight.value)
+            return flight.value
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            flight.event.set()
+
+    def invalidate(self, prefix):
+        """
+        Drop key prefix, and every tuple key starting with it.
+
+        eg: invalidate(chat_id) drops both chat_id and (chat_id, user_id).
+        """
+        with self._lock:
+            for key in [k for k in self._data if _key_startswith(k, prefix)]:
+                del self._data[key]
+            for key, flight in self._loading.items():
+                if _key_startswith(key, prefix):
+                    flight.stale = True
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            for flight in self._loading.values():
+                flight.stale = True
 
     def collect(self):
         """Clear cache of results which have timed out"""
-        for func in self._caches:
-            cache = {}
-            for key in self._caches[func]:
-                if (time.time() - self._caches[func][key][1]) < self._timeouts[
-                    func
-                ]:
-                    cache[key] = self._caches[func][key]
-            self._caches[func] = cache
+        with self._lock:
+            now = time.time()
+            for key in [k for k, v in self._data.items() if v[1] <= now]:
+                del self._data[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class MWT(object):
+    """Memoize With Timeout"""
+
+    def __init__(self, timeout=2, maxsize=1024, key=None):
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.key = key
 
     def __call__(self, f):
-        self.cache = self._caches[f] = {}
-        self._timeouts[f] = self.timeout
+        cache = TTLCache(self.timeout, self.maxsize)
 
+        @wraps(f)
         def func(*args, **kwargs):
-            kw = sorted(kwargs.items())
-            key = (args, tuple(kw))
-            try:
-                v = self.cache[key]
-                # print("cache")
-                if (time.time() - v[1]) > self.timeout:
-                    raise KeyError
-            except KeyError:
-                # print("new")
-                v = self.cache[key] = f(*args, **kwargs), time.time()
-            return v[0]
-
-        func.func_name = f.__name__
+            if self.key:
+                key = self.key(*args, **kwargs)
+            else:
+                key = args + tuple(sorted(kwargs.items()))
+            return cache.get_or_load(key, lambda: f(*args, **kwargs))
 
+        func.cache = cache
         return func
@@ -43,9 +43,22 @@ class Config(object):
     DONATION_LINK = None  # EG, paypal
     CERT_PATH = None
     PORT = 5000
+    # Port serving /metrics for prometheus, eg. 5001. Unauthenticated, so
+    # firewall it off from everything but the scraper. 0 to disable
+    METRICS_PORT = 0
     DEL_CMDS = False  # Whether or not you should delete "blue text must click" commands
     STRICT_GBAN = True
     WORKERS = 8  # Number of subthreads to use. This is the recommended amount - see for yourself what works best!
+    SHARDS = 4  # Number of threads updates are handled on, each chat's updates always go to the same one
+    DB_POOL_SIZE = 16  # Database connections kept open, enough for WORKERS + SHARDS and the jobs
+    # Extra connections opened when all of the above are in use
+    DB_MAX_OVERFLOW = 16
+    # Seconds after which a connection is replaced by a fresh one
+    DB_POOL_RECYCLE = 30 * 60
+    # Compiled SQL statements to cache, needs sqlalchemy 1.4+
+    DB_QUERY_CACHE = 500
+    # Log SQL statements taking longer than this, see /dbstats
+    SLOW_QUERY_MS = 250
     BAN_STICKER = None  # banhammer marie sticker
     ALLOW_EXCL = (
         False  # DEPRECATED, USE BELOW INSTEAD! Allow ! commands as well as /
@@ -53,6 +66,11 @@ class Config(object):
     CUSTOM_CMD = False  # Set to ('/', '!') or whatever to enable it, like ALLOW_EXCL but with more custom handler!
     API_OPENWEATHER = None  # OpenWeather API
     SPAMWATCH_API = None  # Your SpamWatch token
+    SPAMWATCH_SNAPSHOT = None  # File to keep a copy of the SpamWatch ban list in, eg. "spamwatch.txt"
+    # Seconds strong welcomemuted users get to press the button
+    HUMAN_CHECK_TIMEOUT = 24 * 60 * 60
+    # Kick strong welcomemuted users who didn't press it in time
+    KICK_UNVERIFIED = False
     WALL_API = None
 
 
@@ -0,0 +1,97 @@
+import queue
+import threading
+import time
+from typing import List, Optional
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from kaguya import LOGGER
+
+
+class ChatShardedExecutor(object):
+    """
+    Handle a Dispatcher's updates on `shards` threads instead of its one.
+
+    Updates are hashed onto a shard by chat id, or by user id for updates
+    without a chat, so every chat's updates are handled one at a time in
+    the order they came in while different chats are handled in parallel.
+    State kept per chat, like antiflood's counters, is thus only ever
+    touched by one thread. Handlers with run_async still go to the
+    dispatcher's pool, outside of that order.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, shards: int = 4):
+        self.dispatcher = dispatcher
+        # the dispatcher's own, wrap it to see every update handled
+        self.process_update = dispatcher.process_update
+        self._queues = [queue.Queue() for _ in range(shards)]
+        # per shard [updates handled, total latency, slowest], only
+        # written by the shard's own thread
+        self._stats = [[0, 0.0, 0.0] for _ in range(shards)]
+        self._threads = [
+            threading.Thread(
+                target=self._run,
+                args=(shard,),
+                name="shard_{}".format(shard),
+                daemon=True,
+            )
+            for shard in range(shards)
+        ]
+
+    def install(self):
+        """Start the shards and take over the dispatcher's updates."""
+        for thread in self._threads:
+            thread.start()
+        self.dispatcher.process_update = self.submit
+
+    def shard_of(self, update) -> Optional[int]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            key = update.effective_chat.id
+        elif update.effective_user:
+            key = update.effective_user.id
+        else:
+            return None
+        return key % len(self._queues)
+
+    def submit(self, update):
+        shard = self.shard_of(update)
+        if shard is None:
+            # errors and chatless updates, handled as before
+            self.process_update(update)
+            return
+        self._queues[shard].put((time.monotonic(), update))
+
+    def _run(self, shard):
+        updates = self._queues[shard]
+        stats = self._stats[shard]
+        while True:
+            queued, update = updates.get()
+            try:
+                self.process_update(update)
+            except Exception:
+                LOGGER.exception("Shard %d failed to handle an update", shard)
+            latency = time.monotonic() - queued
+            stats[0] += 1
+            stats[1] += latency
+            stats[2] = max(stats[2], latency)
+
+    def stats(self) -> List[dict]:
+        """
+        Per shard: updates waiting, updates handled, and their average
+        and worst latency from being received to being handled.
+        """
+        return [
+            {
+                "shard": shard,
+                "depth": updates.qsize(),
+                "handled": handled,
+                "avg_ms": total * 1000 / handled if handled else 0.0,
+                "max_ms": slowest * 1000,
+            }
+            for shard, (updates, (handled, total, slowest)) in enumerate(
+                zip(self._queues, self._stats)
+            )
+        ]